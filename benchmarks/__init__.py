@@ -0,0 +1,3 @@
+from .fake_docker import FakeDocker, FakeDockerConfig
+from .runner import BenchmarkResult, measure, save_results
+from .scenarios import SCENARIOS
@@ -0,0 +1,57 @@
+"""
+Runs benchmarks against a local fake Docker Engine API::
+
+    python -m benchmarks --concurrency 1 8 32 --operations 200 --output results.json
+
+The fake server runs in the same process, its work is constant between
+releases, so results of different releases can be compared.
+"""
+import argparse
+import asyncio
+from pathlib import Path
+
+from runbox import DockerExecutor
+from .fake_docker import FakeDocker, FakeDockerConfig
+from .runner import BenchmarkResult, save_results
+from .scenarios import SCENARIOS
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--operations", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of every API call, seconds")
+    parser.add_argument("--run-time", type=float, default=0.0, help="run time of containers, seconds")
+    parser.add_argument("--output-size", type=int, default=1024, help="stdout size of containers, bytes")
+    parser.add_argument("--output", type=Path, default=Path("benchmark-results.json"))
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> list[BenchmarkResult]:
+    config = FakeDockerConfig(
+        latency=args.latency,
+        run_time=args.run_time,
+        stdout=(b"x" * 79 + b"\n") * (args.output_size // 80) + b"x" * (args.output_size % 80),
+    )
+    results = []
+    async with FakeDocker(config) as docker:
+        executor = DockerExecutor(url=docker.url)
+        try:
+            for name in args.scenarios:
+                for concurrency in args.concurrency:
+                    result = await SCENARIOS[name](executor, config, concurrency, args.operations)
+                    print(
+                        f"{result.name:<20} concurrency={result.concurrency:<4} "
+                        f"{result.throughput:10.1f} op/s  "
+                        f"p50={result.p50 * 1000:8.2f}ms  p99={result.p99 * 1000:8.2f}ms"
+                    )
+                    results.append(result)
+        finally:
+            await executor.close()
+    return results
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    save_results(asyncio.run(main(arguments)), arguments.output)
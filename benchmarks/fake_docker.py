@@ -0,0 +1,294 @@
+import asyncio
+import json
+import struct
+import tempfile
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+from aiohttp import web
+
+__all__ = [
+    "FakeDocker",
+    "FakeDockerConfig",
+]
+
+API_VERSION = "1.41"
+
+_HEADER = struct.Struct(">BxxxL")
+
+
+@dataclass
+class FakeDockerConfig:
+    """
+    :param latency: delay of every API call in seconds.
+    :param latencies: delays of particular endpoints, e.g. ``{"create": 0.05}``,
+        override the common latency.
+    :param run_time: how long a container runs after it's started.
+    :param stdout: output written by every container run.
+    :param frame_size: maximal payload of one multiplexed frame.
+    :param exit_code: exit code of every container.
+    """
+    latency: float = 0.0
+    latencies: dict[str, float] = field(default_factory=dict)
+    run_time: float = 0.0
+    stdout: bytes = b"Hello, world!\n"
+    frame_size: int = 4096
+    exit_code: int = 0
+
+
+@dataclass
+class _Container:
+    id: str
+    name: str
+    config: dict
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    exit_code: int | None = None
+    finished: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def state(self) -> dict:
+        running = self.started_at is not None and not self.finished.is_set()
+        return {
+            "Status": "running" if running else ("exited" if self.started_at else "created"),
+            "Running": running,
+            "ExitCode": self.exit_code or 0,
+            "OOMKilled": False,
+            "StartedAt": _timestamp(self.started_at),
+            "FinishedAt": _timestamp(self.finished_at),
+        }
+
+
+def _timestamp(moment: datetime | None) -> str:
+    return (moment or datetime(1, 1, 1, tzinfo=timezone.utc)).isoformat()
+
+
+class FakeDocker:
+    """
+    Local server imitating the part of Docker Engine API, that runbox
+    uses: containers (create, list, start, attach, wait, inspect, kill, update,
+    archive upload, delete) and volumes. Containers don't run anything,
+    they write the configured output and exit after the configured time,
+    so only the overhead of runbox and the HTTP round-trips is measured.
+
+    Usage::
+
+        async with FakeDocker(FakeDockerConfig(run_time=0.01)) as docker:
+            executor = DockerExecutor(url=docker.url)
+    """
+
+    def __init__(self, config: FakeDockerConfig | None = None) -> None:
+        self.config = config or FakeDockerConfig()
+        self.calls: Counter[str] = Counter()
+        self.containers: dict[str, _Container] = {}
+        self.volumes: set[str] = set()
+        self._runner: web.AppRunner | None = None
+        self._tmp: tempfile.TemporaryDirectory | None = None
+        self._runs: set[asyncio.Task] = set()
+        self.url: str | None = None
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_get("/version", self._version)
+        app.router.add_get("/_ping", self._ping)
+        prefix = "/v{version}"
+        app.router.add_get(f"{prefix}/containers/json", self._list)
+        app.router.add_post(f"{prefix}/containers/create", self._create)
+        app.router.add_get(f"{prefix}/containers/{{id}}/json", self._inspect)
+        app.router.add_post(f"{prefix}/containers/{{id}}/start", self._start)
+        app.router.add_post(f"{prefix}/containers/{{id}}/attach", self._attach)
+        app.router.add_post(f"{prefix}/containers/{{id}}/wait", self._wait)
+        app.router.add_post(f"{prefix}/containers/{{id}}/kill", self._kill)
+        app.router.add_post(f"{prefix}/containers/{{id}}/update", self._update)
+        app.router.add_put(f"{prefix}/containers/{{id}}/archive", self._put_archive)
+        app.router.add_delete(f"{prefix}/containers/{{id}}", self._delete)
+        app.router.add_post(f"{prefix}/volumes/create", self._create_volume)
+        app.router.add_delete(f"{prefix}/volumes/{{name}}", self._delete_volume)
+        return app
+
+    async def start(self) -> str:
+        """Starts the server on a unix socket and returns its url"""
+        self._tmp = tempfile.TemporaryDirectory(prefix="runbox-fake-docker-")
+        socket = Path(self._tmp.name) / "docker.sock"
+        self._runner = web.AppRunner(self.app(), handle_signals=False)
+        await self._runner.setup()
+        await web.UnixSite(self._runner, str(socket)).start()
+        self.url = f"unix://{socket}"
+        return self.url
+
+    async def close(self) -> None:
+        for task in self._runs:
+            task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._tmp is not None:
+            self._tmp.cleanup()
+            self._tmp = None
+
+    async def __aenter__(self) -> "FakeDocker":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    async def _call(self, endpoint: str) -> None:
+        self.calls[endpoint] += 1
+        delay = self.config.latencies.get(endpoint, self.config.latency)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def _container(self, request: web.Request) -> _Container:
+        key = request.match_info["id"]
+        container = self.containers.get(key)
+        if container is None:
+            container = next((c for c in self.containers.values() if c.name == key), None)
+        if container is None:
+            raise web.HTTPNotFound(
+                text=f'{{"message": "No such container: {key}"}}',
+                content_type="application/json",
+            )
+        return container
+
+    def _finish(self, container: _Container, exit_code: int) -> None:
+        if not container.finished.is_set():
+            container.exit_code = exit_code
+            container.finished_at = datetime.now(timezone.utc)
+            container.finished.set()
+
+    async def _run(self, container: _Container) -> None:
+        await asyncio.sleep(self.config.run_time)
+        self._finish(container, self.config.exit_code)
+
+    async def _version(self, _: web.Request) -> web.Response:
+        return web.json_response({"ApiVersion": API_VERSION, "Version": "fake"})
+
+    async def _ping(self, _: web.Request) -> web.Response:
+        return web.Response(text="OK")
+
+    async def _create(self, request: web.Request) -> web.Response:
+        await self._call("create")
+        config = await request.json()
+        container_id = uuid.uuid4().hex
+        name = request.query.get("name", container_id)
+        self.containers[container_id] = _Container(container_id, name, config)
+        return web.json_response({"Id": container_id, "Warnings": []}, status=201)
+
+    async def _list(self, request: web.Request) -> web.Response:
+        await self._call("list")
+        filters = json.loads(request.query.get("filters", "{}"))
+        volumes = set(filters.get("volume", []))
+        return web.json_response([
+            {"Id": container.id, "Names": [f"/{container.name}"]}
+            for container in self.containers.values()
+            if not volumes or volumes & self._volumes_of(container)
+        ])
+
+    @staticmethod
+    def _volumes_of(container: _Container) -> set[str]:
+        mounts = container.config.get("HostConfig", {}).get("Mounts") or []
+        return {mount["Source"] for mount in mounts if mount.get("Type") == "volume"}
+
+    async def _inspect(self, request: web.Request) -> web.Response:
+        await self._call("inspect")
+        container = self._container(request)
+        info = {
+            "Id": container.id,
+            "Name": f"/{container.name}",
+            "Config": {"Tty": False, **container.config},
+            "State": container.state(),
+        }
+        if request.query.get("size") == "true":
+            # Containers don't write anything
+            info["SizeRw"] = 0
+        return web.json_response(info)
+
+    async def _start(self, request: web.Request) -> web.Response:
+        await self._call("start")
+        container = self._container(request)
+        container.started_at = datetime.now(timezone.utc)
+        container.finished_at = None
+        container.exit_code = None
+        container.finished = asyncio.Event()
+        task = asyncio.get_running_loop().create_task(self._run(container))
+        self._runs.add(task)
+        task.add_done_callback(self._runs.discard)
+        return web.Response(status=204)
+
+    async def _attach(self, request: web.Request) -> web.StreamResponse:
+        await self._call("attach")
+        container = self._container(request)
+        response = web.StreamResponse(status=101, reason="UPGRADED", headers={
+            "Content-Type": "application/vnd.docker.raw-stream",
+            "Connection": "Upgrade",
+            "Upgrade": "tcp",
+        })
+        await response.prepare(request)
+
+        # The connection is hijacked, frames are written to the socket as is
+        transport = request.transport
+        stdout = memoryview(self.config.stdout)
+        for offset in range(0, len(stdout), self.config.frame_size):
+            payload = stdout[offset:offset + self.config.frame_size]
+            transport.write(_HEADER.pack(1, len(payload)))
+            transport.write(payload)
+
+        await container.finished.wait()
+        transport.close()
+        return response
+
+    async def _wait(self, request: web.Request) -> web.Response:
+        await self._call("wait")
+        container = self._container(request)
+        await container.finished.wait()
+        return web.json_response({"StatusCode": container.exit_code, "Error": None})
+
+    async def _kill(self, request: web.Request) -> web.Response:
+        await self._call("kill")
+        self._finish(self._container(request), 137)
+        return web.Response(status=204)
+
+    async def _update(self, request: web.Request) -> web.Response:
+        await self._call("update")
+        self._container(request)
+        return web.json_response({"Warnings": []})
+
+    async def _put_archive(self, request: web.Request) -> web.Response:
+        await self._call("put_archive")
+        self._container(request)
+        async for _ in request.content.iter_any():
+            pass
+        return web.Response(status=200)
+
+    async def _delete(self, request: web.Request) -> web.Response:
+        await self._call("delete")
+        container = self._container(request)
+        self._finish(container, 137)
+        del self.containers[container.id]
+        return web.Response(status=204)
+
+    async def _create_volume(self, request: web.Request) -> web.Response:
+        await self._call("volume_create")
+        config = await request.json()
+        name = config.get("Name") or uuid.uuid4().hex
+        self.volumes.add(name)
+        return web.json_response({"Name": name, "Driver": config.get("Driver", "local")}, status=201)
+
+    async def _delete_volume(self, request: web.Request) -> web.Response:
+        await self._call("volume_delete")
+        name = request.match_info["name"]
+        if name not in self.volumes:
+            raise web.HTTPNotFound(
+                text=f'{{"message": "No such volume: {name}"}}',
+                content_type="application/json",
+            )
+        if any(name in self._volumes_of(container) for container in self.containers.values()):
+            raise web.HTTPConflict(
+                text=f'{{"message": "remove {name}: volume is in use"}}',
+                content_type="application/json",
+            )
+        self.volumes.remove(name)
+        return web.Response(status=204)
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import math
+import platform
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from importlib import metadata
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Sequence
+
+__all__ = [
+    "BenchmarkResult",
+    "measure",
+    "percentile",
+    "save_results",
+]
+
+
+@dataclass(frozen=True)
+class BenchmarkResult:
+    name: str
+    concurrency: int
+    operations: int
+    # Seconds
+    duration: float
+    # Operations per second
+    throughput: float
+    # Latencies of an operation in seconds
+    p50: float
+    p99: float
+    params: dict[str, Any] = field(default_factory=dict)
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile, ``q`` is in [0, 100]"""
+    assert values, "No values"
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+async def measure(
+    name: str,
+    operation: Callable[[], Awaitable[Any]],
+    operations: int,
+    concurrency: int,
+    params: dict[str, Any] | None = None,
+) -> BenchmarkResult:
+    """
+    Runs the operation the given number of times by ``concurrency``
+    workers and measures the latency of every run.
+    """
+    latencies: list[float] = []
+    left = operations
+
+    async def worker():
+        nonlocal left
+        while left > 0:
+            left -= 1
+            started = time.perf_counter()
+            await operation()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - started
+
+    return BenchmarkResult(
+        name=name,
+        concurrency=concurrency,
+        operations=operations,
+        duration=duration,
+        throughput=operations / duration,
+        p50=percentile(latencies, 50),
+        p99=percentile(latencies, 99),
+        params=params or {},
+    )
+
+
+def save_results(results: Sequence[BenchmarkResult], path: Path) -> None:
+    """
+    Writes results with the versions of runbox and python, so results
+    of different releases can be compared.
+    """
+    try:
+        version = metadata.version("runbox")
+    except metadata.PackageNotFoundError:
+        version = None
+
+    report = {
+        "runbox": version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "results": [asdict(result) for result in results],
+    }
+    Path(path).write_text(json.dumps(report, indent=2))
@@ -0,0 +1,137 @@
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from runbox import DockerExecutor, SandboxBuilder
+from runbox.build_stages import CompileAndRunPipeline
+from runbox.build_stages.stages import SandboxMount, UseSandbox, UseVolume
+from runbox.models import DockerProfile, File
+from runbox.shortucts import execute
+from runbox.testing import BaseTestSuite, IOTestCase
+from .fake_docker import FakeDockerConfig
+from .runner import BenchmarkResult, measure
+
+__all__ = [
+    "SCENARIOS",
+    "Scenario",
+]
+
+PROFILE = DockerProfile(
+    image="runbox-benchmark",
+    workdir=Path("/sandbox"),
+    cmd_template=["python", ...],
+)
+
+FILES = [File(name="main.py", content="print('Hello, world!')")]
+
+# Number of tests in a suite run by the test suite benchmark
+SUITE_SIZE = 10
+
+Scenario = Callable[[DockerExecutor, FakeDockerConfig, int, int], Awaitable[BenchmarkResult]]
+
+
+def _params(config: FakeDockerConfig, **extra) -> dict:
+    return {
+        "latency": config.latency,
+        "run_time": config.run_time,
+        "output_size": len(config.stdout),
+        **extra,
+    }
+
+
+async def executor_run(
+    executor: DockerExecutor,
+    config: FakeDockerConfig,
+    concurrency: int,
+    operations: int,
+) -> BenchmarkResult:
+    """Create, run, read the output, wait and delete a sandbox"""
+
+    async def operation():
+        sandbox = await executor.create_container(PROFILE, FILES)
+        async with sandbox:
+            output = await sandbox.run()
+            while await output.read_out():
+                pass
+            await sandbox.wait()
+            await sandbox.state()
+
+    return await measure("executor_run", operation, operations, concurrency, _params(config))
+
+
+async def test_suite(
+    executor: DockerExecutor,
+    config: FakeDockerConfig,
+    concurrency: int,
+    operations: int,
+) -> BenchmarkResult:
+    """Run a suite of tests comparing the output, a sandbox per worker"""
+    builder = SandboxBuilder().with_profile(PROFILE).add_files(*FILES)
+
+    async def operation():
+        suite = BaseTestSuite(builder)
+        suite.add_tests(*(
+            IOTestCase(stdin=b"", expected_stout=config.stdout)
+            for _ in range(SUITE_SIZE)
+        ))
+        await suite.exec(executor)
+
+    return await measure(
+        "test_suite", operation, operations, concurrency,
+        _params(config, suite_size=SUITE_SIZE),
+    )
+
+
+async def pipeline(
+    executor: DockerExecutor,
+    config: FakeDockerConfig,
+    concurrency: int,
+    operations: int,
+) -> BenchmarkResult:
+    """Build into a volume and run from it with CompileAndRunPipeline"""
+    mounts = [SandboxMount(key="build", bind=Path("/sandbox"))]
+
+    async def operation():
+        compile_and_run = CompileAndRunPipeline() \
+            .add_stages(
+                "build",
+                UseVolume(UseVolume.Params(key="build")),
+                UseSandbox(UseSandbox.Params(
+                    key="compile", profile=PROFILE, files=FILES,
+                    mounts=mounts, attach=False, depends_on=["build"],
+                )),
+            ) \
+            .add_stages(
+                "run",
+                UseSandbox(UseSandbox.Params(key="run", profile=PROFILE, mounts=mounts, attach=False)),
+            ) \
+            .with_executor(executor)
+        try:
+            await compile_and_run.build()
+            await compile_and_run.run()
+        finally:
+            await compile_and_run.finalize()
+
+    return await measure("pipeline", operation, operations, concurrency, _params(config))
+
+
+async def shortcut_execute(
+    executor: DockerExecutor,
+    config: FakeDockerConfig,
+    concurrency: int,
+    operations: int,
+) -> BenchmarkResult:
+    """Run a program with :func:`runbox.shortucts.execute`"""
+
+    async def operation():
+        async for _ in execute(PROFILE, FILES, executor):
+            pass
+
+    return await measure("shortcut_execute", operation, operations, concurrency, _params(config))
+
+
+SCENARIOS: dict[str, Scenario] = {
+    "executor_run": executor_run,
+    "test_suite": test_suite,
+    "pipeline": pipeline,
+    "shortcut_execute": shortcut_execute,
+}
@@ -1,4 +1,5 @@
 from runbox.build_stages import exceptions
+from runbox.build_stages.build_cache import *
 from runbox.build_stages.pipeline import *
 from runbox.build_stages.pipeline_loaders import *
 from runbox.build_stages.stages import *
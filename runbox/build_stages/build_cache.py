@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from dataclasses import dataclass
+from pathlib import Path, PosixPath
+from typing import Any, AsyncIterator, Mapping, Sequence
+
+from aiodocker.volumes import DockerVolume
+
+from runbox import DockerExecutor, SandboxBuilder
+from runbox.docker.utils import CHUNK_SIZE, canonical
+from runbox.models import DockerProfile
+from .stages import BuildStage
+
+__all__ = ['BuildCache', 'BuildCacheStats', 'build_cache_key']
+
+
+def build_cache_key(stages: Sequence[BuildStage], state: Mapping[str, Any] | None = None) -> str:
+    """
+    Hash of the stages and their parameters: profiles (including command
+    templates), limits, mounts and contents of the input files.
+
+    :param state: values of the shared state the stages read, e.g. files
+        of ``WriteFiles.Params.file_keys``. Their contents are hashed too.
+    :raises TypeError: if the state has values, that can't be hashed
+        by content, e.g. volumes.
+    """
+    digest = hashlib.sha256()
+    for stage in stages:
+        params = getattr(stage, 'params', None)
+        digest.update(type(stage).__qualname__.encode('utf-8'))
+        digest.update(json.dumps(canonical(params), sort_keys=True).encode('utf-8'))
+    digest.update(json.dumps(canonical(state or {}), sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class BuildCacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+
+
+class BuildCache:
+    """
+    On-disk store of build artifacts. Contents of every volume created by
+    a build are kept as a tar archive per volume in the ``root/<key>``
+    directory. Least recently used entries are evicted when the total size
+    goes over ``max_bytes``.
+
+    Storing is best-effort: if artifacts can't be saved, the build
+    is not failed, it's just not cached. Archives are read, written and
+    evicted in worker threads, so the event loop isn't blocked by the disk.
+
+    :param root: directory of the store.
+    :param helper_profile: profile of a container used to read and write
+        volumes. Container is never started, so any image is suitable,
+        but it must be present on the host, e.g. pulled with
+        ``DockerExecutor.prepull``.
+    :param max_bytes: size budget of the store.
+    """
+
+    _mount_point = PosixPath('/artifacts')
+
+    def __init__(
+        self,
+        root: Path,
+        helper_profile: DockerProfile,
+        max_bytes: int = 1024 ** 3,
+    ):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.helper_profile = helper_profile
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def stats(self) -> BuildCacheStats:
+        return BuildCacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=sum(size for _, _, size in self._entries()),
+        )
+
+    def lookup(self, key: str) -> bool:
+        """Checks if artifacts of the build are stored and counts a hit or a miss"""
+        found = (self.root / key).is_dir()
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    async def store(
+        self,
+        key: str,
+        volumes: Mapping[str, DockerVolume],
+        executor: DockerExecutor,
+    ) -> bool:
+        """
+        Saves contents of the volumes as artifacts of the build.
+
+        :return: whether the artifacts are stored.
+        """
+        staging = self.root / f'.{key}.{uuid.uuid4().hex}'
+        try:
+            await asyncio.to_thread(staging.mkdir)
+            for volume_key, volume in volumes.items():
+                archive = staging / f'{volume_key}.tar'
+                sandbox = await self._helper(volume).create(executor)
+                async with sandbox:
+                    await _write_archive(archive, sandbox.read_archive(self._mount_point))
+            # Entry appears in the store only when all archives are written
+            await asyncio.to_thread(os.rename, staging, self.root / key)
+        except Exception:
+            # Another build with the same key may have been stored first
+            if not (self.root / key).is_dir():
+                return False
+        finally:
+            await asyncio.to_thread(shutil.rmtree, staging, ignore_errors=True)
+
+        await asyncio.to_thread(self.evict)
+        return True
+
+    async def restore(
+        self,
+        key: str,
+        volumes: Mapping[str, DockerVolume],
+        executor: DockerExecutor,
+    ) -> None:
+        """Puts the stored artifacts into the volumes"""
+        entry = self.root / key
+        await asyncio.to_thread(os.utime, entry)
+        for volume_key, volume in volumes.items():
+            archive = entry / f'{volume_key}.tar'
+            sandbox = await self._helper(volume).create(executor)
+            async with sandbox:
+                await sandbox.write_archive('/', _read_archive(archive))
+
+    def evict(self) -> None:
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def _entries(self) -> list[tuple[Path, float, int]]:
+        entries = []
+        for path in self.root.iterdir():
+            if path.name.startswith('.') or not path.is_dir():
+                continue
+            size = sum(file.stat().st_size for file in path.iterdir())
+            entries.append((path, path.stat().st_mtime, size))
+        return entries
+
+    def _helper(self, volume: DockerVolume) -> SandboxBuilder:
+        return SandboxBuilder() \
+            .with_profile(self.helper_profile) \
+            .mount(volume, self._mount_point)
+
+
+async def _read_archive(path: Path) -> AsyncIterator[bytes]:
+    file = await asyncio.to_thread(path.open, 'rb')
+    try:
+        while chunk := await asyncio.to_thread(file.read, CHUNK_SIZE):
+            yield chunk
+    finally:
+        await asyncio.to_thread(file.close)
+
+
+async def _write_archive(path: Path, chunks: AsyncIterator[bytes]) -> None:
+    # Chunks of the docker stream are small, they are written in batches
+    file = await asyncio.to_thread(path.open, 'wb')
+    try:
+        buffer = bytearray()
+        async for chunk in chunks:
+            buffer += chunk
+            if len(buffer) >= CHUNK_SIZE:
+                await asyncio.to_thread(file.write, buffer)
+                buffer = bytearray()
+        await asyncio.to_thread(file.write, buffer)
+    finally:
+        await asyncio.to_thread(file.close)
@@ -63,3 +63,27 @@ class MemoryLimitError(UseSandboxError):
     ):
         message = f"Sandbox has been killed due to memory limit >{limits.memory_mb}MB"
         super().__init__(message, key, params, stage)
+
+
+class OutputLimitError(UseSandboxError):
+
+    def __init__(
+        self, limits: Limits,
+        key: str,
+        params: ParamsType,
+        stage: "BuildStage",
+    ):
+        message = f"Sandbox has been killed due to output limit >{limits.output_bytes} bytes"
+        super().__init__(message, key, params, stage)
+
+
+class DiskLimitError(UseSandboxError):
+
+    def __init__(
+        self, limits: Limits,
+        key: str,
+        params: ParamsType,
+        stage: "BuildStage",
+    ):
+        message = f"Sandbox has been killed due to disk limit >{limits.disk_space_mb}MB"
+        super().__init__(message, key, params, stage)
@@ -5,13 +5,16 @@ from dataclasses import dataclass, field
 from typing import Protocol, Mapping, Any, Sequence
 
 from runbox import DockerExecutor
+from runbox.build_stages.build_cache import BuildCache, build_cache_key
 from runbox.build_stages.exceptions import StageError
 from runbox.build_stages.stages import (
     Observer, SharedState,
-    BuildStage, BuildState
+    BuildStage, BuildState,
+    UseVolume,
 )
+from runbox.instrumentation import NOOP_INSTRUMENTATION
 
-__all__ = ['Pipeline', 'BasePipeline', 'CompileAndRunPipeline']
+__all__ = ['Pipeline', 'BasePipeline', 'CompileAndRunPipeline', 'crossing_keys', 'stage_dependencies']
 
 
 class GroupStatus(str, enum.Enum):
@@ -32,6 +35,93 @@ class GroupWithStages(Group):
     stages: list[BuildStage]
 
 
+def stage_writes(stage: BuildStage) -> str | None:
+    return getattr(getattr(stage, 'params', None), 'key', None)
+
+
+def stage_reads(stage: BuildStage) -> set[str]:
+    """Keys of the shared state the stage depends on: explicit
+    ``depends_on`` and the keys it reads (mounts, volume and file keys)"""
+    params = getattr(stage, 'params', None)
+    reads = set(getattr(params, 'depends_on', []))
+    reads.update(mount.key for mount in getattr(params, 'mounts', []))
+    reads.update(getattr(params, 'file_keys', []))
+    if (volume := getattr(params, 'volume', None)) is not None:
+        reads.add(volume)
+    return reads
+
+
+def stage_modifies(stage: BuildStage) -> set[str]:
+    """Keys of the shared state, whose data the stage changes:
+    writable mounts and the volume files are written to"""
+    params = getattr(stage, 'params', None)
+    modifies = {mount.key for mount in getattr(params, 'mounts', []) if not mount.readonly}
+    if (volume := getattr(params, 'volume', None)) is not None:
+        modifies.add(volume)
+    return modifies
+
+
+def crossing_keys(stages: Sequence[BuildStage]) -> set[str]:
+    """
+    Keys of the shared state, whose data crosses containers: keys read by
+    more than one stage, or by a stage, that writes files before its
+    container starts. Data of a tmpfs volume is lost in between, so such
+    volumes are kept on the disk.
+    """
+    readers: dict[str, int] = {}
+    for stage in stages:
+        params = getattr(stage, 'params', None)
+        writes_files = bool(getattr(params, 'files', None) or getattr(params, 'file_keys', None))
+        for key in stage_reads(stage):
+            readers[key] = readers.get(key, 0) + (2 if writes_files else 1)
+    return {key for key, count in readers.items() if count > 1}
+
+
+def stage_dependencies(stages: Sequence[BuildStage]) -> list[set[int]]:
+    """
+    Returns indices of the stages every stage depends on.
+    Keys that are not written by any of the stages are expected
+    to be in the shared state already. Stages, that change data of
+    a key, e.g. mount a volume writable, and other stages using the key
+    are set up in the order they were declared.
+
+    :raises ValueError: if dependencies are cyclic.
+    """
+    writers: dict[str, set[int]] = {}
+    for idx, stage in enumerate(stages):
+        if (key := stage_writes(stage)) is not None:
+            writers.setdefault(key, set()).add(idx)
+
+    dependencies = [
+        set().union(*(writers.get(key, set()) for key in stage_reads(stage))) - {idx}
+        for idx, stage in enumerate(stages)
+    ]
+
+    # Changes of a key are ordered with every other use of the key
+    modifiers: dict[str, list[int]] = {}
+    users: dict[str, list[int]] = {}
+    for idx, stage in enumerate(stages):
+        modifies = stage_modifies(stage)
+        for key in stage_reads(stage) - {stage_writes(stage)}:
+            dependencies[idx].update(modifiers.get(key, []))
+            if key in modifies:
+                dependencies[idx].update(users.get(key, []))
+                modifiers.setdefault(key, []).append(idx)
+            users.setdefault(key, []).append(idx)
+
+    resolved: set[int] = set()
+    while len(resolved) < len(stages):
+        ready = {
+            idx for idx, deps in enumerate(dependencies)
+            if idx not in resolved and deps <= resolved
+        }
+        if not ready:
+            raise ValueError("Stages have cyclic dependencies")
+        resolved |= ready
+
+    return dependencies
+
+
 class Pipeline(Protocol):
 
     @property
@@ -65,13 +155,26 @@ class Pipeline(Protocol):
 
 
 class BasePipeline:
+    """
+    Stages of a group are set up as soon as all stages they depend on are
+    set up. Dependencies are declared with ``depends_on`` or inferred from
+    the shared state keys the stages read and write.
 
-    def __init__(self):
+    :param max_concurrency: maximum number of stages set up at the same time.
+        With 1 stages are set up one by one in the order they were added.
+    """
+
+    def __init__(self, max_concurrency: int = 1):
+        assert max_concurrency > 0, "Concurrency must be positive"
         self._groups: dict[str, GroupWithStages] = {}
         self._executor: DockerExecutor | None = None
         self._observer: Observer | None = None
         self._state: SharedState | None = {}
         self._meta: dict[str, Any] = {}
+        self._max_concurrency = max_concurrency
+        # Stages in the order their setup has finished, it's
+        # a topological order, so stages are disposed in reverse
+        self._setup_order: list[BuildStage] = []
 
     @property
     def build_state(self) -> BuildState:
@@ -117,23 +220,70 @@ class BasePipeline:
         group_data = self._groups[group]
         assert group_data.status == GroupStatus.pending
 
-        for stage in group_data.stages:
-            try:
-                await stage.setup(self.build_state)
-            except Exception as e:
-                group_data.status = GroupStatus.failed
-                await stage.dispose()
-                raise e
+        self._use_disk_volumes(group_data.stages)
+        await self._setup_stages(group_data, group_data.stages)
+
+    def _use_disk_volumes(self, stages: Sequence[BuildStage]) -> None:
+        """Keeps volumes of the stages on the disk, if their data crosses
+        containers of any group"""
+        crossing = crossing_keys([stage for group in self._groups.values() for stage in group.stages])
+        for stage in stages:
+            if isinstance(stage, UseVolume) and stage.params.key in crossing:
+                stage.tmpfs = False
+
+    async def _setup_stages(self, group_data: GroupWithStages, stages: Sequence[BuildStage]) -> None:
+        dependencies = stage_dependencies(stages)
+        pending = list(range(len(stages)))
+        done: set[int] = set()
+        running: dict[asyncio.Task, int] = {}
+        first_exception: Exception | None = None
+
+        while pending or running:
+            ready = [idx for idx in pending if dependencies[idx] <= done]
+            while first_exception is None and ready and len(running) < self._max_concurrency:
+                idx = ready.pop(0)
+                pending.remove(idx)
+                running[asyncio.create_task(self._setup_stage(group_data, stages[idx]))] = idx
+
+            if not running:
+                break
+
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                idx = running.pop(task)
+                if (e := task.exception()) is not None:
+                    await stages[idx].dispose()
+                    first_exception = first_exception or e
+                else:
+                    done.add(idx)
+                    self._setup_order.append(stages[idx])
+
+        if first_exception is not None:
+            group_data.status = GroupStatus.failed
+            raise first_exception
+
+        group_data.status = GroupStatus.done
+
+    async def _setup_stage(self, group_data: GroupWithStages, stage: BuildStage) -> None:
+        instrumentation = getattr(self._executor, "instrumentation", NOOP_INSTRUMENTATION)
+        tags = {"group": group_data.name, "stage": stage_writes(stage)}
+        with instrumentation.span("stage", tags):
+            await stage.setup(self.build_state)
 
     async def finalize(self) -> None:
         first_exception: Exception | None = None
-        for group in self._groups.values():
-            for stage in group.stages:
-                if stage.is_setup and not stage.is_disposed:
-                    try:
-                        await stage.dispose()
-                    except Exception as e:
-                        first_exception = e
+        setup_order = self._setup_order[::-1] + [
+            stage
+            for group in self._groups.values()
+            for stage in group.stages
+            if stage not in self._setup_order
+        ]
+        for stage in setup_order:
+            if stage.is_setup and not stage.is_disposed:
+                try:
+                    await stage.dispose()
+                except Exception as e:
+                    first_exception = e
 
         if first_exception is not None:
             raise first_exception
@@ -144,18 +294,62 @@ class BasePipeline:
 
 
 class CompileAndRunPipeline(BasePipeline):
+    """
+    :param build_cache: if given, contents of the volumes created by the
+        build group are stored after a successful build. Next build with
+        the same stages only creates the volumes and restores
+        the artifacts into them.
+    """
 
     def __init__(
         self,
         build_group: str = "build",
         run_group: str = "run",
+        build_cache: BuildCache | None = None,
+        max_concurrency: int = 1,
     ):
-        super().__init__()
+        super().__init__(max_concurrency)
         self._build_group = build_group
         self._run_group = run_group
+        self._build_cache = build_cache
 
     async def build(self) -> None:
-        await self.execute_group(self._build_group)
+        if self._build_cache is None:
+            await self.execute_group(self._build_group)
+            return
+
+        group_data = self._groups[self._build_group]
+        try:
+            key = build_cache_key(group_data.stages, self._read_state(group_data.stages))
+        except TypeError:
+            # Inputs can't be hashed, so the build can't be cached
+            await self.execute_group(self._build_group)
+            return
+
+        volume_stages = [stage for stage in group_data.stages if isinstance(stage, UseVolume)]
+
+        # Cached artifacts are read and restored by containers of their own
+        for stage in volume_stages:
+            stage.tmpfs = False
+
+        if self._build_cache.lookup(key):
+            assert group_data.status == GroupStatus.pending
+            await self._setup_stages(group_data, volume_stages)
+            await self._build_cache.restore(key, self._volumes(volume_stages), self.build_state.executor)
+        else:
+            await self.execute_group(self._build_group)
+            await self._build_cache.store(key, self._volumes(volume_stages), self.build_state.executor)
+
+    def _read_state(self, stages: Sequence[BuildStage]) -> dict[str, Any]:
+        """Values of the shared state the stages read, but don't write"""
+        written = {stage_writes(stage) for stage in stages}
+        reads = set().union(*(stage_reads(stage) for stage in stages)) - written
+        shared = self.build_state.shared
+        return {key: shared[key] for key in reads if key in shared}
+
+    def _volumes(self, stages: Sequence[UseVolume]) -> dict[str, Any]:
+        shared = self.build_state.shared
+        return {stage.params.key: shared[stage.params.key] for stage in stages}
 
     async def run(self) -> None:
         await self.execute_group(self._run_group)
@@ -16,8 +16,12 @@ from typing import (
 from pydantic import BaseModel, root_validator
 
 from runbox import DockerExecutor, SandboxBuilder, DockerSandbox
+from runbox.docker.demux import OutputDecoder, view_reader
 from runbox.models import File, Limits, DockerProfile
-from .exceptions import NonZeroExitCodeError, MemoryLimitError, CpuLimitError, UseSandboxError
+from .exceptions import (
+    NonZeroExitCodeError, MemoryLimitError, CpuLimitError,
+    OutputLimitError, DiskLimitError, UseSandboxError,
+)
 
 __all__ = [
     "Observer",
@@ -96,6 +100,7 @@ class WriteFiles:
         key: str
         file_keys: list[str]
         volume: str
+        depends_on: list[str] = []
         profile: DockerProfile = DockerProfile(
             image="alpine:latest",
             workdir=Path("/tmp"),
@@ -146,13 +151,24 @@ class WriteFiles:
 
 
 class UseVolume:
+    """
+    Creates a volume shared by the stages. With ``tmpfs`` the volume is
+    a scratch space in memory of ``limits.disk_space_mb`` size. Pipelines
+    fall back to a volume on the disk, when its data must cross containers.
+    """
+
     class Params(BaseModel):
         key: str
+        depends_on: list[str] = []
+        tmpfs: bool = False
+        limits: Limits = Limits()
 
     def __init__(self, params: Params):
         self._is_setup = False
         self._is_disposed = False
         self.params = params
+        # Cleared by a pipeline, if the volume can't be a tmpfs
+        self.tmpfs = params.tmpfs
         self._volume_ctx: AsyncContextManager | None = None
         self._state: BuildState | None = None
 
@@ -167,7 +183,8 @@ class UseVolume:
     async def setup(self, state: BuildState) -> None:
         self._is_setup = True
         self._state = state
-        self._volume_ctx = state.executor.workdir()
+        tmpfs_mb = self.params.limits.disk_space_mb if self.tmpfs else None
+        self._volume_ctx = state.executor.workdir(tmpfs_mb=tmpfs_mb)
         self._state.shared[self.params.key] = await self._volume_ctx.__aenter__()
 
     async def dispose(self) -> None:
@@ -209,6 +226,7 @@ class UseSandbox:
         files: list[LoadableFile] = []
         mounts: list[SandboxMount] = []
         attach: bool = True
+        depends_on: list[str] = []
 
     def __init__(self, params: Params):
         self.params = params
@@ -256,11 +274,15 @@ class UseSandbox:
             raise UseSandboxError("Can't attach if no observer was given",
                                   self.params.key, self.params, self)
 
-        while message := await sandbox.stream.read_out():
-            data = message.data.decode("utf-8")
-            await self._state.observer.write_output(
-                self.params.key, data, message.stream
-            )
+        decoder = OutputDecoder()
+        read = view_reader(sandbox.stream)
+        while message := await read():
+            if data := decoder.decode(message.stream, message.data):
+                await self._state.observer.write_output(
+                    self.params.key, data, message.stream
+                )
+        for stream, data in decoder.flush():
+            await self._state.observer.write_output(self.params.key, data, stream)
 
     async def setup(self, state: BuildState) -> None:
         self._is_setup = True
@@ -303,6 +325,12 @@ class UseSandbox:
         if result.cpu_limit:
             raise CpuLimitError(self.params.limits, self.params.key, self.params, self)
 
+        if result.output_limit:
+            raise OutputLimitError(self.params.limits, self.params.key, self.params, self)
+
+        if result.disk_limit:
+            raise DiskLimitError(self.params.limits, self.params.key, self.params, self)
+
         if result.exit_code != 0:
             raise NonZeroExitCodeError(result.exit_code, self.params.key, self.params, self)
 
@@ -1 +1,10 @@
 from .docker_api import DockerExecutor
+from .container_pool import ContainerPool
+from .scheduler import AdmissionScheduler
+from .cpu_allocator import CpuAllocator
+from .usage import CgroupUsageReader, StatsUsageReader
+from .connections import ConnectionPoolConfig
+from .reaper import Reaper
+from .images import ImageCache
+from .exceptions import ImageNotFoundError
+from .volume_pool import VolumePool
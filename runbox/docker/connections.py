@@ -0,0 +1,87 @@
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+import aiohttp
+from aiodocker import Docker
+
+__all__ = [
+    "ConnectionPoolConfig",
+    "ConnectionPoolStats",
+    "create_docker_client",
+    "connection_stats",
+]
+
+_TCP_SCHEMES = re.compile(r"^(tcp|https?)://")
+
+_SOCKETS = [Path("/run/docker.sock"), Path("/var/run/docker.sock")]
+
+
+@dataclass(frozen=True)
+class ConnectionPoolConfig:
+    """
+    :param limit: maximum number of open connections, 0 means no limit.
+        Requests wait for a free connection when the pool is full.
+    :param keepalive_timeout: how many seconds an idle connection
+        is kept open to be reused.
+    """
+    limit: int = 100
+    keepalive_timeout: float = 15.0
+
+
+@dataclass(frozen=True)
+class ConnectionPoolStats:
+    limit: int
+    acquired: int
+    idle: int
+    waiting: int
+
+    @property
+    def saturation(self) -> float:
+        """Part of the limit taken by acquired connections"""
+        return self.acquired / self.limit if self.limit else 0.0
+
+
+def _docker_host(url: str | None) -> str:
+    if url := url or os.environ.get("DOCKER_HOST"):
+        return url
+    for path in _SOCKETS:
+        if path.is_socket():
+            return f"unix://{path}"
+    raise ValueError("Docker host is not given and no local docker socket is found")
+
+
+def create_docker_client(url: str | None, config: ConnectionPoolConfig) -> Docker:
+    """
+    Creates a docker client with its own connection pool. The host
+    is found the same way aiodocker does it, TLS is taken from
+    the ``DOCKER_TLS_VERIFY`` and ``DOCKER_CERT_PATH`` variables.
+    """
+    host = _docker_host(url)
+    options = dict(limit=config.limit, keepalive_timeout=config.keepalive_timeout)
+
+    if host.startswith("unix://"):
+        connector = aiohttp.UnixConnector(host.removeprefix("unix://"), **options)
+        # Dummy hostname for URL composition, as aiodocker does it
+        host = "unix://localhost"
+    elif _TCP_SCHEMES.match(host):
+        ssl_context = None
+        if os.environ.get("DOCKER_TLS_VERIFY", "0") == "1":
+            ssl_context = Docker._docker_machine_ssl_context()
+            host = _TCP_SCHEMES.sub("https://", host)
+        connector = aiohttp.TCPConnector(ssl=ssl_context, **options)
+    else:
+        raise ValueError(f"Unsupported docker host: {host}")
+
+    return Docker(host, connector=connector)
+
+
+def connection_stats(client: Docker) -> ConnectionPoolStats:
+    connector = client.connector
+    return ConnectionPoolStats(
+        limit=connector.limit,
+        acquired=len(connector._acquired),
+        idle=sum(len(connections) for connections in connector._conns.values()),
+        waiting=sum(len(waiters) for waiters in connector._waiters.values()),
+    )
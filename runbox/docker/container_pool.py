@@ -0,0 +1,188 @@
+import asyncio
+import json
+import time
+from collections import deque
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any, Callable
+
+from aiodocker import Docker
+from aiodocker.containers import DockerContainer
+from aiodocker.exceptions import DockerError
+
+__all__ = [
+    "ContainerPool",
+    "PoolStats",
+]
+
+
+@dataclass(frozen=True)
+class PoolStats:
+    hits: int
+    misses: int
+    idle: int
+
+
+@dataclass
+class _PooledContainer:
+    name: str
+    container: DockerContainer
+    created_at: float
+
+
+class ContainerPool:
+    """
+    Keeps pre-created, not yet started containers for the registered
+    container configurations. The pool is refilled by a background task,
+    so ``DockerExecutor.create_container`` can skip the create round-trip.
+
+    Containers with mounts are never pooled, because mounts can't be
+    changed after a container is created.
+
+    :param size: number of idle containers kept for every configuration.
+    :param max_idle: upper bound for idle containers of all configurations.
+    :param max_age: idle containers older than this are deleted.
+    :param refill_interval: how often (in seconds) the pool is checked
+        for expired containers and refilled.
+    :param timeout: timeout of a single create call.
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        max_idle: int = 32,
+        max_age: timedelta = timedelta(minutes=5),
+        refill_interval: float = 1.0,
+        timeout: int = 5,
+    ) -> None:
+        self.size = size
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.refill_interval = refill_interval
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._docker: Docker | None = None
+        self._name_factory: Callable[[], str] | None = None
+        self._configs: dict[str, dict[str, Any]] = {}
+        self._idle: dict[str, deque[_PooledContainer]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._deleting: set[asyncio.Task] = set()
+
+    @property
+    def stats(self) -> PoolStats:
+        return PoolStats(hits=self.hits, misses=self.misses, idle=self.idle)
+
+    @property
+    def idle(self) -> int:
+        return sum(len(queue) for queue in self._idle.values())
+
+    @staticmethod
+    def key(config: dict[str, Any]) -> str:
+        return json.dumps(config, sort_keys=True)
+
+    def bind(self, docker: Docker, name_factory: Callable[[], str]) -> None:
+        self._docker = docker
+        self._name_factory = name_factory
+
+    def register(self, config: dict[str, Any]) -> None:
+        """Starts keeping containers with the given config warm"""
+        key = self.key(config)
+        if key not in self._configs:
+            self._configs[key] = config
+            self._idle[key] = deque()
+        self._wake()
+
+    def take(self, config: dict[str, Any]) -> tuple[str, DockerContainer] | None:
+        """
+        Pops an idle container created with the given config.
+        Returns None if config is not registered or there are no
+        fresh containers left.
+        """
+        queue = self._idle.get(self.key(config))
+        if queue is None:
+            return None
+
+        deadline = time.monotonic() - self.max_age.total_seconds()
+        while queue:
+            item = queue.popleft()
+            if item.created_at >= deadline:
+                self.hits += 1
+                self._wake()
+                return item.name, item.container
+            self._discard(item)
+
+        self.misses += 1
+        self._wake()
+        return None
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+        idle = [item for queue in self._idle.values() for item in queue]
+        for queue in self._idle.values():
+            queue.clear()
+        await asyncio.gather(
+            *(self._delete(item) for item in idle),
+            *self._deleting,
+        )
+
+    def _wake(self) -> None:
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._maintain())
+
+    async def _maintain(self) -> None:
+        while True:
+            self._wakeup.clear()
+            self._evict_expired()
+            await self._refill()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.refill_interval)
+
+    def _evict_expired(self) -> None:
+        deadline = time.monotonic() - self.max_age.total_seconds()
+        for queue in self._idle.values():
+            while queue and queue[0].created_at < deadline:
+                self._discard(queue.popleft())
+
+    async def _refill(self) -> None:
+        for key, config in list(self._configs.items()):
+            missing = min(
+                self.size - len(self._idle[key]),
+                self.max_idle - self.idle,
+            )
+            if missing <= 0:
+                continue
+
+            created = await asyncio.gather(
+                *(self._create(config) for _ in range(missing)),
+                return_exceptions=True,
+            )
+            self._idle[key].extend(
+                item for item in created if isinstance(item, _PooledContainer)
+            )
+
+    async def _create(self, config: dict[str, Any]) -> _PooledContainer:
+        assert self._docker is not None and self._name_factory is not None, \
+            "Pool is not bound to an executor"
+        name = self._name_factory()
+        task = self._docker.containers.create(config, name=name)
+        container = await asyncio.wait_for(task, self.timeout)
+        return _PooledContainer(name, container, time.monotonic())
+
+    def _discard(self, item: _PooledContainer) -> None:
+        task = asyncio.get_running_loop().create_task(self._delete(item))
+        self._deleting.add(task)
+        task.add_done_callback(self._deleting.discard)
+
+    @staticmethod
+    async def _delete(item: _PooledContainer) -> None:
+        with suppress(DockerError):
+            await item.container.delete(force=True)
@@ -0,0 +1,102 @@
+import asyncio
+import os
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Sequence
+
+__all__ = [
+    "CpuAllocator",
+    "CpuSet",
+]
+
+
+@dataclass
+class CpuSet:
+    """Cores given to a sandbox exclusively until it is deleted"""
+    cores: tuple[int, ...]
+    _allocator: "CpuAllocator | None" = field(default=None, repr=False)
+
+    @property
+    def cpuset_cpus(self) -> str:
+        """Value of the ``CpusetCpus`` option of a container"""
+        return ",".join(map(str, self.cores))
+
+    def release(self) -> None:
+        """Returns cores to the allocator, can be called many times"""
+        if self._allocator is not None:
+            allocator, self._allocator = self._allocator, None
+            allocator._release(self.cores)
+
+
+@dataclass
+class _Request:
+    count: int
+    future: asyncio.Future
+
+
+class CpuAllocator:
+    """
+    Gives every sandbox its own cores, so sandboxes running at the same
+    time don't share CPUs and measured durations don't depend on the load.
+    Requests wait in FIFO order while there are not enough free cores.
+
+    :param cores: cores available to sandboxes,
+        all cores the process can run on by default.
+    """
+
+    def __init__(self, cores: Sequence[int] | None = None) -> None:
+        if cores is None:
+            cores = sorted(os.sched_getaffinity(0))
+        assert cores, "No cores to allocate"
+        self.cores = tuple(cores)
+        self._free: set[int] = set(self.cores)
+        self._queue: deque[_Request] = deque()
+
+    @property
+    def free(self) -> int:
+        return len(self._free)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    async def acquire(self, count: int) -> CpuSet:
+        """
+        Waits until ``count`` cores are free and takes them.
+
+        :raises ValueError: if there are less than ``count`` cores at all.
+        """
+        if not 0 < count <= len(self.cores):
+            raise ValueError(f"Can't allocate {count} of {len(self.cores)} cores")
+
+        request = _Request(count, asyncio.get_running_loop().create_future())
+        self._queue.append(request)
+        self._allocate()
+
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            if request.future.done() and not request.future.cancelled():
+                request.future.result().release()
+            elif request in self._queue:
+                self._queue.remove(request)
+                self._allocate()
+            raise
+
+    def _allocate(self) -> None:
+        while self._queue:
+            request = self._queue[0]
+            if request.future.done():
+                self._queue.popleft()
+                continue
+            if request.count > len(self._free):
+                break
+
+            self._queue.popleft()
+            cores = tuple(sorted(self._free)[:request.count])
+            self._free.difference_update(cores)
+            request.future.set_result(CpuSet(cores, self))
+
+    def _release(self, cores: tuple[int, ...]) -> None:
+        self._free.update(cores)
+        self._allocate()
@@ -0,0 +1,252 @@
+import codecs
+import struct
+from typing import Awaitable, Callable
+
+import aiodocker
+import aiohttp
+from aiodocker.stream import Message, Stream
+
+__all__ = [
+    "DemuxParser",
+    "DemuxReader",
+    "OutputDecoder",
+    "parser_supported",
+    "view_reader",
+]
+
+_HEADER = struct.Struct(">BxxxL")
+
+# Parser is installed into internals of these versions, that it's tested
+# with. With other versions the stream is read by aiodocker's own parser.
+SUPPORTED_VERSIONS = {
+    aiohttp: ((3, 8), (4, 0)),
+    aiodocker: ((0, 21), (0, 22)),
+}
+
+
+def _version(module) -> tuple[int, ...]:
+    parts = []
+    for part in module.__version__.split(".")[:2]:
+        digits = "".join(char for char in part if char.isdigit())
+        parts.append(int(digits or 0))
+    return tuple(parts)
+
+
+def parser_supported() -> bool:
+    """Checks, that :class:`DemuxParser` can be installed into the streams"""
+    return all(
+        low <= _version(module) < high
+        for module, (low, high) in SUPPORTED_VERSIONS.items()
+    ) and hasattr(aiohttp, "FlowControlDataQueue")
+
+
+def view_reader(reader) -> Callable[[], Awaitable[Message | None]]:
+    """
+    Returns ``read_view`` of the reader, if it has one, or ``read_out``
+    otherwise, for consumers, that accept memoryview data of messages.
+    """
+    return getattr(reader, "read_view", None) or reader.read_out
+
+
+class DemuxParser:
+    """
+    Parser of docker's multiplexed attach stream, that doesn't copy
+    payloads. Every piece of a frame, that arrives in a socket read, is
+    queued as a memoryview slice of the received bytes, so frames split
+    between reads are not reassembled and consumers get pieces of frames.
+    Only a header split between reads is buffered.
+    """
+
+    def __init__(self, queue: aiohttp.DataQueue, tty: bool = False) -> None:
+        self.queue = queue
+        self.tty = tty
+        self._header = bytearray()
+        self._stream = 0
+        self._left = 0
+
+    def set_exception(self, exc: BaseException, *_) -> None:
+        self.queue.set_exception(exc)
+
+    def feed_eof(self) -> None:
+        self.queue.feed_eof()
+
+    def feed_data(self, data: bytes) -> tuple[bool, bytes]:
+        view = memoryview(data)
+        if self.tty:
+            self._feed(1, view)
+            return False, b""
+
+        while view:
+            if self._left == 0:
+                missing = _HEADER.size - len(self._header)
+                if missing > len(view) or self._header:
+                    self._header += view[:missing]
+                    view = view[missing:]
+                    if len(self._header) < _HEADER.size:
+                        break
+                    self._stream, self._left = _HEADER.unpack(self._header)
+                    self._header.clear()
+                else:
+                    self._stream, self._left = _HEADER.unpack_from(view)
+                    view = view[_HEADER.size:]
+                continue
+
+            piece = view[:self._left]
+            view = view[len(piece):]
+            self._left -= len(piece)
+            self._feed(self._stream, piece)
+
+        return False, b""
+
+    def _feed(self, stream: int, piece: memoryview) -> None:
+        self.queue.feed_data(Message(stream, piece), len(piece))
+
+
+class DemuxReader:
+    """
+    Reads an attach stream with :class:`DemuxParser`. Frames split between
+    socket reads come as several messages, so text must be decoded
+    incrementally. :meth:`read_out` returns ``bytes`` like aiodocker does,
+    :meth:`read_view` returns memoryview slices of the received data
+    without copying them. Slices stay valid after next reads,
+    so they may be kept.
+
+    :meth:`readinto` copies output into a caller's buffer instead,
+    for callers, that write output to a file or feed it to a comparator
+    in chunks of a fixed size.
+
+    If the installed aiohttp or aiodocker is not supported
+    (see :func:`parser_supported`), aiodocker's parser is used.
+
+    :param queue: queue fed by an installed :class:`DemuxParser`,
+        if not given, the parser is installed on the first read.
+    """
+
+    # Size of queued output, after which reading from the socket is paused
+    queue_limit = 2 ** 16
+
+    def __init__(self, stream: Stream, queue: aiohttp.DataQueue | None = None) -> None:
+        self.stream = stream
+        self._queue = queue
+        self._piece: Message | None = None
+        self._offset = 0
+        self._closed = False
+
+    @classmethod
+    async def open(cls, stream: Stream) -> "DemuxReader":
+        reader = cls(stream)
+        await reader._install()
+        return reader
+
+    async def _install(self) -> None:
+        await self.stream._init()
+        if not parser_supported():
+            self._queue = self.stream._queue
+            return
+
+        # Nothing is read from the socket until this method returns,
+        # so data parsed by aiodocker's parser is moved to the new queue
+        protocol = self.stream._resp.connection.protocol
+        old_parser = protocol._payload_parser
+        old_queue = self.stream._queue
+
+        queue = aiohttp.FlowControlDataQueue(
+            protocol, limit=self.queue_limit, loop=self.stream._resp._loop,
+        )
+        parser = DemuxParser(queue, tty=getattr(old_parser, "tty", False))
+        for message, size in old_queue._buffer:
+            queue.feed_data(Message(message.stream, memoryview(message.data)), size)
+        old_queue._buffer.clear()
+        protocol.set_parser(parser, queue)
+        if buffered := getattr(old_parser, "_buf", None):
+            parser.feed_data(bytes(buffered))
+        if (exc := old_queue.exception()) is not None:
+            queue.set_exception(exc)
+        elif old_queue.is_eof():
+            queue.feed_eof()
+
+        self.stream._queue = self._queue = queue
+
+    async def read_out(self) -> Message | None:
+        message = await self.read_view()
+        if message is None or isinstance(message.data, bytes):
+            return message
+        return Message(message.stream, bytes(message.data))
+
+    async def read_view(self) -> Message | None:
+        """Same as :meth:`read_out`, but data of messages is not copied"""
+        if self._queue is None:
+            await self._install()
+
+        if self._piece is not None:
+            message = Message(self._piece.stream, memoryview(self._piece.data)[self._offset:])
+            self._piece = None
+            return message
+
+        try:
+            return await self._queue.read()
+        except aiohttp.EofStream:
+            return None
+        except aiohttp.ClientError:
+            # Connection closed by close() is the end of the stream
+            if self._closed:
+                return None
+            raise
+
+    async def readinto(self, buffer: bytearray | memoryview) -> tuple[int, int] | None:
+        """
+        Copies the next output into the buffer. Output of different
+        streams is never mixed in one call.
+
+        :return: stream number and the number of bytes written
+            or None at the end of the stream.
+        """
+        if self._piece is None:
+            message = await self.read_view()
+            if message is None:
+                return None
+            self._piece, self._offset = message, 0
+
+        data = self._piece.data
+        size = min(len(buffer), len(data) - self._offset)
+        memoryview(buffer)[:size] = data[self._offset:self._offset + size]
+        stream = self._piece.stream
+
+        self._offset += size
+        if self._offset == len(data):
+            self._piece = None
+        return stream, size
+
+    async def write_in(self, data: bytes) -> None:
+        await self.stream.write_in(data)
+
+    async def close(self) -> None:
+        self._closed = True
+        await self.stream.close()
+
+
+class OutputDecoder:
+    """
+    Decodes output of every stream incrementally, so characters split
+    between messages are decoded, when their last byte arrives.
+    Invalid bytes are replaced, as output may be cut at any byte
+    by the output limit.
+    """
+
+    def __init__(self, encoding: str = "utf-8") -> None:
+        self._factory = codecs.getincrementaldecoder(encoding)
+        self._decoders: dict[int, codecs.IncrementalDecoder] = {}
+
+    def decode(self, stream: int, data: bytes | memoryview) -> str:
+        decoder = self._decoders.get(stream)
+        if decoder is None:
+            decoder = self._decoders[stream] = self._factory(errors="replace")
+        return decoder.decode(data)
+
+    def flush(self) -> list[tuple[int, str]]:
+        """Decodes incomplete characters left at the end of the streams"""
+        return [
+            (stream, text)
+            for stream, decoder in self._decoders.items()
+            if (text := decoder.decode(b"", final=True))
+        ]
@@ -1,25 +1,76 @@
 import asyncio
+import json
 from pathlib import PosixPath
 import uuid
 from contextlib import asynccontextmanager, suppress
+from functools import partial
 from typing import Callable, Sequence
 
 from aiodocker import Docker
+from aiodocker.containers import DockerContainer
 from aiodocker.exceptions import DockerError
+from aiodocker.volumes import DockerVolume
 
 from runbox.docker.sandbox import DockerSandbox
+from runbox.instrumentation import Instrumentation, NOOP_INSTRUMENTATION
 from runbox.models import File, Limits, DockerProfile
+from .connections import ConnectionPoolConfig, ConnectionPoolStats, connection_stats, create_docker_client
+from .container_pool import ContainerPool
+from .cpu_allocator import CpuAllocator
+from .events import ContainerEvents
+from .exceptions import ImageNotFoundError
+from .images import ImageCache
 from .mount import Mount
-from .utils import write_files
+from .reaper import Reaper
+from .scheduler import AdmissionScheduler
+from .usage import UsageReader
+from .volume_pool import VolumePool
+from .utils import write_files, ulimits, tmpfs_options, TarballCache
 
 __all__ = [
     "DockerExecutor",
 ]
 
+HTTP_NOT_FOUND = 404
+
+# Scratch space of every sandbox
+SCRATCH_DIR = "/tmp"
+
 
 class DockerExecutor:
     """
     DockerExecutor is a sandbox factory.
+
+    :param container_pool: optional pool of pre-created containers.
+        Configurations are added to the pool with :meth:`warm_up`.
+    :param watch_events: subscribe to the docker events stream once and
+        resolve sandbox completion from it instead of a wait and an inspect
+        call per sandbox.
+    :param tarball_cache: cache of archives uploaded to containers, reused
+        when the same files are written many times.
+    :param scheduler: if given, memory and CPUs of every sandbox are
+        reserved from the host budget before its container is created,
+        and released when the sandbox is deleted.
+    :param cpu_allocator: if given, every sandbox is pinned to
+        ``Limits.cpu_count`` cores, that are not shared with
+        other sandboxes until it's deleted.
+    :param usage_reader: if given, sandboxes measure their CPU time and
+        peak memory. It's required for limits with ``time_measure="cpu"``.
+    :param control_pool: connection pool of short control calls
+        (create, start, inspect, delete). Ignored if a client is given.
+    :param streaming_pool: if given, long-lived calls (attach, wait,
+        events) use a client with a connection pool of their own,
+        so they don't make short calls wait for a free connection.
+    :param reaper: if given, sandboxes and workdir volumes are deleted
+        in the background. Pending deletions are awaited by :meth:`close`.
+    :param image_cache: if given, images are checked before containers
+        are created, sandboxes of missing images fail fast with
+        :class:`ImageNotFoundError`. Images are pulled ahead with :meth:`prepull`.
+    :param volume_pool: if given, workdir volumes are taken from the pool
+        and returned to it instead of being created and deleted.
+    :param instrumentation: receives timed spans of docker calls of the
+        executor and its sandboxes, and of pipeline stages run with it.
+        Nothing is recorded by default.
     """
 
     def __init__(
@@ -27,20 +78,76 @@ class DockerExecutor:
         url: str = None,
         name_factory: Callable[[], str] = None,
         docker_client: Docker = None,
+        container_pool: ContainerPool = None,
+        watch_events: bool = False,
+        tarball_cache: TarballCache = None,
+        scheduler: AdmissionScheduler = None,
+        cpu_allocator: CpuAllocator = None,
+        usage_reader: UsageReader = None,
+        control_pool: ConnectionPoolConfig = None,
+        streaming_pool: ConnectionPoolConfig = None,
+        reaper: Reaper = None,
+        instrumentation: Instrumentation = None,
+        image_cache: ImageCache = None,
+        volume_pool: VolumePool = None,
     ) -> None:
 
-        self.docker_client = docker_client or Docker(url)
+        if docker_client is None:
+            docker_client = create_docker_client(url, control_pool) if control_pool else Docker(url)
+        self.docker_client = docker_client
+        self.streaming_client = create_docker_client(url, streaming_pool) \
+            if streaming_pool else self.docker_client
         self.name_factory = name_factory or (lambda: str(uuid.uuid4()))
+        self.container_pool = container_pool
+        if self.container_pool is not None:
+            self.container_pool.bind(self.docker_client, self.name_factory)
+        self.events = ContainerEvents(self.streaming_client) if watch_events else None
+        self.tarball_cache = tarball_cache
+        self.scheduler = scheduler
+        self.cpu_allocator = cpu_allocator
+        self.usage_reader = usage_reader
+        self.reaper = reaper
+        self.instrumentation = instrumentation or NOOP_INSTRUMENTATION
+        self.image_cache = image_cache
+        if self.image_cache is not None:
+            self.image_cache.bind(self.docker_client, self.streaming_client)
+        self.volume_pool = volume_pool
+        if self.volume_pool is not None:
+            self.volume_pool.bind(self.docker_client, self.name_factory, self.reaper, self.instrumentation)
 
-    async def create_container(
+    async def warm_up(
+        self,
+        profile: DockerProfile,
+        limits: Limits = Limits(),
+        files: Sequence[File] | None = None,
+    ) -> None:
+        """
+        Asks the container pool to keep containers for the profile ready.
+        Files are used only to render the command of the profile,
+        they are not written to pooled containers.
+        """
+        assert self.container_pool is not None, "Executor has no container pool"
+        self.container_pool.register(self.container_config(profile, files, None, limits))
+
+    async def prepull(self, *profiles: DockerProfile | str) -> None:
+        """
+        Pulls images of the profiles, that are not present on the host,
+        and pins them in the image cache. It's meant to be called at startup,
+        so requests never wait for a pull.
+        """
+        assert self.image_cache is not None, "Executor has no image cache"
+        await self.image_cache.pull(
+            profile if isinstance(profile, str) else profile.image
+            for profile in profiles
+        )
+
+    def container_config(
         self,
         profile: DockerProfile,
         files: Sequence[File] | None = None,
         mounts: list[Mount] | None = None,
         limits: Limits = Limits(),
-        timeout: int = 5,
-    ) -> DockerSandbox:
-
+    ) -> dict:
         config = {
             "Image": profile.image,
             "Cmd": profile.cmd(files or []),
@@ -55,26 +162,135 @@ class DockerExecutor:
             "OomKillDisable": False,
             "HostConfig": {
                 "Mounts": [mount.dump() for mount in mounts or []] or None,
+                "Memory": limits.memory_bytes,
+                # Swap is disabled, so the memory limit is not bypassed
+                "MemorySwap": limits.memory_bytes,
+                "NanoCpus": limits.cpu_count * 10 ** 9,
+                "PidsLimit": limits.pids,
+                "Ulimits": ulimits(limits),
+                "Tmpfs": {},
             },
         }
+        mounted = {mount.bind.as_posix() for mount in mounts or []}
+        targets = mounted | ({profile.workdir.as_posix()} if profile.workdir else set())
+        if not any(_is_within(target, SCRATCH_DIR) for target in targets):
+            # The root filesystem of a container can't be size-capped
+            # on every storage driver, so writable scratch space is
+            # a tmpfs of the disk limit size. It's skipped, if files or
+            # a volume go to /tmp, as the tmpfs would hide them.
+            config["HostConfig"]["Tmpfs"][SCRATCH_DIR] = f"rw,nosuid,size={limits.disk_space_mb}m"
+
         if profile.workdir:
             config["WorkingDir"] = profile.workdir.as_posix()
+            if profile.tmpfs_workdir and not files and config["WorkingDir"] not in mounted:
+                # Programs are built and run in the workdir, so it's exec
+                config["HostConfig"]["Tmpfs"][config["WorkingDir"]] = \
+                    f"rw,exec,nosuid,size={limits.disk_space_mb}m"
 
         if profile.user:
             config["User"] = profile.user
 
-        name = self.name_factory()
-        task = self.docker_client.containers.create(config, name=name)
+        return config
 
-        container = await asyncio.wait_for(task, timeout)
-        if files:
-            await write_files(
-                container=container,
-                directory=profile.workdir or PosixPath("/"),
-                files=files,
-            )
+    async def create_container(
+        self,
+        profile: DockerProfile,
+        files: Sequence[File] | None = None,
+        mounts: list[Mount] | None = None,
+        limits: Limits = Limits(),
+        timeout: int = 5,
+        priority: int = 0,
+    ) -> DockerSandbox:
+        """
+        :param priority: sandboxes with higher priority are admitted
+            first, when the executor has a scheduler.
+        """
+
+        assert limits.time_measure == "wall" or self.usage_reader is not None, \
+            "Executor can't measure CPU time without a usage reader"
+
+        config = self.container_config(profile, files, mounts, limits)
+
+        if self.events is not None:
+            await self.events.start()
+
+        if self.image_cache is not None:
+            await self.image_cache.start()
+            await self.image_cache.ensure(profile.image)
+
+        reservation = None
+        cpuset = None
+        try:
+            if self.scheduler is not None:
+                reservation = await self.scheduler.acquire(limits, priority)
+            if self.cpu_allocator is not None:
+                cpuset = await self.cpu_allocator.acquire(limits.cpu_count)
+
+            pooled = None
+            if self.container_pool is not None and not mounts:
+                pooled = self.container_pool.take(config)
 
-        return DockerSandbox(name, container, limits.time.total_seconds())
+            if pooled is not None:
+                name, container = pooled
+                if cpuset is not None:
+                    await self._update_container(container, {"CpusetCpus": cpuset.cpuset_cpus})
+            else:
+                if cpuset is not None:
+                    config["HostConfig"]["CpusetCpus"] = cpuset.cpuset_cpus
+                name = self.name_factory()
+                with self.instrumentation.span("create", {"container": name, "image": profile.image}):
+                    task = self.docker_client.containers.create(config, name=name)
+                    try:
+                        container = await asyncio.wait_for(task, timeout)
+                    except DockerError as e:
+                        if e.status != HTTP_NOT_FOUND or self.image_cache is None:
+                            raise
+                        # The image was removed after it had been checked
+                        self.image_cache.discard(profile.image)
+                        raise ImageNotFoundError(profile.image, e.message) from e
+
+            if files:
+                with self.instrumentation.span("put_archive", {"container": name, "image": profile.image}):
+                    await write_files(
+                        container=container,
+                        directory=profile.workdir or PosixPath("/"),
+                        files=files,
+                        cache=self.tarball_cache,
+                    )
+        except BaseException:
+            for held in (cpuset, reservation):
+                if held is not None:
+                    held.release()
+            raise
+
+        streaming_container = None
+        if self.streaming_client is not self.docker_client:
+            streaming_container = DockerContainer(self.streaming_client, id=container.id)
+
+        return DockerSandbox(
+            name, container,
+            streaming_container=streaming_container,
+            reaper=self.reaper,
+            instrumentation=self.instrumentation,
+            image=profile.image,
+            limits=limits,
+            timeout=limits.wall_time_limit.total_seconds(),
+            output_limit=limits.output_bytes,
+            events=self.events,
+            tarball_cache=self.tarball_cache,
+            reservation=reservation,
+            cpuset=cpuset,
+            usage_reader=self.usage_reader,
+            cpu_time_limit=limits.time.total_seconds() if limits.time_measure == "cpu" else None,
+        )
+
+    async def _update_container(self, container, resources: dict) -> None:
+        await self.docker_client._query_json(
+            f"containers/{container.id}/update",
+            method="POST",
+            data=json.dumps(resources),
+            headers={"Content-Type": "application/json"},
+        )
 
     @asynccontextmanager
     async def workdir(
@@ -82,35 +298,78 @@ class DockerExecutor:
         name: str = None,
         driver: str = "local",
         timeout: int = 5,
+        tmpfs_mb: int | None = None,
     ):
         """
         Context manager, that returns a temporary docker volume, that
         will be deleted upon exiting context manager. Workdir allows you
-        to share data with multiple containers
+        to share data with multiple containers. With a volume pool, volumes
+        without a name are taken from the pool and returned to it.
         :param name: volume name, will be generated if None.
         :param driver: docker volume driver
         :param timeout: timeout
+        :param tmpfs_mb: if given, the volume is a tmpfs of this size. Its data
+            is lost when no running container has it mounted, so it's
+            a scratch space of containers running at the same time.
         :return:
         """
+        if self.volume_pool is not None and not name and driver == "local" and tmpfs_mb is None:
+            volume = await self.volume_pool.acquire()
+            try:
+                yield volume
+            finally:
+                self.volume_pool.release(volume)
+            return
+
         if not name:
             name = self.name_factory()
 
+        config = {"Name": name, "Driver": driver}
+        if tmpfs_mb is not None:
+            config["DriverOpts"] = tmpfs_options(tmpfs_mb)
+
+        tags = {"volume": name}
         volume = None
         try:
-            volume = await asyncio.wait_for(
-                self.docker_client.volumes.create(
-                    {
-                        "Name": name,
-                        "Driver": driver,
-                    }
-                ),
-                timeout,
-            )
+            with self.instrumentation.span("volume_create", tags):
+                volume = await asyncio.wait_for(
+                    self.docker_client.volumes.create(config),
+                    timeout,
+                )
             yield volume
         finally:
-            if volume:
+            if volume and self.reaper is not None:
+                self.reaper.reap(volume.name, partial(self._delete_volume, volume, tags))
+            elif volume:
                 with suppress(DockerError):
-                    await volume.delete()
+                    await self._delete_volume(volume, tags)
+
+    async def _delete_volume(self, volume: DockerVolume, tags: dict) -> None:
+        with self.instrumentation.span("volume_delete", tags):
+            await volume.delete()
+
+    def connection_stats(self) -> dict[str, ConnectionPoolStats]:
+        """Usage of the connection pools of the control and streaming clients"""
+        return {
+            "control": connection_stats(self.docker_client),
+            "streaming": connection_stats(self.streaming_client),
+        }
 
     async def close(self):
+        if self.reaper is not None:
+            await self.reaper.drain()
+        if self.events is not None:
+            await self.events.close()
+        if self.container_pool is not None:
+            await self.container_pool.close()
+        if self.image_cache is not None:
+            await self.image_cache.close()
+        if self.volume_pool is not None:
+            await self.volume_pool.close()
         await self.docker_client.close()
+        if self.streaming_client is not self.docker_client:
+            await self.streaming_client.close()
+
+
+def _is_within(path: str, directory: str) -> bool:
+    return path == directory or path.startswith(directory.rstrip("/") + "/")
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any
+
+import aiohttp
+from aiodocker import Docker
+
+__all__ = [
+    "ContainerEvents",
+    "ContainerExit",
+    "EventsStreamClosed",
+]
+
+logger = logging.getLogger(__name__)
+
+
+class EventsStreamClosed(ConnectionError):
+    pass
+
+
+@dataclass(frozen=True)
+class ContainerExit:
+    exit_code: int
+    started_at: datetime
+    finished_at: datetime
+    oom_killed: bool
+
+    def state(self) -> dict[str, Any]:
+        """Returns the state in the same format as docker inspect does"""
+        return {
+            "Status": "exited",
+            "ExitCode": self.exit_code,
+            "StartedAt": self.started_at,
+            "FinishedAt": self.finished_at,
+            "OOMKilled": self.oom_killed,
+        }
+
+
+@dataclass
+class _Watcher:
+    future: asyncio.Future
+    started_at: datetime | None = None
+    oom_killed: bool = False
+
+
+class ContainerEvents:
+    """
+    Single subscription to the docker events stream shared by all sandboxes
+    of an executor. Sandboxes register a watcher before a container is
+    started and get a future, that is resolved by the ``die`` event of the
+    container, so they don't need their own wait and inspect calls.
+
+    If the stream breaks, all pending futures fail with
+    :class:`EventsStreamClosed` and sandboxes fall back to HTTP calls.
+    The subscription is retried with an exponential backoff.
+    """
+
+    # Delay before the first retry of a failed subscription, it's doubled
+    # after every failed retry up to the max
+    reconnect_backoff: float = 1.0
+    max_reconnect_backoff: float = 30.0
+
+    def __init__(self, docker: Docker):
+        self._docker = docker
+        self._watchers: dict[str, _Watcher] = {}
+        self._task: asyncio.Task | None = None
+        self._connected = False
+        self._backoff = self.reconnect_backoff
+        self._retry_at = 0.0
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    async def start(self) -> bool:
+        """
+        Subscribes to the events stream if it is not subscribed yet.
+        After a failure the subscription isn't retried until
+        the backoff is over.
+
+        :return: whether the subscription is active.
+        """
+        if self._task is not None and not self._task.done():
+            return self._connected
+
+        loop = asyncio.get_running_loop()
+        if loop.time() < self._retry_at:
+            return False
+
+        subscribed: asyncio.Future[bool] = loop.create_future()
+        self._task = loop.create_task(self._listen(subscribed))
+        return await subscribed
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def watch(self, container_id: str) -> asyncio.Future:
+        """
+        Returns a future resolved with :class:`ContainerExit` when the
+        container dies after its next start.
+        """
+        assert self._connected, "Events stream is not subscribed"
+        future = asyncio.get_running_loop().create_future()
+        self._watchers[container_id] = _Watcher(future)
+        return future
+
+    def forget(self, container_id: str) -> None:
+        if watcher := self._watchers.pop(container_id, None):
+            watcher.future.cancel()
+
+    async def _listen(self, subscribed: asyncio.Future) -> None:
+        try:
+            async with self._docker._query(
+                "events",
+                params={
+                    "filters": {
+                        "type": ["container"],
+                        "event": ["start", "oom", "die"],
+                    },
+                },
+                # total timeout doesn't make sense for streaming
+                timeout=aiohttp.ClientTimeout(),
+            ) as response:
+                self._connected = True
+                self._backoff = self.reconnect_backoff
+                subscribed.set_result(True)
+                async for line in response.content:
+                    if line.strip():
+                        self._dispatch(json.loads(line))
+        except Exception:
+            logger.warning(
+                "Container events stream failed, retrying in %.1fs", self._backoff, exc_info=True,
+            )
+        finally:
+            self._connected = False
+            self._retry_at = asyncio.get_running_loop().time() + self._backoff
+            self._backoff = min(self._backoff * 2, self.max_reconnect_backoff)
+            if not subscribed.done():
+                subscribed.set_result(False)
+            self._close_watchers()
+
+    def _dispatch(self, event: dict[str, Any]) -> None:
+        actor = event.get("Actor", {})
+        watcher = self._watchers.get(actor.get("ID") or event.get("id"))
+        if watcher is None or watcher.future.done():
+            return
+
+        action = event.get("Action") or event.get("status")
+        time = datetime.fromtimestamp(event["timeNano"] / 1e9, tz=timezone.utc)
+        if action == "start":
+            watcher.started_at = time
+        elif watcher.started_at is None:
+            # Events of a previous run of the container
+            return
+        elif action == "oom":
+            watcher.oom_killed = True
+        elif action == "die":
+            exit_code = actor.get("Attributes", {}).get("exitCode", -1)
+            watcher.future.set_result(ContainerExit(
+                exit_code=int(exit_code),
+                started_at=watcher.started_at,
+                finished_at=time,
+                oom_killed=watcher.oom_killed,
+            ))
+
+    def _close_watchers(self) -> None:
+        for watcher in self._watchers.values():
+            if not watcher.future.done():
+                watcher.future.set_exception(EventsStreamClosed())
+                # The exception may be never retrieved if the sandbox
+                # doesn't wait for the container
+                watcher.future.exception()
+        self._watchers.clear()
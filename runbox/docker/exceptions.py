@@ -1,2 +1,11 @@
 class SandboxError(Exception):
     pass
+
+
+class ImageNotFoundError(SandboxError):
+    """Image of a profile is not present on the docker host"""
+
+    def __init__(self, image: str, reason: str | None = None):
+        message = f"Image {image} is not present on the docker host"
+        super().__init__(f"{message}: {reason}" if reason else message)
+        self.image = image
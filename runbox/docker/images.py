@@ -0,0 +1,239 @@
+import asyncio
+import json
+from typing import Any, Iterable
+
+import aiohttp
+from aiodocker import Docker
+from aiodocker.exceptions import DockerError
+
+from .exceptions import ImageNotFoundError
+
+__all__ = [
+    "ImageCache",
+    "normalize_image",
+]
+
+HTTP_NOT_FOUND = 404
+
+# Events, after which an image is present or may be gone
+_ADDED = frozenset({"pull", "tag", "load", "import"})
+_REMOVED = frozenset({"untag", "delete"})
+
+
+def normalize_image(image: str) -> str:
+    """Adds the ``latest`` tag to image names without a tag or a digest"""
+    if "@" in image or ":" in image.rpartition("/")[2]:
+        return image
+    return f"{image}:latest"
+
+
+class ImageCache:
+    """
+    Keeps track of images present on the docker host, so sandboxes
+    are never created from missing images: :meth:`ensure` fails fast
+    with :class:`ImageNotFoundError` instead of a pull inside the request.
+
+    Images are pulled ahead with :meth:`pull` and pinned: if a pinned image
+    is removed from the host, it's pulled again in the background.
+    The cache is refreshed from image events of the docker events stream.
+    While the stream is not connected, only pinned images and images
+    inspected within ``inspect_ttl`` seconds are trusted, and the subscription
+    is retried with an exponential backoff.
+
+    :param concurrency: number of images pulled at the same time.
+    """
+
+    # Delay before the first retry of a failed subscription, it's doubled
+    # after every failed retry up to the max
+    reconnect_backoff: float = 1.0
+    max_reconnect_backoff: float = 30.0
+    # How long an inspected image is trusted without events
+    inspect_ttl: float = 1.0
+
+    def __init__(self, concurrency: int = 4) -> None:
+        assert concurrency > 0, "Concurrency must be positive"
+        self.concurrency = concurrency
+        self.pinned: set[str] = set()
+        self._docker: Docker | None = None
+        self._streaming: Docker | None = None
+        # Image name -> id
+        self._present: dict[str, str | None] = {}
+        # Image name -> loop time of the last inspect
+        self._inspected_at: dict[str, float] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._task: asyncio.Task | None = None
+        self._connected = False
+        self._backoff = self.reconnect_backoff
+        self._retry_at = 0.0
+        self._pulls: dict[str, asyncio.Task] = {}
+
+    def bind(self, docker: Docker, streaming: Docker | None = None) -> None:
+        """
+        :param docker: client for inspects and pulls.
+        :param streaming: client for the events stream, so the long-lived
+            subscription doesn't hold a connection of the control pool.
+        """
+        self._docker = docker
+        self._streaming = streaming or docker
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    def __contains__(self, image: str) -> bool:
+        return normalize_image(image) in self._present
+
+    async def start(self) -> bool:
+        """
+        Subscribes to image events if it is not subscribed yet.
+        After a failure the subscription isn't retried until
+        the backoff is over.
+
+        :return: whether the subscription is active.
+        """
+        if self._task is not None and not self._task.done():
+            return self._connected
+
+        loop = asyncio.get_running_loop()
+        if loop.time() < self._retry_at:
+            return False
+
+        subscribed: asyncio.Future[bool] = loop.create_future()
+        self._task = loop.create_task(self._listen(subscribed))
+        return await subscribed
+
+    async def close(self) -> None:
+        tasks = [*self._pulls.values(), *([self._task] if self._task else [])]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._pulls.clear()
+
+    async def pull(self, images: Iterable[str]) -> None:
+        """
+        Pulls images, that are not present yet, and pins them.
+        At most ``concurrency`` images are pulled at the same time.
+        """
+        await self.start()
+        images = {normalize_image(image) for image in images}
+        self.pinned.update(images)
+        await asyncio.gather(*(self._pull(image) for image in images))
+
+    async def ensure(self, image: str) -> None:
+        """
+        Checks, that the image is present. Only images unknown to
+        the cache are looked up on the host, nothing is pulled.
+
+        :raises ImageNotFoundError: if the image is not present.
+        """
+        image = normalize_image(image)
+        if image in self._present and (
+            self._connected or image in self.pinned or self._inspected_recently(image)
+        ):
+            return
+
+        if (pull := self._pulls.get(image)) is not None:
+            await asyncio.shield(pull)
+            return
+
+        if not await self._inspect(image):
+            raise ImageNotFoundError(image)
+
+    def discard(self, image: str) -> None:
+        """Forgets the image, e.g. after docker said it's missing"""
+        image = normalize_image(image)
+        self._present.pop(image, None)
+        if image in self.pinned:
+            self._repull(image)
+
+    async def _inspect(self, image: str) -> bool:
+        assert self._docker is not None, "Image cache is not bound to an executor"
+        try:
+            info = await self._docker.images.inspect(image)
+        except DockerError as e:
+            if e.status == HTTP_NOT_FOUND:
+                self._present.pop(image, None)
+                return False
+            raise
+
+        self._present[image] = info.get("Id")
+        self._inspected_at[image] = asyncio.get_running_loop().time()
+        return True
+
+    def _inspected_recently(self, image: str) -> bool:
+        inspected_at = self._inspected_at.get(image)
+        return inspected_at is not None \
+            and asyncio.get_running_loop().time() - inspected_at < self.inspect_ttl
+
+    async def _pull(self, image: str) -> None:
+        if image in self._present or await self._inspect(image):
+            return
+
+        async with self._semaphore:
+            repo, tag = image, None
+            if "@" not in image:
+                repo, _, tag = image.rpartition(":")
+            progress = await self._docker.images.pull(repo, tag=tag)
+            if isinstance(progress, dict):
+                progress = [progress]
+            for status in progress or []:
+                if "error" in status:
+                    raise ImageNotFoundError(image, status["error"])
+
+        if not await self._inspect(image):
+            raise ImageNotFoundError(image)
+
+    def _repull(self, image: str) -> None:
+        if image in self._pulls:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._pull(image))
+        self._pulls[image] = task
+        task.add_done_callback(lambda _: self._pulls.pop(image, None))
+
+    async def _listen(self, subscribed: asyncio.Future) -> None:
+        try:
+            async with self._streaming._query(
+                "events",
+                params={"filters": {"type": ["image"]}},
+                # total timeout doesn't make sense for streaming
+                timeout=aiohttp.ClientTimeout(),
+            ) as response:
+                self._connected = True
+                self._backoff = self.reconnect_backoff
+                subscribed.set_result(True)
+                async for line in response.content:
+                    if line.strip():
+                        self._dispatch(json.loads(line))
+        except Exception:
+            pass
+        finally:
+            self._connected = False
+            self._retry_at = asyncio.get_running_loop().time() + self._backoff
+            self._backoff = min(self._backoff * 2, self.max_reconnect_backoff)
+            if not subscribed.done():
+                subscribed.set_result(False)
+
+    def _dispatch(self, event: dict[str, Any]) -> None:
+        action = event.get("Action") or event.get("status")
+        actor = event.get("Actor", {})
+        image_id = actor.get("ID") or event.get("id")
+        name = actor.get("Attributes", {}).get("name")
+
+        if action in _ADDED:
+            if image_id and not image_id.startswith("sha256:"):
+                # Pull events carry the reference instead of the id and
+                # the repository as the name, an inspected id is kept
+                image = normalize_image(image_id)
+                self._present[image] = self._present.get(image)
+            elif name and not name.startswith("sha256:"):
+                self._present[normalize_image(name)] = image_id
+        elif action in _REMOVED:
+            name = normalize_image(name) if name else None
+            removed = {
+                image for image, known_id in self._present.items()
+                if image_id in (image, known_id) or image == name
+            }
+            for image in removed:
+                self.discard(image)
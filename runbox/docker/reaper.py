@@ -0,0 +1,138 @@
+import asyncio
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import aiohttp
+from aiodocker.exceptions import DockerError
+
+__all__ = [
+    "Reaper",
+    "ReaperStats",
+]
+
+HTTP_NOT_FOUND = 404
+
+
+@dataclass(frozen=True)
+class ReaperStats:
+    pending: int
+    deleted: int
+    # Deletions given up after all retries
+    failed: int
+    retried: int
+
+
+@dataclass
+class _Job:
+    name: str
+    delete: Callable[[], Awaitable[None]]
+    on_done: Callable[[], None] | None
+
+
+class Reaper:
+    """
+    Deletes containers and volumes in the background, so callers
+    don't wait for delete round-trips. Deletions are run by a bounded
+    number of workers in the order they were queued, failed ones are
+    retried with an exponential backoff. Resources, that are already gone,
+    count as deleted.
+
+    :meth:`drain` waits until the queue is empty, it's called
+    by :meth:`DockerExecutor.close`, so nothing is leaked on shutdown.
+
+    :param concurrency: number of deletions in progress at the same time.
+    :param retries: number of retries after the first failed attempt.
+    :param backoff: delay before the first retry in seconds,
+        doubled after every retry.
+    """
+
+    def __init__(self, concurrency: int = 8, retries: int = 5, backoff: float = 0.1) -> None:
+        assert concurrency > 0, "Concurrency must be positive"
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.deleted = 0
+        self.failed = 0
+        self.retried = 0
+        self._pending = 0
+        self._queue: asyncio.Queue[_Job] = asyncio.Queue()
+        self._workers: list[asyncio.Task] = []
+
+    @property
+    def pending(self) -> int:
+        """Number of queued and running deletions"""
+        return self._pending
+
+    @property
+    def stats(self) -> ReaperStats:
+        return ReaperStats(
+            pending=self.pending,
+            deleted=self.deleted,
+            failed=self.failed,
+            retried=self.retried,
+        )
+
+    def reap(
+        self,
+        name: str,
+        delete: Callable[[], Awaitable[None]],
+        on_done: Callable[[], None] | None = None,
+    ) -> None:
+        """
+        Queues a deletion.
+
+        :param name: name of the resource.
+        :param delete: deletes the resource.
+        :param on_done: called when the resource is deleted or
+            given up, e.g. to release resources of a sandbox.
+        """
+        self._pending += 1
+        self._queue.put_nowait(_Job(name, delete, on_done))
+        if len(self._workers) < min(self.concurrency, self._pending):
+            self._workers.append(asyncio.get_running_loop().create_task(self._work()))
+
+    async def drain(self) -> None:
+        """Waits until every queued resource is deleted or given up"""
+        await self._queue.join()
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.cancel()
+        for worker in workers:
+            with suppress(asyncio.CancelledError):
+                await worker
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._delete(job)
+            except Exception:
+                self.failed += 1
+            finally:
+                self._pending -= 1
+                if job.on_done is not None:
+                    job.on_done()
+                self._queue.task_done()
+
+    async def _delete(self, job: _Job) -> None:
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+                await asyncio.sleep(delay)
+                delay *= 2
+            try:
+                await job.delete()
+            except DockerError as e:
+                if e.status == HTTP_NOT_FOUND:
+                    break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            else:
+                break
+        else:
+            self.failed += 1
+            return
+
+        self.deleted += 1
@@ -1,63 +1,189 @@
 import asyncio
 from contextlib import suppress
+from functools import partial
 from pathlib import Path
-from typing import Any
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable
 
 import aiodocker
 from aiodocker.containers import DockerContainer
 from aiodocker.stream import Stream, Message
 
+from runbox.docker.events import ContainerEvents, EventsStreamClosed
 from runbox.docker.exceptions import SandboxError
-from runbox.docker.utils import write_files
-from runbox.models import SandboxState, File
+from runbox.docker.cpu_allocator import CpuSet
+from runbox.docker.demux import DemuxReader, view_reader
+from runbox.docker.reaper import Reaper
+from runbox.docker.scheduler import Reservation
+from runbox.docker.usage import ResourceUsage, UsageReader
+from runbox.docker.utils import write_files, cpu_ulimit, TarballCache, CHUNK_SIZE
+from runbox.instrumentation import Instrumentation, NOOP_INSTRUMENTATION
+from runbox.models import SandboxState, File, Limits
 from runbox.proto import SandboxIO
 
+# Exit codes of a container killed by a signal are 128 + signal number
+EXIT_SIGXCPU = 128 + 24
+EXIT_SIGXFSZ = 128 + 25
+
 
 class StreamWrapper:
+    """
+    Wraps container's attach stream. If output limit is given, number of
+    bytes read is counted per stream, and the stream is ended as soon as
+    any of them goes over the limit.
+    """
 
-    def __init__(self, stream: Stream, detach_keys: str = "ctrl-c"):
+    def __init__(
+        self,
+        stream: Stream | DemuxReader,
+        detach_keys: str = "ctrl-c",
+        output_limit: int | None = None,
+        on_output_limit: Callable[[], Awaitable[None]] | None = None,
+    ):
         self.stream = stream
         self.detach_keys = detach_keys
+        self.output_limit = output_limit
+        self.on_output_limit = on_output_limit
+        self._read: dict[int, int] = {}
+        self._limit_exceeded = False
 
     async def write_in(self, data: bytes) -> None:
         await self.stream.write_in(data)
 
     async def read_out(self) -> Message | None:
-        return await self.stream.read_out()
+        message = await self.read_view()
+        if message is None or isinstance(message.data, bytes):
+            return message
+        return Message(message.stream, bytes(message.data))
+
+    async def read_view(self) -> Message | None:
+        """
+        Same as :meth:`read_out`, but data of messages are memoryview
+        slices of the received data, if the stream supports it.
+        """
+        if self._limit_exceeded:
+            return None
+
+        message = await view_reader(self.stream)()
+        if message is None or self.output_limit is None:
+            return message
+
+        read = self._read.get(message.stream, 0) + len(message.data)
+        self._read[message.stream] = read
+        if read > self.output_limit:
+            self._limit_exceeded = True
+            if self.on_output_limit is not None:
+                await self.on_output_limit()
+            return None
+
+        return message
 
     async def detach(self) -> None:
         await self.stream.write_in(self.detach_keys.encode())
 
+    async def close(self) -> None:
+        await self.stream.close()
+
 
 class DockerSandbox:
+    """
+    :param events: if given, completion of the container is taken from the
+        shared docker events stream instead of wait and inspect calls.
+    :param reservation: resources reserved for the sandbox by the
+        executor's scheduler, released when the sandbox is deleted.
+    :param cpuset: cores the sandbox is pinned to, returned to the
+        executor's allocator when the sandbox is deleted.
+    :param usage_reader: if given, CPU time and peak memory of the sandbox
+        are sampled while it runs and reported in its state.
+    :param cpu_time_limit: the sandbox is killed when its CPU time goes
+        over this number of seconds, requires a usage reader.
+    :param streaming_container: the same container bound to a client
+        with a connection pool of long-lived calls, used for attach,
+        wait and archive downloads.
+    :param reaper: if given, the container is deleted in the background,
+        reserved resources are released after it's deleted.
+    :param instrumentation: receives timed spans of docker calls
+        tagged with the name of the sandbox and the image.
+    """
+
+    # How long state() waits for the die event after the container is killed
+    exit_event_grace: float = 1.0
 
     def __init__(
         self,
         name: str,
         container: DockerContainer,
         timeout: float,
+        output_limit: int | None = None,
+        events: ContainerEvents | None = None,
+        tarball_cache: TarballCache | None = None,
+        reservation: Reservation | None = None,
+        cpuset: CpuSet | None = None,
+        usage_reader: UsageReader | None = None,
+        cpu_time_limit: float | None = None,
+        streaming_container: DockerContainer | None = None,
+        reaper: Reaper | None = None,
+        instrumentation: Instrumentation = NOOP_INSTRUMENTATION,
+        image: str | None = None,
+        limits: Limits | None = None,
     ) -> None:
+        assert cpu_time_limit is None or usage_reader is not None, \
+            "CPU time can't be limited without a usage reader"
         self.name = name
         self._container = container
+        self._streaming_container = streaming_container or container
         self._timeout = timeout
+        self._output_limit = output_limit
+        self._events = events
+        self._tarball_cache = tarball_cache
+        self._reservation = reservation
+        self._cpuset = cpuset
+        self._usage_reader = usage_reader
+        self._cpu_time_limit = cpu_time_limit
+        self._reaper = reaper
+        self._instrumentation = instrumentation
+        self._span_tags = {"container": name, "image": image}
+        self._limits = limits
+        self._usage: ResourceUsage | None = None
+        self._monitor_task: asyncio.Task | None = None
+        self._exit_usage_task: asyncio.Task | None = None
         self._cpu_limit: bool = False
+        self._output_limit_exceeded: bool = False
         self._timeout_task: asyncio.Task | None = None
         self._stream: StreamWrapper | None = None
+        self._exit: asyncio.Future | None = None
+        self._waited: bool = False
 
     @property
     def stream(self) -> SandboxIO | None:
         assert self._stream is not None, "Stream can't be get before the container is started"
-        return StreamWrapper(self._stream)
+        return self._stream
 
     async def write_files(self, path: Path | str, *files: File) -> None:
-        await write_files(self._container, Path(path), files)
+        with self._instrumentation.span("put_archive", self._span_tags):
+            await write_files(self._container, Path(path), files, self._tarball_cache)
+
+    async def read_archive(self, path: Path | str) -> AsyncIterator[bytes]:
+        """Streams a tar archive of the path inside the container"""
+        async with self._streaming_container.docker._query(
+            f"containers/{self._container.id}/archive",
+            method="GET",
+            params={"path": Path(path).as_posix()},
+        ) as response:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                yield chunk
+
+    async def write_archive(self, path: Path | str, archive: bytes | AsyncIterable[bytes]) -> None:
+        """Extracts a tar archive to the path inside the container"""
+        with self._instrumentation.span("put_archive", self._span_tags):
+            await self._container.put_archive(Path(path).as_posix(), archive)
 
     async def wait(self):
         try:
             if self._timeout_task is None:
                 raise SandboxError("Sandbox is not running")
 
-            await self._timeout_task
+            with self._instrumentation.span("wait", self._span_tags):
+                await self._timeout_task
 
         except asyncio.exceptions.TimeoutError:
             with suppress(aiodocker.DockerError):
@@ -65,49 +191,210 @@ class DockerSandbox:
                 self._cpu_limit = True
         finally:
             self._timeout_task = None
+            self._waited = True
+            await self._read_exit_usage()
+            await self._stop_monitor()
 
     async def set_timeout(self):
         loop = asyncio.get_running_loop()
-        waiter = self._container.wait(timeout=self._timeout)
 
         if self._timeout_task is not None:
             raise SandboxError("Container is already running")
 
+        waiter = asyncio.wait_for(self._wait_exit(), self._timeout)
         self._timeout_task = loop.create_task(waiter)
 
-    async def run(self, stdin: bytes | None = None) -> StreamWrapper:
-        self._cpu_limit = False
+    async def _wait_exit(self) -> None:
+        if self._exit is not None:
+            with suppress(EventsStreamClosed):
+                await asyncio.shield(self._exit)
+                return
 
-        await self._container.start()
+        await self._streaming_container.wait()
 
-        stream = self._container.attach(
-            stdin=True, stdout=True, stderr=True, logs=True,
-            detach_keys="ctrl-c"
+    async def run(self, stdin: bytes | None = None) -> StreamWrapper:
+        self._cpu_limit = False
+        self._output_limit_exceeded = False
+        self._waited = False
+        await self._close_stream()
+
+        self._exit = None
+        if self._events is not None and self._events.connected:
+            self._exit = self._events.watch(self._container.id)
+
+        with self._instrumentation.span("start", self._span_tags):
+            await self._container.start()
+
+        self._usage = None
+        if self._usage_reader is not None:
+            self._monitor_task = asyncio.create_task(self._monitor())
+            # Polls miss the end of the run, and short runs entirely
+            self._exit_usage_task = asyncio.create_task(self._usage_reader.read_exit(self._container))
+
+        with self._instrumentation.span("attach", self._span_tags):
+            stream = await DemuxReader.open(self._streaming_container.attach(
+                stdin=True, stdout=True, stderr=True, logs=True,
+                detach_keys="ctrl-c"
+            ))
+        self._stream = StreamWrapper(
+            stream,
+            output_limit=self._output_limit,
+            on_output_limit=self._on_output_limit,
         )
-        self._stream = StreamWrapper(stream)
 
         if stdin:
             await stream.write_in(stdin)
 
         await self.set_timeout()
 
-        return StreamWrapper(stream)
+        return self._stream
 
-    async def state(self) -> SandboxState:
-        container_info = await self._container.docker.containers.get(self._container.id)
-        state = container_info._container['State']
+    async def _monitor(self) -> None:
+        while True:
+            usage = await self._sample()
+            if usage is None:
+                # Container has stopped, the last sample is kept
+                return
+
+            if self._cpu_time_limit is not None and \
+                    usage.cpu_time.total_seconds() > self._cpu_time_limit:
+                self._cpu_limit = True
+                with suppress(aiodocker.DockerError):
+                    await self.kill()
+                return
+
+            await asyncio.sleep(self._usage_reader.poll_interval)
+
+    async def _sample(self) -> ResourceUsage | None:
+        usage = await self._usage_reader.read(self._container)
+        if usage is not None:
+            self._usage = usage if self._usage is None else self._usage.merge(usage)
+        return usage
+
+    async def _stop_monitor(self) -> None:
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._monitor_task
+            self._monitor_task = None
+        if self._exit_usage_task is not None:
+            self._exit_usage_task.cancel()
+            self._exit_usage_task = None
+
+    async def _read_exit_usage(self) -> None:
+        """Adds the usage read, when the container has exited"""
+        task, self._exit_usage_task = self._exit_usage_task, None
+        if task is None:
+            return
+        try:
+            usage = await asyncio.wait_for(task, self.exit_event_grace)
+        except (asyncio.TimeoutError, OSError):
+            return
+        if usage is not None:
+            self._usage = usage if self._usage is None else self._usage.merge(usage)
 
-        state = {**state, 'CpuLimit': self._cpu_limit}
-        return create_sandbox_state(state)
+    async def _on_output_limit(self) -> None:
+        self._output_limit_exceeded = True
+        with suppress(aiodocker.DockerError):
+            await self.kill()
+
+    async def state(self) -> SandboxState:
+        state = await self._exit_state()
+        if state is None:
+            with self._instrumentation.span("inspect", self._span_tags):
+                container_info = await self._container.docker.containers.get(self._container.id)
+            state = container_info._container['State']
+
+        exit_code = state.get('ExitCode')
+        state = {
+            **state,
+            'CpuLimit': self._cpu_limit,
+            'OutputLimit': self._output_limit_exceeded,
+        }
+        if self._usage is not None:
+            state['CpuTime'] = self._usage.cpu_time
+            state['MemoryPeak'] = self._usage.memory_peak_bytes
+        sandbox_state = create_sandbox_state(state)
+
+        # A program can exit with these codes on its own, so they are
+        # limit verdicts only if the limit was set and could be reached
+        if exit_code == EXIT_SIGXCPU and self._cpu_ulimit_reached(sandbox_state):
+            sandbox_state = sandbox_state.copy(update={'cpu_limit': True})
+        if exit_code == EXIT_SIGXFSZ and await self._fsize_ulimit_reached():
+            sandbox_state = sandbox_state.copy(update={'disk_limit': True})
+        return sandbox_state
+
+    def _cpu_ulimit_reached(self, state: SandboxState) -> bool:
+        if self._limits is None:
+            return False
+        if state.cpu_time is not None:
+            cpu_time = state.cpu_time.total_seconds()
+        else:
+            # CPU time can't be more than that
+            cpu_time = state.duration.total_seconds() * self._limits.cpu_count
+        return cpu_time >= cpu_ulimit(self._limits)
+
+    async def _fsize_ulimit_reached(self) -> bool:
+        """Checks, that the container has written at least a file limit
+        of data. Writes to volumes are not counted, so it may miss some."""
+        if self._limits is None:
+            return False
+        with self._instrumentation.span("inspect", self._span_tags):
+            info = await self._container.docker._query_json(
+                f"containers/{self._container.id}/json",
+                params={"size": "true"},
+            )
+        return (info.get('SizeRw') or 0) >= self._limits.disk_space_bytes
+
+    async def _exit_state(self) -> dict[str, Any] | None:
+        if self._exit is None or not (self._exit.done() or self._waited):
+            return None
+
+        with suppress(asyncio.TimeoutError, EventsStreamClosed):
+            container_exit = await asyncio.wait_for(
+                asyncio.shield(self._exit),
+                self.exit_event_grace,
+            )
+            return container_exit.state()
+
+        return None
 
     async def log(self, stdout: bool = False, stderr: bool = False) -> list[str]:
         return await self._container.log(stdout=stdout, stderr=stderr)
 
     async def kill(self) -> None:
-        await self._container.kill()
+        with self._instrumentation.span("kill", self._span_tags):
+            await self._container.kill()
+
+    async def _close_stream(self) -> None:
+        # The wrapper is kept, so output listeners see the end of the stream
+        if self._stream is not None:
+            await self._stream.close()
 
     async def delete(self, force: bool = False) -> None:
-        await self._container.delete(force=force)
+        await self._stop_monitor()
+        await self._close_stream()
+        if self._events is not None:
+            self._events.forget(self._container.id)
+        if self._reaper is not None:
+            # Nobody waits for the result, so running containers are removed too
+            self._reaper.reap(self.name, partial(self._delete_container, force=True), self._release)
+            return
+
+        try:
+            await self._delete_container(force)
+        finally:
+            self._release()
+
+    async def _delete_container(self, force: bool) -> None:
+        with self._instrumentation.span("delete", self._span_tags):
+            await self._container.delete(force=force)
+
+    def _release(self) -> None:
+        if self._cpuset is not None:
+            self._cpuset.release()
+        if self._reservation is not None:
+            self._reservation.release()
 
     def __await__(self):
         return self.wait().__await__()
@@ -17,6 +17,23 @@ class SandboxBuilder:
         self._limits: Limits | None = None
         self._files: list[File] = []
         self._mounts: list[Mount] = []
+        self._priority: int = 0
+
+    @property
+    def profile(self) -> DockerProfile | None:
+        return self._profile
+
+    @property
+    def limits(self) -> Limits:
+        return self._limits or Limits()
+
+    @property
+    def files(self) -> list[File]:
+        return self._files[:]
+
+    @property
+    def mounts(self) -> list[Mount]:
+        return self._mounts[:]
 
     def with_limits(self, limits: Limits) -> SandboxBuilder:
         new_builder = self.copy()
@@ -28,6 +45,11 @@ class SandboxBuilder:
         new_builder._profile = profile
         return new_builder
 
+    def with_priority(self, priority: int) -> SandboxBuilder:
+        new_builder = self.copy()
+        new_builder._priority = priority
+        return new_builder
+
     def add_files(self, *files: File) -> SandboxBuilder:
         new_builder = self.copy()
         new_builder._files.extend(files)
@@ -55,6 +77,16 @@ class SandboxBuilder:
             mounts=self._mounts,
             limits=self._limits or Limits(),
             timeout=timeout,
+            priority=self._priority,
+        )
+
+    async def warm_up(self, executor: DockerExecutor) -> None:
+        assert self._profile is not None
+        assert not self._mounts, "Sandboxes with mounts can't be pooled"
+        await executor.warm_up(
+            profile=self._profile,
+            limits=self._limits or Limits(),
+            files=self._files,
         )
 
     def copy(self) -> SandboxBuilder:
@@ -63,6 +95,7 @@ class SandboxBuilder:
         # so copying is not necessary
         new_builder._profile = self._profile
         new_builder._limits = self._limits
+        new_builder._priority = self._priority
 
         # Copying mounts and files only by links,
         # because Mount and File models are immutable
@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+
+from runbox.models import Limits
+
+__all__ = [
+    "AdmissionScheduler",
+    "Reservation",
+    "SchedulerStats",
+]
+
+
+@dataclass(frozen=True)
+class SchedulerStats:
+    reserved_memory_mb: int
+    reserved_cpus: int
+    queue_depth: int
+    max_queue_depth: int
+    admitted: int
+    # Seconds spent in the queue by admitted requests
+    total_wait: float
+    max_wait: float
+
+
+@dataclass
+class Reservation:
+    """Resources held by a sandbox until it is deleted"""
+    memory_mb: int
+    cpu_count: int
+    _scheduler: "AdmissionScheduler | None" = field(default=None, repr=False)
+
+    @property
+    def released(self) -> bool:
+        return self._scheduler is None
+
+    def release(self) -> None:
+        """Returns resources to the scheduler, can be called many times"""
+        if self._scheduler is not None:
+            scheduler, self._scheduler = self._scheduler, None
+            scheduler._release(self)
+
+
+@dataclass(order=True)
+class _Request:
+    # Higher priority is served first, requests
+    # with the same priority are served in FIFO order
+    sort_key: tuple[int, int]
+    memory_mb: int = field(compare=False)
+    cpu_count: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    queued_at: float = field(compare=False)
+
+
+class AdmissionScheduler:
+    """
+    Admission control for sandboxes of an executor. Memory and CPUs
+    declared in :class:`Limits` are reserved from the host budget before
+    a container is created and released when the sandbox is deleted.
+    Requests that don't fit into the budget wait in a queue.
+
+    The head of the queue is never overtaken by smaller requests,
+    so big sandboxes are not starved under a steady load.
+
+    :param memory_mb: memory budget of the host.
+    :param cpu_count: number of CPUs of the host given to sandboxes.
+    """
+
+    def __init__(self, memory_mb: int, cpu_count: int) -> None:
+        assert memory_mb > 0 and cpu_count > 0, "Budget must be positive"
+        self.memory_mb = memory_mb
+        self.cpu_count = cpu_count
+        self.reserved_memory_mb = 0
+        self.reserved_cpus = 0
+        self.admitted = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._queue: list[_Request] = []
+        self._counter = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def stats(self) -> SchedulerStats:
+        return SchedulerStats(
+            reserved_memory_mb=self.reserved_memory_mb,
+            reserved_cpus=self.reserved_cpus,
+            queue_depth=self.queue_depth,
+            max_queue_depth=self.max_queue_depth,
+            admitted=self.admitted,
+            total_wait=self.total_wait,
+            max_wait=self.max_wait,
+        )
+
+    async def acquire(self, limits: Limits, priority: int = 0) -> Reservation:
+        """
+        Waits until resources declared in the limits are available
+        and reserves them.
+
+        :raises ValueError: if the limits exceed the whole budget.
+        """
+        if limits.memory_mb > self.memory_mb or limits.cpu_count > self.cpu_count:
+            raise ValueError(
+                f"Limits ({limits.memory_mb} MB, {limits.cpu_count} CPU) exceed "
+                f"the host budget ({self.memory_mb} MB, {self.cpu_count} CPU)"
+            )
+
+        request = _Request(
+            sort_key=(-priority, next(self._counter)),
+            memory_mb=limits.memory_mb,
+            cpu_count=limits.cpu_count,
+            future=asyncio.get_running_loop().create_future(),
+            queued_at=time.monotonic(),
+        )
+        heapq.heappush(self._queue, request)
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+        self._admit()
+
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            if request.future.done() and not request.future.cancelled():
+                # Admitted right before the cancellation
+                request.future.result().release()
+            elif request in self._queue:
+                self._queue.remove(request)
+                heapq.heapify(self._queue)
+                # Requests behind the cancelled one may fit now
+                self._admit()
+            raise
+
+    def _fits(self, request: _Request) -> bool:
+        return self.reserved_memory_mb + request.memory_mb <= self.memory_mb \
+            and self.reserved_cpus + request.cpu_count <= self.cpu_count
+
+    def _admit(self) -> None:
+        now = time.monotonic()
+        while self._queue and self._fits(self._queue[0]):
+            request = heapq.heappop(self._queue)
+            if request.future.done():
+                continue
+
+            self.reserved_memory_mb += request.memory_mb
+            self.reserved_cpus += request.cpu_count
+            self.admitted += 1
+            wait = now - request.queued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            request.future.set_result(
+                Reservation(request.memory_mb, request.cpu_count, self)
+            )
+
+    def _release(self, reservation: Reservation) -> None:
+        self.reserved_memory_mb -= reservation.memory_mb
+        self.reserved_cpus -= reservation.cpu_count
+        self._admit()
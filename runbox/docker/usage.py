@@ -0,0 +1,201 @@
+import asyncio
+import os
+import select
+from dataclasses import dataclass
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, Protocol
+
+from aiodocker.containers import DockerContainer
+from aiodocker.exceptions import DockerError
+
+__all__ = [
+    "ResourceUsage",
+    "UsageReader",
+    "CgroupUsageReader",
+    "StatsUsageReader",
+]
+
+
+@dataclass(frozen=True)
+class ResourceUsage:
+    # User and system CPU time of all processes of the container
+    cpu_time: timedelta
+    memory_peak_bytes: int
+
+    def merge(self, other: "ResourceUsage") -> "ResourceUsage":
+        """Combines two samples of the same container"""
+        return ResourceUsage(
+            cpu_time=max(self.cpu_time, other.cpu_time),
+            memory_peak_bytes=max(self.memory_peak_bytes, other.memory_peak_bytes),
+        )
+
+
+class UsageReader(Protocol):
+    """
+    Reads resource usage of a running container. Returns None when
+    the container is not running, because docker removes its cgroup.
+    """
+
+    # How often (in seconds) a running container is sampled
+    poll_interval: float
+
+    async def read(self, container: DockerContainer) -> ResourceUsage | None:
+        ...
+
+    async def read_exit(self, container: DockerContainer) -> ResourceUsage | None:
+        """
+        Waits until all processes of the running container have exited
+        and reads the last usage before docker removes the cgroup.
+        Returns None, if the usage can't be read at the exit.
+        """
+        ...
+
+
+class CgroupUsageReader:
+    """
+    Reads cgroup files of the container directly. It's cheap enough to be
+    polled often, but works only on the docker host itself.
+
+    Both cgroup v2 and v1 hierarchies are supported
+    with either systemd or cgroupfs cgroup driver.
+    """
+
+    poll_interval: float = 0.02
+
+    def __init__(self, root: Path = Path("/sys/fs/cgroup")) -> None:
+        self.root = Path(root)
+
+    def read_sync(self, container_id: str) -> ResourceUsage | None:
+        for group in self._groups(container_id):
+            if (cpu_stat := group / "cpu.stat").exists():
+                return self._read_v2(group, cpu_stat)
+
+        cpu = self._find("cpuacct", container_id, "cpuacct.usage")
+        memory = self._find("memory", container_id, "memory.max_usage_in_bytes")
+        if cpu is None or memory is None:
+            return None
+        return _read_files(lambda: ResourceUsage(
+            cpu_time=timedelta(microseconds=int(cpu.read_text()) / 1000),
+            memory_peak_bytes=int(memory.read_text()),
+        ))
+
+    async def read(self, container: DockerContainer) -> ResourceUsage | None:
+        return self.read_sync(container.id)
+
+    async def read_exit(self, container: DockerContainer) -> ResourceUsage | None:
+        """
+        Cgroup v2 notifies about changes of ``cgroup.events``, when the
+        last process of the group exits, the group is still there.
+        Cgroup v1 has no such notifications, so None is returned.
+        """
+        for group in self._groups(container.id):
+            try:
+                fd = os.open(group / "cgroup.events", os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                return await _wait_unpopulated(fd, lambda: self._read_v2(group, group / "cpu.stat"))
+            finally:
+                os.close(fd)
+        return None
+
+    def _read_v2(self, group: Path, cpu_stat: Path) -> ResourceUsage | None:
+        def read() -> ResourceUsage:
+            stat = dict(line.split() for line in cpu_stat.read_text().splitlines())
+            # memory.peak appeared only in linux 5.19
+            peak = group / "memory.peak"
+            if not peak.exists():
+                peak = group / "memory.current"
+            return ResourceUsage(
+                cpu_time=timedelta(microseconds=int(stat["usage_usec"])),
+                memory_peak_bytes=int(peak.read_text()),
+            )
+
+        return _read_files(read)
+
+    def _groups(self, container_id: str, controller: str = "") -> list[Path]:
+        base = self.root / controller if controller else self.root
+        return [
+            base / "system.slice" / f"docker-{container_id}.scope",
+            base / "docker" / container_id,
+        ]
+
+    def _find(self, controller: str, container_id: str, name: str) -> Path | None:
+        for group in self._groups(container_id, controller):
+            if (path := group / name).exists():
+                return path
+        return None
+
+
+async def _wait_unpopulated(fd: int, read) -> ResourceUsage | None:
+    loop = asyncio.get_running_loop()
+    exited = asyncio.Event()
+
+    def check() -> None:
+        try:
+            if b"populated 0" in os.pread(fd, 4096, 0):
+                exited.set()
+        except OSError:
+            exited.set()
+
+    # Changes are signaled with EPOLLPRI, the file itself is always
+    # readable, so the loop waits for a separate epoll instance instead
+    epoll = select.epoll()
+    try:
+        epoll.register(fd, select.EPOLLPRI)
+        loop.add_reader(epoll.fileno(), lambda: epoll.poll(0) and check())
+        try:
+            check()
+            await exited.wait()
+        finally:
+            loop.remove_reader(epoll.fileno())
+    finally:
+        epoll.close()
+    return read()
+
+
+def _read_files(read) -> ResourceUsage | None:
+    # Cgroup is removed as soon as the container stops
+    try:
+        return read()
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class StatsUsageReader:
+    """
+    Reads usage with the docker stats API. Works with remote docker
+    daemons, but every sample is an HTTP call, so it should be
+    polled less often than :class:`CgroupUsageReader`.
+    """
+
+    poll_interval: float = 0.5
+
+    async def read(self, container: DockerContainer) -> ResourceUsage | None:
+        try:
+            stats = await container.docker._query_json(
+                f"containers/{container.id}/stats",
+                params={"stream": "false", "one-shot": "true"},
+            )
+        except DockerError:
+            return None
+        return parse_stats(stats)
+
+    async def read_exit(self, container: DockerContainer) -> ResourceUsage | None:
+        # Docker has no stats of stopped containers
+        return None
+
+
+def parse_stats(stats: dict[str, Any]) -> ResourceUsage | None:
+    memory = stats.get("memory_stats") or {}
+    if not memory:
+        # Stats of a stopped container are empty
+        return None
+
+    total_usage = stats.get("cpu_stats", {}).get("cpu_usage", {}).get("total_usage", 0)
+    return ResourceUsage(
+        cpu_time=timedelta(microseconds=total_usage / 1000),
+        # max_usage is reported only on cgroup v1
+        memory_peak_bytes=memory.get("max_usage") or memory.get("usage", 0),
+    )
@@ -1,28 +1,51 @@
+import hashlib
 import io
-import time
+import math
+import mmap
 import tarfile
 import pathlib
-from typing import Any, Sequence
+import types
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, AsyncIterator, Iterator, Mapping, Sequence
 from aiodocker.docker import DockerContainer
+from pydantic import BaseModel
 from runbox.models import *
+from runbox.utils import Placeholder
 
 
 __all__ = [
     'create_tarball',
+    'iter_tarball',
+    'stream_tarball',
+    'file_chunks',
+    'map_file',
+    'files_digest',
+    'canonical',
+    'TarballCache',
     'write_files',
 ]
 
+# Archives bigger than that are streamed instead of being built in memory
+STREAMING_THRESHOLD = 4 * 1024 ** 2
+
+CHUNK_SIZE = 256 * 1024
+
 
 def create_tarball(files: Sequence[File]) -> io.BytesIO:
+    """Creates a tar archive with the files.
+
+    Archive is deterministic: entries are sorted by name and have
+    a fixed mtime, so the same files always give the same bytes.
+    """
     file_obj = io.BytesIO()
-    timestamp = time.time()
     with tarfile.open(fileobj=file_obj, mode='w') as tarball:
-        for file in files:
+        for file in sorted(files, key=lambda f: f.name):
             content = file.content_bytes()
 
             file_info = tarfile.TarInfo(file.name)
             file_info.size = len(content)
-            file_info.mtime = int(timestamp)
+            file_info.mtime = 0
 
             tarball.addfile(
                 tarinfo=file_info,
@@ -32,27 +55,207 @@ def create_tarball(files: Sequence[File]) -> io.BytesIO:
     return file_obj
 
 
+def iter_tarball(files: Sequence[File], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes | memoryview]:
+    """Yields the same archive as :func:`create_tarball` chunk by chunk.
+
+    Headers are built on the fly, contents are sent as memoryview slices,
+    :class:`DiskFile` contents are memory-mapped, so memory usage doesn't
+    depend on the size of the files.
+    """
+    offset = 0
+    for file in sorted(files, key=lambda f: f.name):
+        size, chunks = _file_chunks(file, chunk_size)
+        file_info = tarfile.TarInfo(file.name)
+        file_info.size = size
+        file_info.mtime = 0
+
+        header = file_info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+        yield header
+        yield from chunks
+
+        offset += len(header) + file_info.size
+        if remainder := file_info.size % tarfile.BLOCKSIZE:
+            padding = tarfile.BLOCKSIZE - remainder
+            yield tarfile.NUL * padding
+            offset += padding
+
+    # End of archive marker, padded to a whole record
+    # exactly as tarfile.TarFile.close does
+    end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+    offset += len(end)
+    if remainder := offset % tarfile.RECORDSIZE:
+        end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+    yield end
+
+
+async def stream_tarball(files: Sequence[File], chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes | memoryview]:
+    """Async version of :func:`iter_tarball`, that can be used as a request body"""
+    for chunk in iter_tarball(files, chunk_size):
+        yield chunk
+
+
+def _file_chunks(file: File, chunk_size: int) -> tuple[int, Iterator[memoryview]]:
+    if isinstance(file, DiskFile):
+        return file.size, file_chunks(file.path, chunk_size)
+
+    view = memoryview(file.content_bytes())
+    chunks = (
+        view[start:start + chunk_size]
+        for start in range(0, len(view), chunk_size)
+    )
+    return len(view), chunks
+
+
+def map_file(path: pathlib.Path) -> memoryview:
+    """Memory-maps the file for reading.
+
+    The map is unmapped by the garbage collector once the view
+    and all slices of it are released.
+    """
+    with path.open('rb') as fileobj:
+        if path.stat().st_size == 0:
+            return memoryview(b'')
+        return memoryview(mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def file_chunks(path: pathlib.Path, chunk_size: int = CHUNK_SIZE) -> Iterator[memoryview]:
+    """Yields memoryview slices of the memory-mapped file"""
+    view = map_file(path)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def files_digest(files: Sequence[File]) -> str:
+    """Hash of the file set, that doesn't depend on the order of files"""
+    digests = sorted(_file_digest(file) for file in files)
+    return hashlib.sha256(b''.join(digests)).hexdigest()
+
+
+def _file_digest(file: File) -> bytes:
+    # Disk files are hashed chunk by chunk, they are not read in memory
+    digest = hashlib.sha256(file.name.encode('utf-8') + b'\0')
+    _, chunks = _file_chunks(file, CHUNK_SIZE)
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.digest()
+
+
+def canonical(value: Any) -> Any:
+    """
+    JSON-serializable form of the value, that is the same in every process,
+    so it can be hashed into a key. Files are replaced with digests of their
+    content, models with their fields, including excluded ones, e.g.
+    command templates of profiles.
+
+    :raises TypeError: if the value has no stable form.
+    """
+    if isinstance(value, File):
+        return {'name': value.name, 'digest': files_digest([value])}
+    if isinstance(value, BaseModel):
+        return {name: canonical(getattr(value, name)) for name in value.__fields__}
+    if isinstance(value, Mapping):
+        return {str(key): canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, Placeholder):
+        return f'_[{value.arg_num}]'
+    if isinstance(value, types.EllipsisType):
+        return '...'
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if isinstance(value, pathlib.PurePath):
+        return value.as_posix()
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    raise TypeError(f"{type(value).__qualname__} can't be hashed into a key")
+
+
+class TarballCache:
+    """
+    LRU cache of tar archives keyed by the content hashes of the files.
+    Cached archive is the same bytes object every time, so repeated
+    uploads of the same files don't build or copy the archive again.
+
+    :param max_bytes: total size of the cached archives.
+        Archives larger than that are not cached at all.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._archives: OrderedDict[str, bytes] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._archives)
+
+    def get(self, files: Sequence[File]) -> bytes:
+        key = files_digest(files)
+        if (archive := self._archives.get(key)) is not None:
+            self.hits += 1
+            self._archives.move_to_end(key)
+            return archive
+
+        self.misses += 1
+        archive = create_tarball(files).getvalue()
+        if len(archive) <= self.max_bytes:
+            self._archives[key] = archive
+            self.size += len(archive)
+            while self.size > self.max_bytes:
+                _, evicted = self._archives.popitem(last=False)
+                self.size -= len(evicted)
+
+        return archive
+
+    def clear(self) -> None:
+        self._archives.clear()
+        self.size = 0
+
+
 async def write_files(
     container: DockerContainer,
     directory: pathlib.Path,
     files: Sequence[File],
+    cache: TarballCache | None = None,
 ) -> None:
     """Transfers archived files to a docker container
+
+    Big archives and archives with :class:`DiskFile` are streamed
+    as a chunked request body, others are built in memory
+    and taken from the cache if it's given.
     """
-    tarball = create_tarball(files)
-    await container.put_archive(directory.as_posix(), tarball.getvalue())
+    if any(isinstance(file, DiskFile) for file in files) or \
+            sum(len(file.content) for file in files) > STREAMING_THRESHOLD:
+        tarball = stream_tarball(files)
+    elif cache is not None:
+        tarball = cache.get(files)
+    else:
+        tarball = create_tarball(files).getvalue()
+    await container.put_archive(directory.as_posix(), tarball)
 
 
 def create_ulimit(name: str, soft: Any, hard: Any) -> dict[str, Any]:
     return {'Name': name, 'Soft': soft, 'Hard': hard}
 
 
-def ulimits(limits: Limits):
+def cpu_ulimit(limits: Limits) -> int:
+    """Soft limit of the CPU time in seconds, it can't be less than a second"""
+    return max(1, math.ceil(limits.time.total_seconds()))
+
+
+def ulimits(limits: Limits) -> list[dict[str, Any]]:
+    # Soft limit of the CPU time sends SIGXCPU, a second later
+    # the hard limit sends SIGKILL
+    cpu_time = cpu_ulimit(limits)
     return [
-        create_ulimit(
-            'cpu',
-            int(limits.time.total_seconds()),
-            int(limits.time.total_seconds())
-        ),
+        create_ulimit('cpu', cpu_time, cpu_time + 1),
+        # Writing more than that to a single file sends SIGXFSZ
+        create_ulimit('fsize', limits.disk_space_bytes, limits.disk_space_bytes),
+        create_ulimit('nofile', limits.open_files, limits.open_files),
     ]
 
+
+def tmpfs_options(size_mb: int) -> dict[str, str]:
+    """Driver options of a local volume, that is a tmpfs of the given size"""
+    return {'type': 'tmpfs', 'device': 'tmpfs', 'o': f'size={size_mb}m'}
@@ -0,0 +1,266 @@
+import asyncio
+import json
+from collections import deque
+from contextlib import suppress
+from dataclasses import dataclass
+from functools import partial
+from pathlib import PosixPath
+from typing import Callable
+
+from aiodocker import Docker
+from aiodocker.containers import DockerContainer
+from aiodocker.exceptions import DockerError
+from aiodocker.volumes import DockerVolume
+
+from runbox.instrumentation import Instrumentation, NOOP_INSTRUMENTATION
+from .mount import Mount
+from .reaper import Reaper
+
+__all__ = [
+    "VolumePool",
+    "VolumePoolStats",
+]
+
+CLEANER_MOUNT_POINT = PosixPath("/volume")
+
+HTTP_CONFLICT = 409
+
+
+@dataclass(frozen=True)
+class VolumePoolStats:
+    hits: int
+    misses: int
+    idle: int
+    # Released volumes, that are being wiped or replaced
+    recycling: int
+
+
+class VolumePool:
+    """
+    Keeps empty docker volumes ready for ``DockerExecutor.workdir``,
+    so a pipeline run skips the create and delete round-trips.
+
+    Released volumes are recycled in the background. With a cleaner image
+    a cleaner container wipes the volume, and the volume goes back
+    to the pool. Every volume has its own cleaner container, that is
+    created on the first wipe and restarted on the next ones, it's deleted
+    together with the volume. Without a cleaner image, the volume is deleted
+    and a fresh one is created instead. Volumes are not reused if wiping fails.
+
+    A volume is recycled only when no container uses it. With a reaper
+    containers are deleted in the background, so recycling is queued to
+    the reaper after them and retried, while the volume is in use. If the
+    volume is still in use after all retries, the reaper deletes it instead.
+    Without a reaper containers are deleted before the volume is released,
+    so it's not checked.
+
+    :param min_size: number of idle volumes kept ready.
+    :param max_size: upper bound for idle volumes, released volumes
+        over it are deleted.
+    :param cleaner_image: image with ``find``, e.g. ``alpine``.
+    :param refill_interval: how often (in seconds) the pool is refilled.
+    :param timeout: timeout of a single docker call.
+    """
+
+    def __init__(
+        self,
+        min_size: int = 2,
+        max_size: int = 16,
+        cleaner_image: str | None = None,
+        refill_interval: float = 1.0,
+        timeout: int = 5,
+    ) -> None:
+        assert 0 <= min_size <= max_size, "Pool sizes must satisfy 0 <= min_size <= max_size"
+        self.min_size = min_size
+        self.max_size = max_size
+        self.cleaner_image = cleaner_image
+        self.refill_interval = refill_interval
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._docker: Docker | None = None
+        self._name_factory: Callable[[], str] | None = None
+        self._reaper: Reaper | None = None
+        self._instrumentation: Instrumentation = NOOP_INSTRUMENTATION
+        self._idle: deque[DockerVolume] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._recycling: set[asyncio.Task] = set()
+        # Volume name -> its cleaner container
+        self._cleaners: dict[str, DockerContainer] = {}
+        # Released volumes, that the reaper is recycling
+        self._reaping: set[str] = set()
+        self._closed = False
+
+    @property
+    def stats(self) -> VolumePoolStats:
+        return VolumePoolStats(
+            hits=self.hits,
+            misses=self.misses,
+            idle=self.idle,
+            recycling=len(self._recycling),
+        )
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def bind(
+        self,
+        docker: Docker,
+        name_factory: Callable[[], str],
+        reaper: Reaper | None = None,
+        instrumentation: Instrumentation = NOOP_INSTRUMENTATION,
+    ) -> None:
+        self._docker = docker
+        self._name_factory = name_factory
+        self._reaper = reaper
+        self._instrumentation = instrumentation
+
+    async def acquire(self) -> DockerVolume:
+        """Takes an idle volume or creates a new one if the pool is empty"""
+        self._wake()
+        if self._idle:
+            self.hits += 1
+            return self._idle.popleft()
+
+        self.misses += 1
+        return await self._create()
+
+    def release(self, volume: DockerVolume) -> None:
+        """Returns the volume to the pool, it's wiped in the background"""
+        if self._reaper is not None:
+            self._reaping.add(volume.name)
+            self._reaper.reap(volume.name, partial(self._recycle, volume), partial(self._recycled, volume))
+            return
+
+        task = asyncio.get_running_loop().create_task(self._recycle(volume))
+        self._recycling.add(task)
+        task.add_done_callback(self._recycling.discard)
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+        await asyncio.gather(*self._recycling, return_exceptions=True)
+        idle = list(self._idle)
+        self._idle.clear()
+        await asyncio.gather(*(self._delete(volume) for volume in idle), return_exceptions=True)
+
+    def _wake(self) -> None:
+        if self._closed:
+            return
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._maintain())
+
+    async def _maintain(self) -> None:
+        while True:
+            self._wakeup.clear()
+            missing = self.min_size - len(self._idle)
+            if missing > 0:
+                created = await asyncio.gather(
+                    *(self._create() for _ in range(missing)),
+                    return_exceptions=True,
+                )
+                self._idle.extend(volume for volume in created if isinstance(volume, DockerVolume))
+            # asyncio.wait doesn't swallow a cancellation, that comes
+            # together with the wakeup, as wait_for may do
+            wakeup = asyncio.ensure_future(self._wakeup.wait())
+            try:
+                await asyncio.wait({wakeup}, timeout=self.refill_interval)
+            finally:
+                wakeup.cancel()
+
+    async def _create(self) -> DockerVolume:
+        assert self._docker is not None and self._name_factory is not None, \
+            "Pool is not bound to an executor"
+        name = self._name_factory()
+        with self._instrumentation.span("volume_create", {"volume": name}):
+            task = self._docker.volumes.create({"Name": name, "Driver": "local"})
+            return await asyncio.wait_for(task, self.timeout)
+
+    async def _recycle(self, volume: DockerVolume) -> None:
+        """
+        :raises DockerError: with the conflict status, if a container
+            still uses the volume, so the reaper retries later.
+        """
+        if self._reaper is not None:
+            if await self._in_use(volume):
+                raise DockerError(HTTP_CONFLICT, {"message": f"Volume {volume.name} is in use"})
+            self._reaping.discard(volume.name)
+
+        reusable = not self._closed and self.cleaner_image is not None and len(self._idle) < self.max_size
+        if not reusable or not await self._wipe(volume):
+            await self._delete(volume)
+            self._wake()
+            return
+
+        self._idle.append(volume)
+
+    def _recycled(self, volume: DockerVolume) -> None:
+        if volume.name not in self._reaping:
+            return
+
+        # The reaper gave up, while a container was still using the volume
+        self._reaping.discard(volume.name)
+        self._reaper.reap(volume.name, partial(self._delete, volume))
+
+    async def _in_use(self, volume: DockerVolume) -> bool:
+        containers = await self._docker.containers.list(
+            all="true",
+            filters=json.dumps({"volume": [volume.name]}),
+        )
+        cleaner = self._cleaners.get(volume.name)
+        return any(cleaner is None or container.id != cleaner.id for container in containers)
+
+    async def _wipe(self, volume: DockerVolume) -> bool:
+        try:
+            container = self._cleaners.get(volume.name) or await self._create_cleaner(volume)
+        except (DockerError, asyncio.TimeoutError):
+            return False
+
+        try:
+            await container.start()
+            result = await asyncio.wait_for(container.wait(), self.timeout)
+            if result.get("StatusCode") == 0:
+                return True
+        except (DockerError, asyncio.TimeoutError):
+            pass
+        await self._delete_cleaner(volume)
+        return False
+
+    async def _create_cleaner(self, volume: DockerVolume) -> DockerContainer:
+        mount = Mount(volume=volume, bind=CLEANER_MOUNT_POINT)
+        config = {
+            "Image": self.cleaner_image,
+            "Cmd": ["find", CLEANER_MOUNT_POINT.as_posix(), "-mindepth", "1", "-delete"],
+            "User": "root",
+            "NetworkDisabled": True,
+            "HostConfig": {"Mounts": [mount.dump()]},
+        }
+        container = await asyncio.wait_for(
+            self._docker.containers.create(config, name=self._name_factory()),
+            self.timeout,
+        )
+        self._cleaners[volume.name] = container
+        return container
+
+    async def _delete_cleaner(self, volume: DockerVolume) -> None:
+        if (container := self._cleaners.pop(volume.name, None)) is not None:
+            with suppress(DockerError):
+                await container.delete(force=True)
+
+    async def _delete(self, volume: DockerVolume) -> None:
+        await self._delete_cleaner(volume)
+        try:
+            with self._instrumentation.span("volume_delete", {"volume": volume.name}):
+                await volume.delete()
+        except DockerError as e:
+            # Reaper retries volumes, that are still in use
+            if e.status == HTTP_CONFLICT and self._reaper is not None:
+                raise
@@ -0,0 +1,189 @@
+import bisect
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Any, ContextManager, Protocol, Sequence
+
+__all__ = [
+    "Instrumentation",
+    "NoopInstrumentation",
+    "NOOP_INSTRUMENTATION",
+    "PrometheusHistograms",
+    "Span",
+    "SpanRecorder",
+    "TracerInstrumentation",
+]
+
+Tags = dict[str, str | None]
+
+
+class Instrumentation(Protocol):
+    """
+    Receives timed spans of docker calls and pipeline stages.
+
+    Span names are docker calls: ``create``, ``put_archive``, ``start``,
+    ``attach``, ``wait``, ``inspect``, ``kill``, ``delete``,
+    ``volume_create``, ``volume_delete``, and ``stage`` for setup
+    of a pipeline stage. Tags are ``container``, ``image``, ``volume``,
+    ``group`` and ``stage``, a span has only those, that make sense for it.
+    Tags dicts are shared between calls and must not be changed.
+    """
+
+    def span(self, name: str, tags: Tags) -> ContextManager[Any]:
+        ...
+
+
+class NoopInstrumentation:
+    """Default instrumentation, that records nothing"""
+
+    _context = nullcontext()
+
+    def span(self, name: str, tags: Tags) -> ContextManager[Any]:
+        return self._context
+
+
+NOOP_INSTRUMENTATION = NoopInstrumentation()
+
+
+class _Timer:
+    __slots__ = ("_histograms", "_name", "_tags", "_started")
+
+    def __init__(self, histograms: "PrometheusHistograms", name: str, tags: Tags):
+        self._histograms = histograms
+        self._name = name
+        self._tags = tags
+
+    def __enter__(self) -> None:
+        self._started = time.perf_counter()
+
+    def __exit__(self, *_) -> None:
+        self._histograms.observe(self._name, self._tags, time.perf_counter() - self._started)
+
+
+@dataclass
+class _Histogram:
+    buckets: list[int]
+    count: int = 0
+    sum: float = 0.0
+
+
+class PrometheusHistograms:
+    """
+    Histograms of span durations, rendered in the Prometheus text
+    exposition format by :meth:`render`, e.g. to be served on
+    a ``/metrics`` endpoint.
+
+    Spans are labeled by their name and the given tags. Container names
+    are unique, so they are not used as a label by default.
+
+    :param buckets: upper bounds of the buckets in seconds.
+    :param labels: tags used as labels.
+    """
+
+    metric = "runbox_span_duration_seconds"
+
+    def __init__(
+        self,
+        buckets: Sequence[float] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+        labels: Sequence[str] = ("image", "group", "stage"),
+    ) -> None:
+        self.buckets = sorted(buckets)
+        self.labels = tuple(labels)
+        self._histograms: dict[tuple[str, ...], _Histogram] = {}
+
+    def span(self, name: str, tags: Tags) -> ContextManager[Any]:
+        return _Timer(self, name, tags)
+
+    def observe(self, name: str, tags: Tags, seconds: float) -> None:
+        key = (name, *(tags.get(label) or "" for label in self.labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = _Histogram([0] * len(self.buckets))
+
+        idx = bisect.bisect_left(self.buckets, seconds)
+        if idx < len(self.buckets):
+            histogram.buckets[idx] += 1
+        histogram.count += 1
+        histogram.sum += seconds
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.metric} Duration of docker calls and pipeline stages.",
+            f"# TYPE {self.metric} histogram",
+        ]
+        for (name, *values), histogram in sorted(self._histograms.items()):
+            labels = ",".join(
+                f'{label}="{_escape(value)}"'
+                for label, value in zip(("span", *self.labels), (name, *values))
+                if value
+            )
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.buckets):
+                cumulative += count
+                lines.append(f'{self.metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"{self.metric}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{self.metric}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class TracerInstrumentation:
+    """
+    Emits spans to an OpenTelemetry tracer, e.g.
+    ``opentelemetry.trace.get_tracer("runbox")``. Any object with
+    an OpenTelemetry compatible ``start_as_current_span`` will do,
+    so opentelemetry is not a dependency of runbox.
+    """
+
+    def __init__(self, tracer: Any, prefix: str = "docker.") -> None:
+        self.tracer = tracer
+        self.prefix = prefix
+
+    def span(self, name: str, tags: Tags) -> ContextManager[Any]:
+        attributes = {f"runbox.{key}": value for key, value in tags.items() if value is not None}
+        return self.tracer.start_as_current_span(self.prefix + name, attributes=attributes)
+
+
+@dataclass
+class Span:
+    name: str
+    tags: Tags
+    # Seconds of time.perf_counter()
+    start: float
+    end: float | None = None
+    error: BaseException | None = field(default=None, repr=False)
+
+    @property
+    def duration(self) -> float | None:
+        return None if self.end is None else self.end - self.start
+
+
+class _RecordedSpan:
+    __slots__ = ("_recorder", "_span")
+
+    def __init__(self, recorder: "SpanRecorder", name: str, tags: Tags):
+        self._recorder = recorder
+        self._span = Span(name, tags, 0.0)
+
+    def __enter__(self) -> Span:
+        self._span.start = time.perf_counter()
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._span.end = time.perf_counter()
+        self._span.error = exc
+        self._recorder.spans.append(self._span)
+
+
+class SpanRecorder:
+    """Keeps finished spans in memory, e.g. to log the slow ones of a submission"""
+
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+
+    def span(self, name: str, tags: Tags) -> ContextManager[Any]:
+        return _RecordedSpan(self, name, tags)
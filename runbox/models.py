@@ -6,7 +6,7 @@ from typing import Literal, Sequence, cast
 
 from pydantic import BaseModel, Field
 
-__all__ = ["File", "DockerProfile", "Limits", "SandboxState"]
+__all__ = ["File", "DiskFile", "DockerProfile", "Limits", "SandboxState"]
 
 from runbox.utils import Placeholder
 
@@ -25,16 +25,37 @@ class File(BaseModel):
         :return: either unmodified binary or text encoded in utf-8
         :rtype: str | bytes
         """
-        if self.type == "binary":
+        # Binary content, that is valid utf-8, is coerced to str by pydantic
+        if isinstance(self.content, bytes):
             return self.content
         else:
             return self.content.encode("utf-8")
 
 
+class DiskFile(File):
+    """File, that is read from the disk only when it is written to a sandbox.
+    Large files are streamed to a container without loading them in memory.
+    """
+    path: pathlib.Path
+    content: str | bytes = b''
+    type: Literal["binary", "text"] = "binary"
+
+    @property
+    def size(self) -> int:
+        return self.path.stat().st_size
+
+    def content_bytes(self):
+        return self.path.read_bytes()
+
+
 class DockerProfile(BaseModel):
     image: str
     workdir: pathlib.Path | None = None
     user: str | None = None
+    # Workdir is a tmpfs of Limits.disk_space_mb size. Docker doesn't copy
+    # files written before the start into a tmpfs, so sandboxes with files
+    # or a volume mounted at the workdir keep it on the disk
+    tmpfs_workdir: bool = False
     cmd_template: list[str | types.EllipsisType | Placeholder] | None = Field(None, exclude=True)
 
     class Config:
@@ -73,6 +94,15 @@ class Limits(BaseModel):
     memory_mb: int = 64
     cpu_count: int = 1
     disk_space_mb: int = 256
+    # Per stream limit for stdout and stderr read from a sandbox, unlimited if None
+    output_bytes: int | None = None
+    # Number of processes and threads a sandbox can run, unlimited if None
+    pids: int | None = None
+    open_files: int = 256
+    # With "cpu" the time limit is applied to CPU time of the sandbox,
+    # and wall time is limited only by wall_time (twice the time by default)
+    time_measure: Literal["wall", "cpu"] = "wall"
+    wall_time: timedelta | None = None
 
     class Config:
         frozen = True
@@ -81,6 +111,16 @@ class Limits(BaseModel):
     def memory_bytes(self) -> int:
         return self.memory_mb * 1024 ** 2
 
+    @property
+    def disk_space_bytes(self) -> int:
+        return self.disk_space_mb * 1024 ** 2
+
+    @property
+    def wall_time_limit(self) -> timedelta:
+        if self.time_measure == "wall":
+            return self.time
+        return self.wall_time or self.time * 2
+
 
 class SandboxState(BaseModel):
     status: str = Field(..., alias="Status")
@@ -89,6 +129,11 @@ class SandboxState(BaseModel):
     finished_at: datetime | None = Field(None, alias="FinishedAt")
     memory_limit: bool = Field(..., alias="OOMKilled")
     cpu_limit: bool = Field(..., alias="CpuLimit")
+    output_limit: bool = Field(False, alias="OutputLimit")
+    disk_limit: bool = Field(False, alias="DiskLimit")
+    # Known only if the executor measures resource usage
+    cpu_time: timedelta | None = Field(None, alias="CpuTime")
+    memory_peak: int | None = Field(None, alias="MemoryPeak")
 
     @property
     def duration(self) -> timedelta:
@@ -19,6 +19,11 @@ class SandboxInput(Protocol):
 
 
 class SandboxOutput(Protocol):
+    """
+    Outputs of docker sandboxes also have ``read_view``, that returns
+    data as memoryview without copying it, see
+    :func:`runbox.docker.demux.view_reader`.
+    """
 
     async def read_out(self) -> Message | None:
         ...
@@ -1,6 +1,7 @@
 from typing import Sequence, AsyncIterable
 
 from runbox import DockerExecutor, Mount
+from runbox.docker.demux import OutputDecoder, view_reader
 from runbox.models import File, DockerProfile, Limits
 
 __all__ = ['execute']
@@ -27,10 +28,14 @@ async def execute(
 
     async with sandbox:
         io = await sandbox.run(stdin=stdin)
-        while message := await io.read_out():
-            if (message.stream == stdout and attach_stdout) or \
-               (message.stream == stderr and attach_stderr):
-                yield message.data.decode()
+        decoder = OutputDecoder()
+        attached = {stdout: attach_stdout, stderr: attach_stderr}
+        read = view_reader(io)
+        while message := await read():
+            if attached.get(message.stream) and (text := decoder.decode(message.stream, message.data)):
+                yield text
+        for _, text in decoder.flush():
+            yield text
         await sandbox.wait()
 
     if need_to_close_executor:
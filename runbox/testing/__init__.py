@@ -1,3 +1,7 @@
 from runbox.testing import proto
-from .test_case import IOTestCase
+from .test_case import IOTestCase, FileTestCase
+from .checker import Checker, CheckerTestCase
+from .test_set import TestSet
+from .result_cache import MemoryResultCache, SqliteResultCache
 from .test_suite import BaseTestSuite
+from .batch import BatchTestSuite
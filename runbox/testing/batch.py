@@ -0,0 +1,611 @@
+from __future__ import annotations
+
+import asyncio
+import re
+from collections import deque
+from contextlib import suppress
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+
+from aiodocker import DockerError
+
+from runbox import DockerExecutor, SandboxBuilder
+from runbox.docker.demux import view_reader
+from runbox.docker.sandbox import EXIT_SIGXCPU, EXIT_SIGXFSZ
+from runbox.docker.utils import cpu_ulimit
+from runbox.models import DockerProfile, File, Limits, SandboxState
+from .proto import TestResult, TestStatus
+from .test_case import IOTestCase
+from .test_suite import _FailFast
+from ..proto import Sandbox, SandboxIO
+
+__all__ = [
+    "BatchTestSuite",
+    "BatchFrame",
+    "BatchReader",
+    "DRIVER_SCRIPT",
+]
+
+EXIT_SIGKILL = 128 + 9
+
+BATCH_DIR = "/runbox-batch"
+
+# Tests are run as this user, if the profile has no user or a root one
+SOLUTION_USER = "65534"
+
+# Headers of the driver are much shorter, they are searched for in
+# windows of that size
+HEADER_WINDOW = 512
+
+# Runs the command once per input and writes framed results to stdout.
+# The driver runs as root and the tests as another user, who can't read
+# the inputs or the memory of the driver. The first line of the output
+# is a random nonce, unknown to the tests. Then the stdout of every test
+# is passed through as it is written, followed by a trailer, that starts
+# with the nonce, and the beginning of the stderr of the test. A test
+# can't forge a trailer, because it doesn't know the nonce. CPU time and
+# OOM kills are taken from the container's cgroup, so every test is
+# accounted separately.
+DRIVER_SCRIPT = r"""
+dir=$1
+count=$2
+limit=$3
+cpu=$4
+fsize=$5
+excerpt=$6
+user=$7
+group=$8
+shift 8
+
+if [ "$(id -u)" != 0 ]; then
+    echo "Batch driver must run as root" >&2
+    exit 1
+fi
+
+[ -n "$group" ] || group=$(id -g "$user" 2>/dev/null || echo "$user")
+if command -v setpriv > /dev/null 2>&1; then
+    drop="setpriv --reuid=$user --regid=$group --clear-groups"
+else
+    drop="chroot --skip-chdir --userspec=$user:$group /"
+fi
+if ! $drop true; then
+    echo "Can't run tests as $user:$group" >&2
+    exit 1
+fi
+
+# Inputs of the other tests must not be readable by a test
+chmod 700 "$dir"
+[ "$PWD" = / ] || chown "$user:$group" . 2>/dev/null
+
+cgroup=/sys/fs/cgroup
+out=$(mktemp -d)
+nonce=$(od -An -N16 -tx1 /dev/urandom | tr -d ' \n')
+
+cgroup_stat() {
+    value=$(sed -n "s/^$2 //p" "$cgroup/$1" 2>/dev/null)
+    echo "${value:--1}"
+}
+
+now() {
+    value=$(date +%s%N 2>/dev/null)
+    case "$value" in
+        ''|*[!0-9]*) echo -1 ;;
+        *) echo "$value" ;;
+    esac
+}
+
+peak() {
+    cat "$cgroup/memory.peak" 2>/dev/null || cat "$cgroup/memory.current" 2>/dev/null || echo -1
+}
+
+echo RUNBOX-BATCH "$nonce"
+i=0
+while [ "$i" -lt "$count" ]; do
+    cpu_start=$(cgroup_stat cpu.stat usage_usec)
+    oom_start=$(cgroup_stat memory.events oom_kill)
+    start=$(now)
+    # Only timeout writes to its stderr: it reports the kill, that it sends,
+    # the test writes to its own stderr
+    (ulimit -S -t "$cpu" && exec timeout -v -s KILL "$limit" $drop sh -c 'exec "$@" 2>&3 3>&-' sh "$@") \
+        < "$dir/$i.in" 3> "$out/stderr" 2> "$out/timeout"
+    code=$?
+    end=$(now)
+    # Background processes of the test must not outlive it
+    $drop sh -c 'kill -KILL -1' 2> /dev/null
+    cpu_end=$(cgroup_stat cpu.stat usage_usec)
+    oom_end=$(cgroup_stat memory.events oom_kill)
+    # A file of the limit size is left by a write, that went over it
+    file_limit=0
+    if [ "$code" -eq 153 ] && \
+        [ -n "$(find . /tmp -xdev -type f -size +$((fsize - 1))c 2>/dev/null | head -n 1)" ]; then
+        file_limit=1
+    fi
+    timed_out=0
+    if [ "$code" -eq 137 ] && grep -q KILL "$out/timeout"; then
+        timed_out=1
+    fi
+    head -c "$excerpt" "$out/stderr" > "$out/excerpt"
+    printf '\nRUNBOX-BATCH-%s %s %s %s %s %s %s %s %s %s %s %s %s\n' "$nonce" "$i" "$code" \
+        "$start" "$end" "$cpu_start" "$cpu_end" "$oom_start" "$oom_end" "$(peak)" \
+        "$file_limit" "$timed_out" $(wc -c < "$out/excerpt")
+    cat "$out/excerpt"
+    i=$((i + 1))
+done
+rm -rf "$out"
+"""
+
+
+@dataclass(frozen=True)
+class BatchFrame:
+    """Result of a single test run by the batch driver"""
+    index: int
+    exit_code: int
+    started_at: datetime | None
+    finished_at: datetime | None
+    cpu_time: timedelta | None
+    oom_killed: bool
+    # Peak memory of the whole batch container so far
+    memory_peak: int | None
+    # A file of the disk space limit size was found after the test
+    file_limit: bool
+    # The test was killed by the wall time limit of the driver
+    timed_out: bool
+    stderr_size: int
+
+    @classmethod
+    def parse(cls, trailer: bytes) -> BatchFrame:
+        """Parses the trailer of a test without the nonce"""
+        index, code, start, end, cpu_start, cpu_end, oom_start, oom_end, peak, file_limit, timed_out, \
+            stderr = map(int, trailer.split())
+
+        known = start >= 0 and end >= 0
+        return cls(
+            index=index,
+            exit_code=code,
+            started_at=_from_ns(start) if known else None,
+            finished_at=_from_ns(end) if known else None,
+            cpu_time=(
+                timedelta(microseconds=cpu_end - cpu_start)
+                if cpu_start >= 0 and cpu_end >= 0 else None
+            ),
+            oom_killed=oom_end > oom_start,
+            memory_peak=peak if peak >= 0 else None,
+            file_limit=bool(file_limit),
+            timed_out=bool(timed_out),
+            stderr_size=stderr,
+        )
+
+
+def _from_ns(ns: int) -> datetime:
+    return datetime.fromtimestamp(ns / 1e9, tz=timezone.utc)
+
+
+class BatchReader:
+    """
+    Splits the output of the batch driver into tests. Output may be
+    fed in chunks of any size, stdout of the tests is passed on as it
+    arrives without being buffered.
+    """
+
+    def __init__(self) -> None:
+        self._line = bytearray()
+        self._separator: bytes | None = None
+        self._pattern: re.Pattern | None = None
+        # Beginning of a separator at the end of the previous chunk
+        self._held = b""
+        self._in_trailer = False
+        self._frame: BatchFrame | None = None
+        self._left = 0
+        self._index = 0
+
+    def feed(
+        self, data: bytes | memoryview,
+    ) -> Iterator[tuple[int, int | None, bytes | memoryview | BatchFrame]]:
+        """
+        Yields ``(index, stream, chunk)`` for every piece of stdout (1)
+        or stderr (2) of the test with the index and
+        ``(index, None, frame)`` when the output of the test is over.
+        """
+        pos = 0
+        while pos < len(data):
+            if self._separator is None or self._in_trailer:
+                pos = self._read_line(data, pos)
+            elif self._frame is not None:
+                chunk = data[pos:pos + self._left]
+                pos += len(chunk)
+                self._left -= len(chunk)
+                yield self._index, 2, chunk
+            else:
+                chunk, pos = self._read_stdout(data, pos)
+                if chunk:
+                    yield self._index, 1, chunk
+
+            if self._frame is not None and not self._left:
+                yield self._index, None, self._frame
+                self._frame = None
+                self._index += 1
+
+    def _read_line(self, data: bytes | memoryview, pos: int) -> int:
+        # Output may be a memoryview, that can't be searched,
+        # so the line is looked for in a small copy
+        window = bytes(data[pos:pos + HEADER_WINDOW])
+        end = window.find(b"\n")
+        if end == -1:
+            self._line += window
+            return pos + len(window)
+
+        self._line += window[:end]
+        line = bytes(self._line)
+        self._line.clear()
+        if self._separator is None:
+            marker, nonce = line.split()
+            assert marker == b"RUNBOX-BATCH", "Not a batch driver output"
+            self._separator = b"\nRUNBOX-BATCH-" + nonce + b" "
+            self._pattern = re.compile(re.escape(self._separator))
+        else:
+            self._in_trailer = False
+            self._frame = BatchFrame.parse(line)
+            self._left = self._frame.stderr_size
+            assert self._frame.index == self._index, "Batch frames are out of order"
+        return pos + end + 1
+
+    def _read_stdout(self, data: bytes | memoryview, pos: int) -> tuple[bytes | memoryview, int]:
+        separator = self._separator
+        if self._held:
+            probe = self._held + bytes(data[pos:pos + len(separator) - len(self._held)])
+            if separator.startswith(probe):
+                pos += len(probe) - len(self._held)
+                self._held = probe
+                if probe == separator:
+                    self._held = b""
+                    self._in_trailer = True
+                return b"", pos
+
+            # Separator has a newline only at the start, so
+            # no other separator can begin in the held bytes
+            held, self._held = self._held, b""
+            return held, pos
+
+        if match := self._pattern.search(data, pos):
+            self._in_trailer = True
+            return data[pos:match.start()], match.end()
+
+        # The end of the chunk may be the beginning of a separator
+        tail_start = max(pos, len(data) - len(separator) + 1)
+        tail = bytes(data[tail_start:])
+        newline = tail.rfind(b"\n")
+        if newline != -1 and separator.startswith(tail[newline:]):
+            self._held = tail[newline:]
+            return data[pos:tail_start + newline], len(data)
+        return data[pos:], len(data)
+
+
+class BatchTestSuite:
+    """
+    Runs many tests in one container start. All inputs of a batch are
+    uploaded at once and a small shell driver runs the command of the
+    profile once per input, so the start, attach and wait round-trips
+    are paid once per batch instead of once per test.
+
+    Results are the same as :class:`IOTestCase` would give for every
+    test separately. If the container dies in the middle of a batch,
+    the rest of the batch is run again in a new container.
+
+    The image must have ``sh``, ``grep``, coreutils ``timeout`` and either
+    ``setpriv`` or coreutils ``chroot``. The driver runs as root and every test runs as
+    the user of the profile, or as ``nobody``, if it's root or not set,
+    so a test can't read inputs of the other tests or forge their results.
+
+    Output of a test is compared as it arrives. A test, that goes over
+    the output limit, or fails with ``fail_fast``, is stopped at once,
+    and the rest of the batch is run in a new container.
+
+    :param sandbox_factory: builder of the sandbox with a command profile.
+    :param batch_size: number of tests run in one container.
+    :param concurrency: number of batches run at the same time.
+    :param fail_fast: stop after the first non-OK result.
+    """
+
+    # Time given to a batch container on top of the time limits of its tests
+    batch_overhead = timedelta(seconds=5)
+
+    def __init__(
+        self,
+        sandbox_factory: SandboxBuilder,
+        batch_size: int = 256,
+        concurrency: int = 1,
+        fail_fast: bool = False,
+    ) -> None:
+        assert batch_size > 0 and concurrency > 0
+        self.builder = sandbox_factory
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.fail_fast = fail_fast
+        self.tests: list[IOTestCase] = []
+
+    def add_tests(self, *tests: IOTestCase) -> BatchTestSuite:
+        self.tests.extend(tests)
+        return self
+
+    def remove_test(self, test: IOTestCase) -> bool:
+        try:
+            self.tests.remove(test)
+            return True
+        except ValueError:
+            return False
+
+    async def exec(self, executor: DockerExecutor) -> list[TestResult]:
+        results: list[TestResult | None] = [None] * len(self.tests)
+        indices = list(range(len(self.tests)))
+        pending = deque(
+            indices[start:start + self.batch_size]
+            for start in range(0, len(indices), self.batch_size)
+        )
+
+        workers = [
+            asyncio.create_task(self._worker(executor, pending, results))
+            for _ in range(min(self.concurrency, len(pending)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        except _FailFast:
+            pass
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        return [
+            result or TestResult(
+                status=TestStatus.skipped,
+                why="Skipped after an earlier failure",
+                duration=None,
+            )
+            for result in results
+        ]
+
+    async def _worker(
+        self,
+        executor: DockerExecutor,
+        pending: deque[list[int]],
+        results: list[TestResult | None],
+    ) -> None:
+        while pending:
+            batch = pending.popleft()
+            while batch:
+                done = await self._exec_batch(executor, batch, results)
+                if self.fail_fast and any(
+                    results[idx].status != TestStatus.ok for idx in batch[:done]
+                ):
+                    pending.clear()
+                    raise _FailFast()
+                batch = batch[done:]
+
+    async def _exec_batch(
+        self,
+        executor: DockerExecutor,
+        batch: list[int],
+        results: list[TestResult | None],
+    ) -> int:
+        """
+        Runs the tests in one container.
+
+        :return: number of tests from the beginning of the batch,
+            that got their results.
+        """
+        tests = [self.tests[idx] for idx in batch]
+        excerpt = max(
+            # One more byte tells a longer stderr from the expected one
+            max(test.stderr_excerpt_size, len(test.expected_stderr) + 1)
+            for test in tests
+        )
+        builder = self.builder \
+            .with_profile(self._driver_profile(len(tests), excerpt)) \
+            .with_limits(self._batch_limits(len(tests), excerpt))
+
+        sandbox = await builder.create(executor)
+        async with sandbox:
+            await sandbox.write_files("/", *self._batch_files(tests))
+            reader = await sandbox.run()
+            output = asyncio.create_task(self._collect(sandbox, reader, tests))
+            try:
+                await sandbox.wait()
+                batch_results, driver_stderr = await output
+            except asyncio.CancelledError:
+                with suppress(DockerError):
+                    await sandbox.kill()
+                raise
+            finally:
+                output.cancel()
+
+            for idx, result in zip(batch, batch_results):
+                results[idx] = result
+
+            if batch_results:
+                return len(batch_results)
+
+            # The first test has brought the whole container down
+            state = await sandbox.state()
+            if state.cpu_limit or state.memory_limit or state.output_limit:
+                result = IOTestCase._check(False, False, b"", state)
+            else:
+                result = TestResult(
+                    status=TestStatus.server_error,
+                    why=b"Batch driver has failed: " + driver_stderr,
+                    duration=None,
+                )
+            results[batch[0]] = result
+            return 1
+
+    async def _collect(
+        self,
+        sandbox: Sandbox,
+        reader: SandboxIO,
+        tests: list[IOTestCase],
+    ) -> tuple[list[TestResult], bytes]:
+        batch_reader = BatchReader()
+        results: list[TestResult] = []
+        driver_stderr = bytearray()
+        comparators = None
+        matches = True
+        stderr = bytearray()
+        stdout_size = 0
+        started_at = datetime.now(tz=timezone.utc)
+        limits = self.builder.limits
+
+        read = view_reader(reader)
+        while message := await read():
+            if message.stream == 2:
+                driver_stderr += message.data[:4096 - len(driver_stderr)]
+                continue
+            if message.stream != 1:
+                continue
+
+            for index, stream, chunk in batch_reader.feed(message.data):
+                test = tests[index]
+                if comparators is None:
+                    comparators = test.comparators()
+                    matches = True
+                    stderr.clear()
+                    stdout_size = 0
+                    started_at = datetime.now(tz=timezone.utc)
+
+                if stream is None:
+                    matches = matches and all(
+                        comparator.finish()
+                        for comparator in comparators
+                        if comparator is not None
+                    )
+                    results.append(self._result(test, chunk, matches, bytes(stderr)))
+                    comparators = None
+                    if self.fail_fast and results[-1].status != TestStatus.ok:
+                        with suppress(DockerError):
+                            await sandbox.kill()
+                        return results, bytes(driver_stderr)
+                    continue
+
+                if stream == 2:
+                    stderr += chunk
+                else:
+                    stdout_size += len(chunk)
+                comparator = comparators[stream - 1]
+                if matches and comparator is not None:
+                    matches = comparator.feed(chunk)
+
+                output_limit = limits.output_bytes is not None and stdout_size > limits.output_bytes
+                if output_limit or (self.fail_fast and not matches):
+                    # The test is still running, it's stopped with the batch
+                    results.append(self._aborted(test, started_at, output_limit))
+                    with suppress(DockerError):
+                        await sandbox.kill()
+                    return results, bytes(driver_stderr)
+
+        return results, bytes(driver_stderr)
+
+    def _result(
+        self,
+        test: IOTestCase,
+        frame: BatchFrame,
+        matches: bool,
+        stderr: bytes,
+    ) -> TestResult:
+        limits = self.builder.limits
+        if limits.time_measure == "cpu" and frame.cpu_time is not None:
+            measured = frame.cpu_time
+        elif frame.started_at is not None:
+            measured = frame.finished_at - frame.started_at
+        else:
+            measured = frame.cpu_time
+
+        finished_at = frame.finished_at or datetime.now(tz=timezone.utc)
+        state = SandboxState.parse_obj({
+            "Status": "exited",
+            "ExitCode": frame.exit_code,
+            "StartedAt": frame.started_at or finished_at,
+            "FinishedAt": finished_at,
+            "OOMKilled": frame.oom_killed,
+            "CpuLimit": (
+                (frame.exit_code == EXIT_SIGXCPU and self._cpu_ulimit_reached(frame))
+                or (frame.exit_code == EXIT_SIGKILL and frame.timed_out)
+                or (measured is not None and measured > limits.time)
+            ),
+            # Output limit stops a test before its frame is over
+            "OutputLimit": False,
+            # A program can exit with this code on its own
+            "DiskLimit": frame.exit_code == EXIT_SIGXFSZ and frame.file_limit,
+            "CpuTime": frame.cpu_time,
+            "MemoryPeak": frame.memory_peak,
+        })
+        return test._check(matches, False, stderr[:test.stderr_excerpt_size], state)
+
+    def _cpu_ulimit_reached(self, frame: BatchFrame) -> bool:
+        limits = self.builder.limits
+        if frame.cpu_time is not None:
+            cpu_time = frame.cpu_time.total_seconds()
+        elif frame.started_at is not None:
+            # CPU time can't be more than that
+            cpu_time = (frame.finished_at - frame.started_at).total_seconds() * limits.cpu_count
+        else:
+            return False
+        return cpu_time >= cpu_ulimit(limits)
+
+    @staticmethod
+    def _aborted(test: IOTestCase, started_at: datetime, output_limit: bool) -> TestResult:
+        state = SandboxState.parse_obj({
+            "Status": "exited",
+            "ExitCode": EXIT_SIGKILL,
+            "StartedAt": started_at,
+            "FinishedAt": datetime.now(tz=timezone.utc),
+            "OOMKilled": False,
+            "CpuLimit": False,
+            "OutputLimit": output_limit,
+        })
+        return test._check(False, True, b"", state)
+
+    def _driver_timeout(self) -> float:
+        return self.builder.limits.wall_time_limit.total_seconds()
+
+    def _driver_profile(self, count: int, excerpt: int) -> DockerProfile:
+        profile = self.builder.profile
+        assert profile is not None and profile.cmd_template is not None, \
+            "Batch mode requires a profile with a command"
+
+        user, _, group = (profile.user or "").partition(":")
+        if user in ("", "0", "root"):
+            user, group = SOLUTION_USER, SOLUTION_USER
+
+        limits = self.builder.limits
+        return profile.copy(update={
+            "user": "0",
+            "cmd_template": [
+                "sh", f"{BATCH_DIR}/driver.sh", BATCH_DIR, str(count),
+                f"{self._driver_timeout():.3f}", str(cpu_ulimit(limits)),
+                str(limits.disk_space_bytes), str(excerpt), user, group,
+                *profile.cmd_template,
+            ],
+        })
+
+    def _batch_limits(self, count: int, excerpt: int) -> Limits:
+        limits = self.builder.limits
+        return limits.copy(update={
+            "time": timedelta(seconds=self._driver_timeout() * count) + self.batch_overhead,
+            "time_measure": "wall",
+            "wall_time": None,
+            # Frame trailers are short, 256 bytes is more than enough
+            "output_bytes": (
+                (limits.output_bytes + excerpt + 256) * count
+                if limits.output_bytes is not None else None
+            ),
+        })
+
+    @staticmethod
+    def _batch_files(tests: list[IOTestCase]) -> list[File]:
+        directory = BATCH_DIR.lstrip("/")
+        return [
+            File(name=f"{directory}/driver.sh", content=DRIVER_SCRIPT),
+            *(
+                test.input_file(f"{directory}/{idx}.in")
+                for idx, test in enumerate(tests)
+            ),
+        ]
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import json
+import tempfile
+from contextlib import AsyncExitStack
+from pathlib import Path, PosixPath
+from typing import Any, Callable
+
+from runbox import DockerExecutor, SandboxBuilder
+from runbox.docker.demux import view_reader
+from runbox.docker.utils import canonical
+from runbox.models import DiskFile, File
+from .comparators import OutputComparator, OutputSpool, TokenComparator
+from .proto import TestResult, TestStatus
+from .test_case import IOTestCase
+from ..proto import Sandbox
+
+__all__ = [
+    "Checker",
+    "CheckerTestCase",
+]
+
+
+class Checker:
+    """
+    Checker program run in its own sandbox. The sandbox is created once
+    and started again for every check. Input of the test, the output of
+    the solution and the expected answer are put into a volume mounted
+    into the sandbox, their paths are appended to the command of the
+    profile in the testlib order: ``input output answer``.
+
+    Exit codes follow testlib as well: 0 is accepted, 1 and 2 are wrong
+    answers, anything else is a failure of the checker.
+    Checks are run one by one, because they share the sandbox.
+
+    Usage::
+
+        async with Checker(executor, builder) as checker:
+            suite.add_tests(CheckerTestCase(stdin, expected, checker=checker))
+            await suite.exec(executor)
+
+    :param executor: executor the checker sandbox is created with.
+    :param sandbox_factory: builder of the checker sandbox.
+    :param data_dir: where the volume with the files is mounted.
+    """
+
+    # Only the beginning of the checker's output is kept as a comment
+    comment_size = 4096
+
+    def __init__(
+        self,
+        executor: DockerExecutor,
+        sandbox_factory: SandboxBuilder,
+        data_dir: PosixPath = PosixPath("/check"),
+    ):
+        self.executor = executor
+        self.builder = sandbox_factory
+        self.data_dir = data_dir
+        self._sandbox: Sandbox | None = None
+        self._stack = AsyncExitStack()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self) -> Checker:
+        profile = self.builder.profile
+        assert profile is not None and profile.cmd_template is not None, \
+            "Checker requires a profile with a command"
+
+        try:
+            volume = await self._stack.enter_async_context(self.executor.workdir())
+            builder = self.builder \
+                .with_profile(profile.copy(update={
+                    "cmd_template": [
+                        *profile.cmd_template,
+                        *(str(self.data_dir / name) for name in ("input", "output", "answer")),
+                    ],
+                })) \
+                .mount(volume, self.data_dir)
+            sandbox = await builder.create(self.executor)
+            self._sandbox = await self._stack.enter_async_context(sandbox)
+        except BaseException:
+            await self._stack.aclose()
+            raise
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        self._sandbox = None
+        await self._stack.aclose()
+
+    async def check(self, test_input: File, answer: File, output: Path) -> tuple[TestStatus, bytes]:
+        """
+        Runs the checker on the output stored in a file.
+
+        :return: verdict and the comment of the checker.
+        """
+        assert self._sandbox is not None, "Checker is not started"
+        async with self._lock:
+            await self._sandbox.write_files(
+                self.data_dir,
+                test_input.copy(update={"name": "input"}),
+                answer.copy(update={"name": "answer"}),
+                DiskFile(name="output", path=output),
+            )
+            reader = await self._sandbox.run()
+            comment = bytearray()
+            read = view_reader(reader)
+            while message := await read():
+                comment += message.data[:self.comment_size - len(comment)]
+            await self._sandbox.wait()
+            state = await self._sandbox.state()
+
+        if state.exit_code == 0:
+            return TestStatus.ok, bytes(comment)
+        if state.exit_code in (1, 2) and not state.cpu_limit:
+            return TestStatus.wrong_answer, bytes(comment)
+        return TestStatus.server_error, b"Checker has failed: " + comment
+
+
+class CheckerTestCase(IOTestCase):
+    """
+    Test case with a custom output check. Without a checker program
+    the output is compared by a streaming comparator while the sandbox
+    is running. With a checker the output is written to a temporary file
+    and checked after the run.
+
+    :param comparator: factory of the comparator for the expected output,
+        token-wise comparison by default.
+    :param checker: started checker program.
+    """
+
+    def __init__(
+        self,
+        stdin: bytes | None = None,
+        expected_stout: bytes | None = None,
+        comparator: Callable[[bytes | memoryview], OutputComparator] = TokenComparator,
+        checker: Checker | None = None,
+        encoding: str = 'utf-8',
+    ):
+        super().__init__(stdin, expected_stout, None, encoding)
+        self.comparator = comparator
+        self.checker = checker
+
+    def comparators(self) -> tuple[OutputComparator | None, OutputComparator | None]:
+        return self.comparator(self.expected_stout) if self.expected_stout else None, None
+
+    def _cache_parts(self) -> list[bytes | memoryview]:
+        parts = [*super()._cache_parts(), json.dumps(_comparator_key(self.comparator)).encode('utf-8')]
+        if self.checker is not None:
+            builder = self.checker.builder
+            checker = canonical([builder.profile, builder.limits, builder.files])
+            parts.append(json.dumps(checker, sort_keys=True).encode('utf-8'))
+        return parts
+
+    async def exec(self, sandbox: Sandbox) -> TestResult:
+        if self.checker is None:
+            return await super().exec(sandbox)
+
+        with tempfile.NamedTemporaryFile(prefix="runbox-output-") as output:
+            result = await self._run(sandbox, (OutputSpool(output), None))
+            if result.status != TestStatus.ok:
+                return result
+
+            status, comment = await self.checker.check(
+                self.input_file("input"),
+                File(name="answer", content=self.expected_stout, type="binary"),
+                Path(output.name),
+            )
+
+        return TestResult(status=status, why=comment or None, duration=result.duration)
+
+
+def _comparator_key(comparator: Callable[..., OutputComparator]) -> Any:
+    """
+    Stable form of a comparator factory: a class, a module level function
+    or a ``functools.partial`` of them with arguments, e.g.
+    ``partial(FloatComparator, epsilon=1e-3)``.
+
+    :raises TypeError: for lambdas, closures and other factories, that can't
+        be told apart by their names, results with them are not cached.
+    """
+    if isinstance(comparator, functools.partial):
+        return [
+            _comparator_key(comparator.func),
+            canonical(list(comparator.args)),
+            canonical(comparator.keywords),
+        ]
+
+    qualname = getattr(comparator, '__qualname__', None)
+    closure = getattr(comparator, '__closure__', None)
+    if qualname is None or '<' in qualname or closure:
+        raise TypeError(f"Comparator {comparator!r} can't be keyed")
+    return f"{comparator.__module__}.{qualname}"
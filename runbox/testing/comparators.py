@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import math
+import re
+from collections import Counter
+from typing import BinaryIO, Iterator, Protocol
+
+__all__ = [
+    'OutputComparator',
+    'ExactComparator',
+    'TokenComparator',
+    'FloatComparator',
+    'LineSetComparator',
+    'OutputSpool',
+]
+
+_TOKEN = re.compile(rb'\S+')
+
+
+class OutputComparator(Protocol):
+    """Compares output of a sandbox chunk by chunk, as it arrives"""
+
+    def feed(self, chunk: bytes | memoryview) -> bool:
+        """Returns False as soon as the output can't match anymore"""
+        ...
+
+    def finish(self) -> bool:
+        """Returns True if the whole output matches"""
+        ...
+
+
+class ExactComparator:
+    """
+    Byte-to-byte comparison with the expected output. Chunks are compared
+    against slices of the expected buffer, so no output is buffered.
+    """
+
+    def __init__(self, expected: bytes | memoryview):
+        self._expected = memoryview(expected)
+        self._offset = 0
+        self._failed = False
+
+    def feed(self, chunk: bytes | memoryview) -> bool:
+        if self._failed:
+            return False
+
+        end = self._offset + len(chunk)
+        if end > len(self._expected) or self._expected[self._offset:end] != chunk:
+            self._failed = True
+            return False
+
+        self._offset = end
+        return True
+
+    def finish(self) -> bool:
+        return not self._failed and self._offset == len(self._expected)
+
+
+class TokenComparator:
+    """
+    Compares whitespace-separated tokens, so the amount and kind of
+    whitespace doesn't matter. Only a token split between two chunks
+    is buffered, and only up to the longest expected token: longer
+    output can't match, so it fails at once.
+    """
+
+    # Number of bytes an output token may be longer than the expected one
+    token_slack = 0
+
+    def __init__(self, expected: bytes | memoryview):
+        self._expected: Iterator[re.Match] = _TOKEN.finditer(expected)
+        longest = max((len(match.group()) for match in _TOKEN.finditer(expected)), default=0)
+        self._max_token = longest + self.token_slack
+        self._partial = bytearray()
+        self._failed = False
+
+    def feed(self, chunk: bytes | memoryview) -> bool:
+        if self._failed or not chunk:
+            return not self._failed
+
+        chunk = bytes(chunk)
+        tokens = chunk.split()
+        if self._partial and tokens and not chunk[:1].isspace():
+            self._partial += tokens.pop(0)
+        if self._partial and (tokens or chunk[-1:].isspace()):
+            # Token is complete, when anything follows it
+            tokens.insert(0, bytes(self._partial))
+            self._partial.clear()
+        if tokens and not chunk[-1:].isspace():
+            # The last token may continue in the next chunk
+            self._partial += tokens.pop()
+
+        self._failed = len(self._partial) > self._max_token or \
+            not all(self._match(token) for token in tokens)
+        return not self._failed
+
+    def finish(self) -> bool:
+        if self._failed or (self._partial and not self._match(bytes(self._partial))):
+            return False
+        return next(self._expected, None) is None
+
+    def _match(self, token: bytes) -> bool:
+        expected = next(self._expected, None)
+        return expected is not None and self.tokens_equal(expected.group(), token)
+
+    def tokens_equal(self, expected: bytes, actual: bytes) -> bool:
+        return expected == actual
+
+
+class FloatComparator(TokenComparator):
+    """
+    Token-wise comparison, where numbers are equal if they differ
+    by no more than epsilon, absolute or relative to the expected number.
+    """
+
+    # Numbers may be printed with more digits, than expected ones
+    token_slack = 64
+
+    def __init__(self, expected: bytes | memoryview, epsilon: float = 1e-6):
+        super().__init__(expected)
+        self.epsilon = epsilon
+
+    def tokens_equal(self, expected: bytes, actual: bytes) -> bool:
+        if expected == actual:
+            return True
+        try:
+            expected_number, actual_number = float(expected), float(actual)
+        except ValueError:
+            return False
+        if math.isnan(expected_number) or math.isnan(actual_number):
+            return False
+        return abs(expected_number - actual_number) <= self.epsilon * max(1.0, abs(expected_number))
+
+
+class LineSetComparator:
+    """
+    Compares lines regardless of their order. Trailing whitespace
+    and empty lines are ignored. Expected lines are counted in advance,
+    so output lines are checked as soon as they are complete.
+    An incomplete line is buffered only up to the longest expected line.
+    """
+
+    def __init__(self, expected: bytes | memoryview):
+        lines = list(self._lines(bytes(expected).split(b'\n')))
+        self._expected = Counter(lines)
+        self._max_line = max(map(len, lines), default=0)
+        self._partial = bytearray()
+        self._failed = False
+
+    def feed(self, chunk: bytes | memoryview) -> bool:
+        if self._failed:
+            return False
+
+        chunk = bytes(chunk)
+        end = chunk.find(b'\n')
+        if end < 0:
+            self._partial += chunk
+        else:
+            self._partial += chunk[:end]
+            lines = [bytes(self._partial), *chunk[end + 1:].split(b'\n')]
+            self._partial = bytearray(lines.pop())
+            self._failed = not all(self._take(line) for line in self._lines(lines))
+
+        if len(self._partial) > self._max_line and not self._failed:
+            self._failed = len(self._partial.rstrip()) > self._max_line
+            # Only trailing whitespace is over the limit, it's ignored,
+            # unless the line continues, and then the line is too long
+            del self._partial[self._max_line + 1:]
+        return not self._failed
+
+    def finish(self) -> bool:
+        if self._failed or not all(self._take(line) for line in self._lines([bytes(self._partial)])):
+            return False
+        return not +self._expected
+
+    def _take(self, line: bytes) -> bool:
+        if self._expected[line] <= 0:
+            return False
+        self._expected[line] -= 1
+        return True
+
+    @staticmethod
+    def _lines(lines: list[bytes]) -> Iterator[bytes]:
+        return (stripped for line in lines if (stripped := line.rstrip()))
+
+
+class OutputSpool:
+    """Accepts any output and writes it to a file to be checked later"""
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+
+    def feed(self, chunk: bytes | memoryview) -> bool:
+        self._file.write(chunk)
+        return True
+
+    def finish(self) -> bool:
+        self._file.flush()
+        return True
@@ -14,9 +14,11 @@ class TestStatus(Enum):
     compile_error = 'CE'
     time_limit = 'TL'
     memory_limit = 'ML'
+    output_limit = 'OL'
     runtime_error = 'RE'
     server_error = 'SE'
     wrong_answer = 'WA'
+    skipped = 'SK'
 
     def __str__(self):
         return self.value
@@ -38,6 +40,10 @@ class TestCase(Protocol):
     async def exec(self, sandbox: Sandbox) -> TestResult:
         ...
 
+    def cache_key(self) -> str:
+        """Hash of the test data, required only for cached results"""
+        ...
+
 
 class TestSuite(Protocol):
 
@@ -51,5 +57,5 @@ class TestSuite(Protocol):
     # But now RunBox doesn't know any other executor, so it could be ok now.
     # I don't pass here a sandbox instead of executor, because execution
     # of a suite may need many containers.
-    async def exec(self, executor: DockerExecutor) -> list[TestResult]:
+    async def exec(self, executor: DockerExecutor, use_cache: bool = True) -> list[TestResult]:
         ...
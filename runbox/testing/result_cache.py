@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Protocol
+
+from runbox import SandboxBuilder
+from runbox.docker.utils import canonical, files_digest
+from .proto import TestCase, TestResult, TestStatus
+
+__all__ = [
+    "ResultCache",
+    "MemoryResultCache",
+    "SqliteResultCache",
+    "solution_key",
+    "result_key",
+]
+
+# Results, that say nothing about the solution, are never cached
+UNCACHEABLE = frozenset({TestStatus.skipped, TestStatus.server_error})
+
+
+class ResultCache(Protocol):
+    """Storage of test results keyed by :func:`result_key`"""
+
+    def get(self, key: str) -> TestResult | None:
+        ...
+
+    def set(self, key: str, result: TestResult) -> None:
+        ...
+
+
+def solution_key(sandbox_factory: SandboxBuilder) -> str:
+    """
+    Hash of the profile, limits and files of the solution sandbox.
+    Contents of mounted volumes can't be hashed, so solutions built into
+    a volume need a key of their own, e.g. the build cache key.
+
+    :raises ValueError: if the sandbox has mounts.
+    """
+    if sandbox_factory.mounts:
+        raise ValueError(
+            "Contents of mounted volumes can't be hashed, "
+            "sandboxes with mounts need an explicit solution key"
+        )
+    profile = sandbox_factory.profile
+    assert profile is not None
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps(canonical(profile), sort_keys=True).encode('utf-8'))
+    digest.update(json.dumps(canonical(sandbox_factory.limits), sort_keys=True).encode('utf-8'))
+    digest.update(files_digest(sandbox_factory.files).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def result_key(solution: str, test: TestCase) -> str:
+    """:raises TypeError: if the test can't be keyed, its results are not cached"""
+    return hashlib.sha256(f"{solution}:{test.cache_key()}".encode('utf-8')).hexdigest()
+
+
+class MemoryResultCache:
+    """LRU cache of results kept in memory"""
+
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._results: OrderedDict[str, TestResult] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def get(self, key: str) -> TestResult | None:
+        if (result := self._results.get(key)) is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._results.move_to_end(key)
+        return result
+
+    def set(self, key: str, result: TestResult) -> None:
+        self._results[key] = result
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+
+class SqliteResultCache:
+    """
+    Results stored in a local SQLite database, so they survive restarts
+    and are shared by worker processes of the same host. Least recently
+    used results are removed when there are more than ``max_entries``.
+    """
+
+    # Old results are removed once in that many writes
+    eviction_interval = 1024
+
+    def __init__(self, path: Path, max_entries: int = 1_000_000):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._connection = sqlite3.connect(self.path, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)"
+        )
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def get(self, key: str) -> TestResult | None:
+        row = self._connection.execute(
+            "SELECT result FROM results WHERE key = ?", (key,),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._connection.execute(
+            "UPDATE results SET used_at = ? WHERE key = ?", (time.time(), key),
+        )
+        return TestResult.parse_raw(row[0])
+
+    def set(self, key: str, result: TestResult) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO results (key, result, used_at) VALUES (?, ?, ?)",
+            (key, result.json(), time.time()),
+        )
+        self._writes += 1
+        if self._writes % self.eviction_interval == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        self._connection.execute(
+            "DELETE FROM results WHERE key IN ("
+            "SELECT key FROM results ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def close(self) -> None:
+        self._connection.close()
@@ -1,9 +1,28 @@
+import asyncio
+import hashlib
+from contextlib import suppress
+from pathlib import Path
+
+from aiodocker import DockerError
+
+from .comparators import OutputComparator, ExactComparator
 from .proto import TestResult, TestStatus
-from ..models import SandboxState
-from ..proto import Sandbox, SandboxIO
+from ..docker.demux import view_reader
+from ..docker.utils import file_chunks, map_file, CHUNK_SIZE
+from ..models import DiskFile, File, SandboxState
+from ..proto import Sandbox, SandboxIO, SandboxInput
 
 
 class IOTestCase:
+    """
+    Runs a sandbox with the given stdin and compares its output with
+    the expected one while the sandbox is running. The sandbox is killed
+    on the first mismatching chunk.
+    Empty expected output is not checked.
+    """
+
+    # Only the beginning of stderr is kept to explain a runtime error
+    stderr_excerpt_size = 4096
 
     def __init__(
         self,
@@ -18,41 +37,109 @@ class IOTestCase:
         self.encoding = encoding
 
     async def exec(self, sandbox: Sandbox) -> TestResult:
+        return await self._run(sandbox, self.comparators())
 
-        reader = await sandbox.run(self.stdin)
+    async def _run(
+        self,
+        sandbox: Sandbox,
+        comparators: tuple[OutputComparator | None, OutputComparator | None],
+    ) -> TestResult:
 
-        await sandbox.wait()
+        reader = await sandbox.run(self.stdin)
 
-        stdout, stderr = await self._read_output(reader)
+        output = asyncio.create_task(self._compare_output(sandbox, reader, comparators))
+        # Input is written while the output is read, so the sandbox
+        # is never blocked on a full output buffer
+        writer = asyncio.create_task(self.write_input(reader))
+        try:
+            await sandbox.wait()
+            matches, aborted, stderr = await output
+        finally:
+            output.cancel()
+            writer.cancel()
 
         state = await sandbox.state()
 
-        return self._check(stdout, stderr, state)
+        return self._check(matches, aborted, stderr, state)
 
-    @staticmethod
-    async def _read_output(reader: SandboxIO) -> tuple[bytes, bytes]:
-        stdout = b''
-        stderr = b''
-        while message := await reader.read_out():
+    def cache_key(self) -> str:
+        """
+        Hash of the test data. A solution gives the same
+        result on tests with equal keys.
+        """
+        digest = hashlib.sha256(type(self).__qualname__.encode('utf-8'))
+        for part in self._cache_parts():
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _cache_parts(self) -> list[bytes | memoryview]:
+        return [self.stdin or b'', self.expected_stout, self.expected_stderr]
+
+    async def write_input(self, writer: SandboxInput) -> None:
+        """Writes input, that is not passed to ``Sandbox.run``"""
+
+    def input_file(self, name: str) -> File:
+        """Input of the test as a file, that can be uploaded to a sandbox"""
+        return File(name=name, content=self.stdin or b"", type="binary")
+
+    def comparators(self) -> tuple[OutputComparator | None, OutputComparator | None]:
+        return (
+            ExactComparator(self.expected_stout) if self.expected_stout else None,
+            ExactComparator(self.expected_stderr) if self.expected_stderr else None,
+        )
+
+    async def _compare_output(
+        self,
+        sandbox: Sandbox,
+        reader: SandboxIO,
+        comparators: tuple[OutputComparator | None, OutputComparator | None],
+    ) -> tuple[bool, bool, bytes]:
+        """
+        Feeds every output chunk to the comparators.
+
+        :return: whether the output matches, whether the sandbox has been
+            killed because of a mismatch and the beginning of stderr.
+        """
+        stdout, stderr = comparators
+        stderr_excerpt = bytearray()
+
+        read = view_reader(reader)
+        while message := await read():
             if message.stream == 1:
-                stdout += message.data
+                comparator = stdout
             elif message.stream == 2:
-                stderr += message.data
+                comparator = stderr
+                missing = self.stderr_excerpt_size - len(stderr_excerpt)
+                if missing > 0:
+                    stderr_excerpt += message.data[:missing]
+            else:
+                continue
+
+            if comparator is not None and not comparator.feed(message.data):
+                with suppress(DockerError):
+                    await sandbox.kill()
+                return False, True, bytes(stderr_excerpt)
+
+        matches = all(
+            comparator.finish()
+            for comparator in (stdout, stderr)
+            if comparator is not None
+        )
+        return matches, False, bytes(stderr_excerpt)
 
-        return stdout, stderr
-
-    def _check(self, stdout: bytes, stderr: bytes, state: SandboxState) -> TestResult:
-        if (
-            stdout == self.expected_stderr or not self.expected_stout and
-            stderr == self.expected_stderr or not self.expected_stderr
-        ):
-            status = TestStatus.ok
-        else:
-            status = TestStatus.wrong_answer
+    @staticmethod
+    def _check(
+        matches: bool,
+        aborted: bool,
+        stderr: bytes,
+        state: SandboxState,
+    ) -> TestResult:
+        status = TestStatus.ok if matches else TestStatus.wrong_answer
 
         why = None
 
-        if state.exit_code:
+        if state.exit_code and not aborted:
             status = TestStatus.runtime_error
             why = stderr
 
@@ -62,9 +149,64 @@ class IOTestCase:
         elif state.memory_limit:
             status = TestStatus.memory_limit
             why = b"Memory limit has occurred"
+        elif state.output_limit:
+            status = TestStatus.output_limit
+            why = b"Output limit has occurred"
+        elif state.disk_limit:
+            status = TestStatus.runtime_error
+            why = b"Disk limit has occurred"
 
         assert state.finished_at is not None
-        
-        duration = state.finished_at - state.started_at
+
+        duration = state.cpu_time if state.cpu_time is not None else state.duration
 
         return TestResult(status=status, why=why, duration=duration.total_seconds())
+
+
+class FileTestCase(IOTestCase):
+    """
+    :class:`IOTestCase` with input and expected output stored in files.
+    Files are memory-mapped and read in slices when the test is run,
+    so tests don't occupy memory between runs.
+    """
+
+    def __init__(
+        self,
+        input_path: Path,
+        expected_stdout_path: Path | None = None,
+        expected_stderr_path: Path | None = None,
+        encoding: str = 'utf-8',
+        chunk_size: int = CHUNK_SIZE,
+    ):
+        self.input_path = Path(input_path)
+        self.expected_stdout_path = expected_stdout_path and Path(expected_stdout_path)
+        self.expected_stderr_path = expected_stderr_path and Path(expected_stderr_path)
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+
+    @property
+    def stdin(self) -> None:
+        # Input is streamed by write_input
+        return None
+
+    @property
+    def expected_stout(self) -> memoryview:
+        return self._map(self.expected_stdout_path)
+
+    @property
+    def expected_stderr(self) -> memoryview:
+        return self._map(self.expected_stderr_path)
+
+    def _cache_parts(self) -> list[bytes | memoryview]:
+        return [map_file(self.input_path), self.expected_stout, self.expected_stderr]
+
+    async def write_input(self, writer: SandboxInput) -> None:
+        for chunk in file_chunks(self.input_path, self.chunk_size):
+            await writer.write_in(chunk)
+
+    def input_file(self, name: str) -> File:
+        return DiskFile(name=name, path=self.input_path)
+
+    @staticmethod
+    def _map(path: Path | None) -> memoryview:
+        return map_file(path) if path is not None else memoryview(b'')
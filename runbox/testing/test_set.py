@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from .test_case import FileTestCase
+
+__all__ = [
+    "TestSet",
+    "TestSetEntry",
+]
+
+INDEX_FILE = "index.json"
+
+
+@dataclass(frozen=True)
+class TestSetEntry:
+    name: str
+    input: str
+    output: str | None = None
+    stderr: str | None = None
+
+
+class TestSet:
+    """
+    Directory with test data of a problem. The ``index.json`` file lists
+    the tests in order with paths to their files relative to the directory::
+
+        {"tests": [{"name": "1", "input": "1.in", "output": "1.out"}]}
+
+    Only the index is loaded, test files are memory-mapped
+    by :class:`FileTestCase` when a test is run.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        with (self.root / INDEX_FILE).open() as index:
+            self.entries = [TestSetEntry(**entry) for entry in json.load(index)["tests"]]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[FileTestCase]:
+        return iter(self.test_cases())
+
+    def test_cases(self) -> list[FileTestCase]:
+        return [
+            FileTestCase(
+                input_path=self.root / entry.input,
+                expected_stdout_path=entry.output and self.root / entry.output,
+                expected_stderr_path=entry.stderr and self.root / entry.stderr,
+            )
+            for entry in self.entries
+        ]
+
+    @classmethod
+    def create(cls, root: Path, tests: Iterable[tuple[str, bytes, bytes]]) -> TestSet:
+        """
+        Writes a test set from ``(name, input, expected output)`` tuples.
+        """
+        root = Path(root)
+        root.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for name, stdin, expected in tests:
+            entry = TestSetEntry(name=name, input=f"{name}.in", output=f"{name}.out")
+            (root / entry.input).write_bytes(stdin)
+            (root / entry.output).write_bytes(expected)
+            entries.append(entry.__dict__)
+
+        with (root / INDEX_FILE).open("w") as index:
+            json.dump({"tests": entries}, index, indent=2)
+
+        return cls(root)
@@ -1,18 +1,60 @@
 from __future__ import annotations
 
+import asyncio
+from collections import deque
+from contextlib import suppress
+
+from aiodocker import DockerError
+
 from runbox import DockerExecutor
-from .proto import TestCase, TestResult
-from ..proto import SandboxFactory
+from .proto import TestCase, TestResult, TestStatus
+from .result_cache import ResultCache, UNCACHEABLE, result_key, solution_key
+from ..proto import Sandbox, SandboxFactory
+
+
+class _FailFast(Exception):
+    pass
 
 
 class BaseTestSuite:
+    """
+    Runs test cases in sandboxes created by the sandbox factory.
+
+    :param sandbox_factory: factory of sandboxes the tests are run in.
+    :param concurrency: maximum number of tests that are run at the same time.
+        Every worker uses its own sandbox.
+    :param sandbox_per_test: create a fresh sandbox for every test
+        instead of reusing one sandbox per worker.
+    :param fail_fast: cancel remaining tests after the first non-OK result.
+        Tests that haven't been run are reported as skipped.
+    :param result_cache: if given, results of the same solution on the same
+        tests are taken from the cache and only missing tests are run.
+    :param solution_key: key of the solution in the cache, by default a hash
+        of the profile, limits and files of the sandbox factory.
+        It's required with a cache, if the sandbox factory has mounts.
+    :raises ValueError: if the cache is given for a sandbox factory with
+        mounts without a solution key.
+    """
 
     def __init__(
         self,
         sandbox_factory: SandboxFactory,
+        concurrency: int = 1,
+        sandbox_per_test: bool = False,
+        fail_fast: bool = False,
+        result_cache: ResultCache | None = None,
+        solution_key: str | None = None,
     ) -> None:
+        assert concurrency > 0, "Concurrency must be positive"
+        if result_cache is not None and solution_key is None and getattr(sandbox_factory, "mounts", None):
+            raise ValueError("Result cache needs a solution key for a sandbox factory with mounts")
         self.builder = sandbox_factory
         self.tests: list[TestCase] = []
+        self.concurrency = concurrency
+        self.sandbox_per_test = sandbox_per_test
+        self.fail_fast = fail_fast
+        self.result_cache = result_cache
+        self.solution_key = solution_key
 
     def add_tests(self, *tests: TestCase) -> BaseTestSuite:
         self.tests.extend(tests)
@@ -25,11 +67,92 @@ class BaseTestSuite:
         except ValueError:
             return False
 
-    async def exec(self, executor: DockerExecutor) -> list[TestResult]:
-        result = []
-        sandbox = await self.builder.create(executor)
-        async with sandbox:
-            for test_case in self.tests:
-                result.append(await test_case.exec(sandbox))
+    async def exec(self, executor: DockerExecutor, use_cache: bool = True) -> list[TestResult]:
+        """
+        :param use_cache: take results from the cache. With False all tests
+            are run and the cache is refreshed, e.g. for rejudges,
+            that depend on timings.
+        """
+        results: list[TestResult | None] = [None] * len(self.tests)
+        keys: list[str | None] | None = None
+        if self.result_cache is not None:
+            solution = self.solution_key or solution_key(self.builder)
+            keys = [self._result_key(solution, test) for test in self.tests]
+            if use_cache:
+                results = [self.result_cache.get(key) if key else None for key in keys]
+
+        pending = deque(
+            (idx, test)
+            for idx, test in enumerate(self.tests)
+            if results[idx] is None
+        )
+        if self.fail_fast and any(
+            result is not None and result.status != TestStatus.ok
+            for result in results
+        ):
+            pending.clear()
+
+        workers = [
+            asyncio.create_task(self._worker(executor, pending, results, keys))
+            for _ in range(min(self.concurrency, len(pending)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        except _FailFast:
+            pass
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        return [result or self._skipped() for result in results]
+
+    @staticmethod
+    def _result_key(solution: str, test: TestCase) -> str | None:
+        try:
+            return result_key(solution, test)
+        except TypeError:
+            # e.g. a comparator, that can't be keyed
+            return None
+
+    async def _worker(
+        self,
+        executor: DockerExecutor,
+        pending: deque[tuple[int, TestCase]],
+        results: list[TestResult | None],
+        keys: list[str | None] | None,
+    ) -> None:
+        while pending:
+            idx, test_case = pending.popleft()
+            sandbox = await self.builder.create(executor)
+            async with sandbox:
+                while True:
+                    result = await self._exec_test(test_case, sandbox)
+                    results[idx] = result
+                    if keys is not None and keys[idx] and result.status not in UNCACHEABLE:
+                        self.result_cache.set(keys[idx], result)
+
+                    if self.fail_fast and result.status != TestStatus.ok:
+                        pending.clear()
+                        raise _FailFast()
+
+                    if self.sandbox_per_test or not pending:
+                        break
+                    idx, test_case = pending.popleft()
+
+    @staticmethod
+    async def _exec_test(test_case: TestCase, sandbox: Sandbox) -> TestResult:
+        try:
+            return await test_case.exec(sandbox)
+        except asyncio.CancelledError:
+            with suppress(DockerError):
+                await sandbox.kill()
+            raise
 
-        return result
+    @staticmethod
+    def _skipped() -> TestResult:
+        return TestResult(
+            status=TestStatus.skipped,
+            why="Skipped after an earlier failure",
+            duration=None,
+        )
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from benchmarks import FakeDocker, FakeDockerConfig, SCENARIOS, save_results
+from benchmarks.runner import percentile
+from runbox import DockerExecutor
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+    assert percentile(values, 50) == 50.0
+    assert percentile(values, 99) == 99.0
+    assert percentile([3.0], 99) == 3.0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('scenario', list(SCENARIOS))
+async def test_scenario_runs_against_fake_docker(scenario, tmp_path):
+    config = FakeDockerConfig(run_time=0.001, stdout=b'x' * 10000, frame_size=1000)
+    async with FakeDocker(config) as docker:
+        executor = DockerExecutor(url=docker.url)
+        try:
+            result = await SCENARIOS[scenario](executor, config, 2, 4)
+        finally:
+            await executor.close()
+
+        assert not docker.containers
+        assert not docker.volumes
+
+    assert result.operations == 4
+    assert result.throughput > 0
+    assert result.p50 <= result.p99
+
+    save_results([result], tmp_path / 'results.json')
+    report = json.loads((tmp_path / 'results.json').read_text())
+    assert report['results'][0]['name'] == scenario
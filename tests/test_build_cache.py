@@ -0,0 +1,106 @@
+import os
+from pathlib import Path
+
+import pytest
+from aiodocker.volumes import DockerVolume
+
+from runbox.build_stages import BuildCache, BuildCacheStats, build_cache_key
+from runbox.build_stages.stages import UseSandbox, UseVolume, LoadableFile
+from runbox.models import DockerProfile, File, Limits
+from runbox.utils import _
+
+
+def compile_stages(source: str, limits: Limits = Limits()) -> list:
+    return [
+        UseVolume(UseVolume.Params(key='build')),
+        UseSandbox(UseSandbox.Params(
+            key='builder',
+            profile=DockerProfile(
+                image='sandbox:gcc-10',
+                cmd_template=['g++', _[0], '-o', 'main'],
+            ),
+            limits=limits,
+            files=[LoadableFile(name='main.cpp', content=source)],
+            mounts=[{'key': 'build', 'bind': '/sandbox'}],
+        )),
+    ]
+
+
+def test_build_cache_key_is_stable():
+    assert build_cache_key(compile_stages('int main() {}')) == \
+           build_cache_key(compile_stages('int main() {}'))
+
+
+def test_build_cache_key_depends_on_sources_and_limits():
+    key = build_cache_key(compile_stages('int main() {}'))
+
+    assert key != build_cache_key(compile_stages('int main() { return 1; }'))
+    assert key != build_cache_key(compile_stages('int main() {}', Limits(memory_mb=128)))
+
+
+def test_build_cache_key_depends_on_files_in_state():
+    stages = compile_stages('int main() {}')
+    key = build_cache_key(stages, {'sources': [File(name='lib.cpp', content='int f() {}')]})
+
+    assert key == build_cache_key(stages, {'sources': [File(name='lib.cpp', content='int f() {}')]})
+    assert key != build_cache_key(stages, {'sources': [File(name='lib.cpp', content='int g() {}')]})
+
+
+def test_build_cache_evicts_least_recently_used(tmp_path: Path):
+    cache = BuildCache(tmp_path, DockerProfile(image='alpine:latest'), max_bytes=2048)
+    for age, key in enumerate(['old', 'used', 'new']):
+        entry = tmp_path / key
+        entry.mkdir()
+        (entry / 'build.tar').write_bytes(b'\0' * 1024)
+        os.utime(entry, (age, age))
+
+    os.utime(tmp_path / 'used', (10, 10))
+    cache.evict()
+
+    assert not cache.lookup('old')
+    assert cache.lookup('used')
+    assert cache.lookup('new')
+    assert cache.stats == BuildCacheStats(hits=2, misses=1, evictions=1, size=2048)
+
+
+class FakeArchiveSandbox:
+
+    def __init__(self, volumes: dict[str, bytes], volume: str):
+        self.volumes = volumes
+        self.volume = volume
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    async def read_archive(self, path):
+        data = self.volumes[self.volume]
+        for start in range(0, len(data), 1000):
+            yield data[start:start + 1000]
+
+    async def write_archive(self, path, chunks):
+        self.volumes[self.volume] = b''.join([bytes(chunk) async for chunk in chunks])
+
+
+class FakeArchiveExecutor:
+
+    def __init__(self, volumes: dict[str, bytes]):
+        self.volumes = volumes
+
+    async def create_container(self, profile, files, mounts, limits, timeout, priority):
+        return FakeArchiveSandbox(self.volumes, mounts[0].volume.name)
+
+
+@pytest.mark.asyncio
+async def test_build_cache_stores_and_restores_volumes(tmp_path: Path):
+    cache = BuildCache(tmp_path, DockerProfile(image='alpine:latest'))
+    archive = os.urandom(1024 * 1024)
+    executor = FakeArchiveExecutor({'built': archive})
+
+    assert await cache.store('key', {'build': DockerVolume(None, 'built')}, executor)
+    assert (tmp_path / 'key' / 'build.tar').read_bytes() == archive
+
+    await cache.restore('key', {'build': DockerVolume(None, 'fresh')}, executor)
+    assert executor.volumes['fresh'] == archive
@@ -1,16 +1,30 @@
+import asyncio
 import io
+import os
+import subprocess
 import tarfile
 from datetime import timedelta
 from pathlib import Path
 
 import aiodocker
+import aiohttp
 import pytest
 from aiodocker import DockerError
+from aiodocker.stream import Message
 
-from runbox.docker import DockerExecutor
+from benchmarks import FakeDocker, FakeDockerConfig
+from runbox.docker import (
+    DockerExecutor, ContainerPool, AdmissionScheduler, CpuAllocator, ConnectionPoolConfig, Reaper,
+    ImageCache, ImageNotFoundError, VolumePool,
+)
+from runbox.docker.connections import connection_stats
+from runbox.docker.demux import DemuxParser, DemuxReader, OutputDecoder, parser_supported
+from runbox.docker.events import ContainerEvents
 from runbox.docker.mount import Mount
-from runbox.docker.utils import create_tarball
-from runbox.models import DockerProfile, File, Limits
+from runbox.docker.sandbox import StreamWrapper
+from runbox.docker.usage import CgroupUsageReader, ResourceUsage, parse_stats
+from runbox.docker.utils import create_tarball, files_digest, iter_tarball, TarballCache
+from runbox.models import DockerProfile, File, DiskFile, Limits, SandboxState
 
 
 @pytest.mark.asyncio
@@ -106,13 +120,75 @@ def test_tarball_create_multiple_files():
     fileobj = io.BytesIO(tar_file.getvalue())
 
     with tarfile.open(fileobj=fileobj, mode='r') as tarball:
-        assert tarball.getnames() == ['main.py', 'input.txt']
+        assert tarball.getnames() == ['input.txt', 'main.py']
         main_py = tarball.extractfile('main.py').read().decode('utf-8')
         input_txt = tarball.extractfile('input.txt').read().decode('utf-8')
         assert main_py == 'print("Hello, world!")'
         assert input_txt == 'important text!'
 
 
+def test_tarball_is_deterministic():
+    files = [
+        File(name='main.py', content='print(input())'),
+        File(name='input.txt', content='42'),
+    ]
+
+    assert create_tarball(files).getvalue() == create_tarball(files[::-1]).getvalue()
+
+
+def test_streamed_tarball_matches_in_memory_tarball(tmp_path: Path):
+    data = tmp_path / 'input.txt'
+    data.write_bytes(b'1 2 3\n' * 100_000)
+    files = [
+        File(name='main.py', content='print(sum(map(int, input().split())))'),
+        DiskFile(name='input.txt', path=data),
+    ]
+
+    streamed = b''.join(iter_tarball(files, chunk_size=4096))
+
+    assert streamed == create_tarball(files).getvalue()
+
+
+def test_disk_files_are_hashed_without_reading_them_in_memory(tmp_path: Path, monkeypatch):
+    data = tmp_path / 'input.txt'
+    content = b'1 2 3\n' * 100_000
+    data.write_bytes(content)
+    expected = files_digest([File(name='input.txt', content=content)])
+
+    def read_bytes(self):
+        raise AssertionError('Disk file is read in memory')
+
+    monkeypatch.setattr(DiskFile, 'content_bytes', read_bytes)
+    assert files_digest([DiskFile(name='input.txt', path=data)]) == expected
+
+
+def test_tarball_cache_reuses_archives():
+    main_py = File(name='main.py', content='print(input())')
+    input_txt = File(name='input.txt', content='42')
+    cache = TarballCache()
+
+    archive = cache.get([main_py, input_txt])
+    assert cache.get([input_txt, main_py]) is archive
+    assert cache.get([main_py]) is not archive
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_tarball_cache_evicts_least_recently_used():
+    files = [File(name=f'{idx}.txt', content='x' * 1024) for idx in range(3)]
+    archive_size = len(create_tarball(files[:1]).getvalue())
+    cache = TarballCache(max_bytes=2 * archive_size)
+
+    first = cache.get(files[:1])
+    cache.get(files[1:2])
+    cache.get(files[:1])
+    cache.get(files[2:3])
+
+    assert len(cache) == 2
+    assert cache.size <= cache.max_bytes
+    assert cache.get(files[:1]) is first
+    assert cache.misses == 3
+
+
 @pytest.mark.asyncio
 async def test_code_running_no_input(
     docker_client: aiodocker.Docker,
@@ -279,3 +355,703 @@ async def test_can_create_container_with_profile_specifying_only_image(
     assert expected_info["Cmd"] == info["Cmd"]
     assert expected_info["WorkingDir"] == info["WorkingDir"]
     assert expected_info["User"] == info["User"]
+
+
+@pytest.mark.asyncio
+async def test_container_pool_hands_out_warm_containers(
+    python_sandbox_profile: DockerProfile,
+    python_code_sample: list[File],
+):
+    pool = ContainerPool(size=1, refill_interval=0.1)
+    executor = DockerExecutor(container_pool=pool)
+    await executor.warm_up(python_sandbox_profile, files=python_code_sample)
+
+    while pool.idle < 1:
+        await asyncio.sleep(0.1)
+
+    sandbox = await executor.create_container(python_sandbox_profile, python_code_sample)
+    async with sandbox:
+        await sandbox.run()
+        await sandbox.wait()
+        logs = await sandbox.log(stdout=True)
+
+    await executor.close()
+
+    assert logs == ['Hello, World!\n']
+    assert pool.stats.hits == 1
+    assert pool.stats.misses == 0
+
+
+class ListStream:
+
+    def __init__(self, messages: list[Message]):
+        self.messages = messages
+
+    async def read_out(self) -> Message | None:
+        return self.messages.pop(0) if self.messages else None
+
+
+def test_container_config_enforces_limits():
+    executor = DockerExecutor(docker_client=object())
+    limits = Limits(time=timedelta(milliseconds=500), cpu_count=2, disk_space_mb=16, pids=8)
+    host_config = executor.container_config(DockerProfile(image='alpine'), limits=limits)['HostConfig']
+
+    assert host_config['NanoCpus'] == 2 * 10 ** 9
+    assert host_config['MemorySwap'] == host_config['Memory'] == limits.memory_bytes
+    assert host_config['PidsLimit'] == 8
+    assert host_config['Tmpfs'] == {'/tmp': 'rw,nosuid,size=16m'}
+    assert {ulimit['Name']: ulimit['Soft'] for ulimit in host_config['Ulimits']} == {
+        'cpu': 1,
+        'fsize': 16 * 1024 ** 2,
+        'nofile': limits.open_files,
+    }
+
+
+def test_container_config_keeps_tmp_mounts_visible():
+    executor = DockerExecutor(docker_client=object())
+    profile = DockerProfile(image='alpine', workdir=Path('/tmp'))
+    host_config = executor.container_config(profile, [File(name='main.py', content='')])['HostConfig']
+
+    assert host_config['Tmpfs'] == {}
+    assert host_config['PidsLimit'] is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('exit_code', [152, 153])
+async def test_signal_exit_codes_need_reached_limits(exit_code: int):
+    async with FakeDocker(FakeDockerConfig(exit_code=exit_code)) as docker:
+        executor = DockerExecutor(url=docker.url)
+        try:
+            sandbox = await executor.create_container(DockerProfile(image='alpine'))
+            async with sandbox:
+                await sandbox.run()
+                await sandbox.wait()
+                state = await sandbox.state()
+        finally:
+            await executor.close()
+
+    assert state.exit_code == exit_code
+    assert not state.cpu_limit and not state.disk_limit
+
+
+class ContainerUsageReader:
+    """Like the real readers, usage can be read only while the container runs"""
+    poll_interval = 60.0
+
+    def __init__(self):
+        self.reads = 0
+
+    async def read(self, container) -> ResourceUsage | None:
+        if not (await container.show())['State']['Running']:
+            return None
+        self.reads += 1
+        return ResourceUsage(cpu_time=timedelta(milliseconds=self.reads), memory_peak_bytes=1024)
+
+    async def read_exit(self, container) -> ResourceUsage | None:
+        while (await container.show())['State']['Running']:
+            await asyncio.sleep(0.005)
+        # The cgroup is still there, when its last process has exited
+        return ResourceUsage(cpu_time=timedelta(milliseconds=50), memory_peak_bytes=4096)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('run_time', [0.0, 0.1])
+async def test_sandbox_reads_usage_at_exit(run_time: float):
+    reader = ContainerUsageReader()
+    async with FakeDocker(FakeDockerConfig(run_time=run_time)) as docker:
+        executor = DockerExecutor(url=docker.url, usage_reader=reader)
+        try:
+            sandbox = await executor.create_container(DockerProfile(image='alpine'))
+            async with sandbox:
+                await sandbox.run()
+                await sandbox.wait()
+                state = await sandbox.state()
+        finally:
+            await executor.close()
+
+    assert state.cpu_time == timedelta(milliseconds=50)
+    assert state.memory_peak == 4096
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(
+    not Path('/sys/fs/cgroup/cgroup.controllers').exists() or os.geteuid() != 0,
+    reason='requires root and cgroup v2',
+)
+async def test_cgroup_usage_reader_reads_usage_at_exit():
+    group = Path('/sys/fs/cgroup/docker/runbox-test')
+    group.mkdir(parents=True, exist_ok=True)
+    process = subprocess.Popen(['sh', '-c', 'sleep 0.1; i=0; while [ $i -lt 100000 ]; do i=$((i+1)); done'])
+    try:
+        (group / 'cgroup.procs').write_text(str(process.pid))
+        container = type('Container', (), {'id': 'runbox-test'})()
+        usage = await asyncio.wait_for(CgroupUsageReader().read_exit(container), 10)
+        assert process.poll() is not None
+        assert usage is not None and usage.cpu_time > timedelta(0)
+    finally:
+        process.wait()
+        group.rmdir()
+
+
+def test_container_config_tmpfs_workdir():
+    executor = DockerExecutor(docker_client=object())
+    profile = DockerProfile(image='alpine', workdir=Path('/sandbox'), tmpfs_workdir=True)
+    limits = Limits(disk_space_mb=16)
+
+    tmpfs = executor.container_config(profile, limits=limits)['HostConfig']['Tmpfs']
+    assert tmpfs['/sandbox'] == 'rw,exec,nosuid,size=16m'
+
+    # Files written before the start would be hidden by a tmpfs
+    files = [File(name='main.py', content='')]
+    tmpfs = executor.container_config(profile, files, limits=limits)['HostConfig']['Tmpfs']
+    assert '/sandbox' not in tmpfs
+
+
+@pytest.mark.asyncio
+async def test_stream_wrapper_stops_on_output_limit():
+    exceeded = []
+
+    async def on_output_limit():
+        exceeded.append(True)
+
+    stream = StreamWrapper(
+        ListStream([Message(1, b'a' * 6), Message(2, b'b' * 6), Message(1, b'a' * 6)]),
+        output_limit=10,
+        on_output_limit=on_output_limit,
+    )
+
+    assert (await stream.read_out()).stream == 1
+    assert (await stream.read_out()).stream == 2
+    assert await stream.read_out() is None
+    assert await stream.read_out() is None
+    assert exceeded == [True]
+
+
+@pytest.mark.asyncio
+async def test_executor_splits_connection_pools():
+    executor = DockerExecutor(
+        url='unix:///var/run/docker.sock',
+        control_pool=ConnectionPoolConfig(limit=4, keepalive_timeout=30),
+        streaming_pool=ConnectionPoolConfig(limit=64),
+    )
+    try:
+        assert executor.streaming_client is not executor.docker_client
+        assert executor.docker_client.connector.limit == 4
+        stats = executor.connection_stats()
+        assert stats['control'].limit == 4
+        assert stats['streaming'].limit == 64
+        assert stats['streaming'].saturation == 0.0
+    finally:
+        await executor.close()
+
+
+@pytest.mark.asyncio
+async def test_executor_shares_client_without_streaming_pool(docker_client):
+    executor = DockerExecutor(docker_client=docker_client)
+    assert executor.streaming_client is executor.docker_client
+    assert connection_stats(docker_client).acquired == 0
+
+
+@pytest.mark.asyncio
+async def test_reaper_retries_and_drains():
+    reaper = Reaper(concurrency=2, retries=2, backoff=0.01)
+    attempts = {}
+    running = []
+    max_running = []
+    done = []
+
+    def deleter(name: str, failures: int, status: int = 500):
+        async def delete():
+            attempts[name] = attempts.get(name, 0) + 1
+            running.append(name)
+            max_running.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(name)
+            if attempts[name] <= failures:
+                raise DockerError(status, {'message': 'busy'})
+        return delete
+
+    reaper.reap('ok', deleter('ok', 0), lambda: done.append('ok'))
+    reaper.reap('flaky', deleter('flaky', 2), lambda: done.append('flaky'))
+    reaper.reap('broken', deleter('broken', 10), lambda: done.append('broken'))
+    reaper.reap('gone', deleter('gone', 1, status=404), lambda: done.append('gone'))
+    assert reaper.pending == 4
+
+    await reaper.drain()
+
+    assert sorted(done) == ['broken', 'flaky', 'gone', 'ok']
+    assert attempts == {'ok': 1, 'flaky': 3, 'broken': 3, 'gone': 1}
+    assert max(max_running) <= 2
+    assert reaper.stats.pending == 0
+    assert reaper.stats.deleted == 3
+    assert reaper.stats.failed == 1
+
+
+class FakeImages:
+
+    def __init__(self, present: set[str], registry: set[str]):
+        self.present = present
+        self.registry = registry
+        self.inspected = []
+        self.pulled = []
+
+    async def inspect(self, name: str) -> dict:
+        self.inspected.append(name)
+        if name not in self.present:
+            raise DockerError(404, {'message': f'No such image: {name}'})
+        return {'Id': f'sha256:{name}'}
+
+    async def pull(self, repo: str, tag: str | None = None) -> list[dict]:
+        image = f'{repo}:{tag}'
+        self.pulled.append(image)
+        if image not in self.registry:
+            return [{'error': 'not found'}]
+        self.present.add(image)
+        return [{'status': 'Downloaded'}]
+
+
+class FakeImagesClient:
+
+    def __init__(self, images: FakeImages):
+        self.images = images
+
+
+@pytest.mark.asyncio
+async def test_image_cache_prepulls_and_fails_fast():
+    images = FakeImages(present={'alpine:latest'}, registry={'python:3.10'})
+    executor = DockerExecutor(docker_client=FakeImagesClient(images), image_cache=ImageCache())
+    cache = executor.image_cache
+
+    await executor.prepull(DockerProfile(image='alpine'), 'python:3.10')
+    assert images.pulled == ['python:3.10']
+    assert 'alpine' in cache and 'python:3.10' in cache
+
+    # Pinned images are trusted without events
+    inspected = len(images.inspected)
+    await cache.ensure('python:3.10')
+    assert len(images.inspected) == inspected
+
+    with pytest.raises(ImageNotFoundError):
+        await cache.ensure('gcc:latest')
+    with pytest.raises(ImageNotFoundError):
+        await cache.pull(['gcc:latest'])
+
+    # Removal of a pinned image is followed by a pull
+    images.present.discard('python:3.10')
+    cache._dispatch({'Action': 'delete', 'Actor': {'ID': 'sha256:python:3.10', 'Attributes': {}}})
+    assert 'python:3.10' not in cache
+    await asyncio.sleep(0)
+    await cache.ensure('python:3.10')
+    assert images.pulled == ['python:3.10', 'gcc:latest', 'python:3.10']
+
+    await cache.close()
+
+
+class ShortTtlImageCache(ImageCache):
+    inspect_ttl = 0.05
+
+
+@pytest.mark.asyncio
+async def test_image_cache_trusts_inspects_for_a_while():
+    images = FakeImages(present={'alpine:latest'}, registry=set())
+    executor = DockerExecutor(docker_client=FakeImagesClient(images), image_cache=ShortTtlImageCache())
+    cache = executor.image_cache
+    # The events stream is not connected and the image is not pinned
+    assert not await cache.start()
+
+    for _ in range(5):
+        await cache.ensure('alpine')
+    assert len(images.inspected) == 1
+
+    await asyncio.sleep(0.06)
+    await cache.ensure('alpine')
+    assert len(images.inspected) == 2
+
+    await cache.close()
+
+
+def test_image_cache_events_keep_ids_and_match_removals():
+    cache = ImageCache()
+    cache._present = {'alpine:latest': 'sha256:a', 'python:3.10': 'sha256:p'}
+
+    cache._dispatch({'Action': 'pull', 'Actor': {'ID': 'alpine:latest', 'Attributes': {'name': 'alpine'}}})
+    cache._dispatch({'Action': 'tag', 'Actor': {'ID': 'sha256:g', 'Attributes': {'name': 'gcc:12'}}})
+    cache._dispatch({'Action': 'pull', 'Actor': {'ID': 'rust:1', 'Attributes': {'name': 'rust'}}})
+    assert cache._present == {
+        'alpine:latest': 'sha256:a', 'python:3.10': 'sha256:p', 'gcc:12': 'sha256:g', 'rust:1': None,
+    }
+
+    # Images with unknown ids are not removed with every other image
+    cache._dispatch({'Action': 'delete', 'Actor': {'ID': 'sha256:p', 'Attributes': {'name': 'sha256:p'}}})
+    cache._dispatch({'Action': 'untag', 'Actor': {'ID': 'sha256:x', 'Attributes': {'name': 'alpine'}}})
+    assert cache._present == {'gcc:12': 'sha256:g', 'rust:1': None}
+
+
+class UnreachableEventsClient(FakeImagesClient):
+
+    def __init__(self, images: FakeImages):
+        super().__init__(images)
+        self.subscriptions = 0
+
+    def _query(self, *args, **kwargs):
+        self.subscriptions += 1
+        raise aiohttp.ClientConnectionError('Connection refused')
+
+
+class FastRetryImageCache(ImageCache):
+    reconnect_backoff = 0.05
+
+
+@pytest.mark.asyncio
+async def test_image_cache_backs_off_subscriptions():
+    client = UnreachableEventsClient(FakeImages(present={'alpine:latest'}, registry=set()))
+    cache = FastRetryImageCache()
+    cache.bind(client)
+
+    for _ in range(5):
+        assert not await cache.start()
+    assert client.subscriptions == 1
+
+    await asyncio.sleep(0.06)
+    assert not await cache.start()
+    assert not await cache.start()
+    assert client.subscriptions == 2
+
+    await cache.close()
+
+
+class FastRetryContainerEvents(ContainerEvents):
+    reconnect_backoff = 0.05
+
+
+@pytest.mark.asyncio
+async def test_container_events_back_off_subscriptions(caplog):
+    client = UnreachableEventsClient(FakeImages(present=set(), registry=set()))
+    events = FastRetryContainerEvents(client)
+
+    for _ in range(5):
+        assert not await events.start()
+    assert client.subscriptions == 1
+    assert 'Container events stream failed' in caplog.text
+
+    await asyncio.sleep(0.06)
+    assert not await events.start()
+    assert not await events.start()
+    assert client.subscriptions == 2
+
+    await events.close()
+
+
+@pytest.mark.asyncio
+async def test_volume_pool_reuses_wiped_volumes():
+    async with FakeDocker() as docker:
+        pool = VolumePool(min_size=0, max_size=1, cleaner_image='alpine')
+        executor = DockerExecutor(url=docker.url, volume_pool=pool)
+        try:
+            async with executor.workdir() as first:
+                pass
+            await asyncio.gather(*pool._recycling)
+            async with executor.workdir() as second:
+                pass
+            await asyncio.gather(*pool._recycling)
+            assert second.name == first.name
+            assert pool.stats.hits == 1
+            assert docker.calls['volume_delete'] == 0
+            # The cleaner container is restarted for every wipe
+            assert docker.calls['create'] == 1
+            assert docker.calls['start'] == 2
+            assert docker.calls['list'] == 0
+        finally:
+            await executor.close()
+
+        assert not docker.volumes
+        assert not docker.containers
+
+
+@pytest.mark.asyncio
+async def test_volume_pool_recycles_after_reaped_containers():
+    async with FakeDocker(FakeDockerConfig(latencies={'delete': 0.05})) as docker:
+        reaper = Reaper(backoff=0.02)
+        pool = VolumePool(min_size=0, max_size=1, cleaner_image='alpine')
+        executor = DockerExecutor(url=docker.url, volume_pool=pool, reaper=reaper)
+        try:
+            async with executor.workdir() as volume:
+                sandbox = await executor.create_container(
+                    DockerProfile(image='alpine'), mounts=[Mount(volume=volume, bind=Path('/sandbox'))],
+                )
+                await sandbox.delete()
+            await reaper.drain()
+
+            assert pool.idle == 1
+            assert reaper.stats.retried > 0
+            assert docker.calls['volume_delete'] == 0
+        finally:
+            await executor.close()
+
+        assert not docker.volumes
+        assert not docker.containers
+
+
+@pytest.mark.asyncio
+async def test_volume_pool_deletes_volumes_in_use_after_retries():
+    async with FakeDocker() as docker:
+        reaper = Reaper(retries=2, backoff=0.05)
+        pool = VolumePool(min_size=0, max_size=1, cleaner_image='alpine')
+        executor = DockerExecutor(url=docker.url, volume_pool=pool, reaper=reaper)
+        try:
+            async with executor.workdir() as volume:
+                # The sandbox outlives the volume
+                sandbox = await executor.create_container(
+                    DockerProfile(image='alpine'), mounts=[Mount(volume=volume, bind=Path('/sandbox'))],
+                )
+            while not reaper.stats.failed:
+                await asyncio.sleep(0.005)
+            await sandbox.delete()
+            await reaper.drain()
+
+            assert pool.idle == 0
+            assert volume.name not in docker.volumes
+        finally:
+            await executor.close()
+
+        assert not docker.volumes
+        assert not docker.containers
+
+
+def frame(stream: int, data: bytes) -> bytes:
+    return bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, 'big') + data
+
+
+@pytest.mark.asyncio
+async def test_demux_reader_splits_frames_without_copying():
+    queue = aiohttp.DataQueue(asyncio.get_running_loop())
+    parser = DemuxParser(queue)
+    data = frame(1, b'hello, ') + frame(2, b'oops') + frame(1, b'world') + frame(1, b'')
+    chunks = [data[:3], data[3:12], data[12:20], data[20:]]
+    for chunk in chunks:
+        assert parser.feed_data(chunk) == (False, b'')
+    parser.feed_eof()
+
+    reader = DemuxReader(None, queue)
+    message = await reader.read_view()
+    assert message.stream == 1
+    assert isinstance(message.data, memoryview)
+    assert message.data.obj is chunks[1]
+
+    buffer = bytearray(4)
+    read = [(1, bytes(message.data))]
+    while result := await reader.readinto(buffer):
+        stream, size = result
+        read.append((stream, bytes(buffer[:size])))
+
+    output = {1: b'', 2: b''}
+    for stream, data in read:
+        output[stream] += data
+    assert output == {1: b'hello, world', 2: b'oops'}
+    assert all(len(data) <= 4 for _, data in read[1:])
+
+
+@pytest.mark.asyncio
+async def test_demux_reader_returns_bytes():
+    queue = aiohttp.DataQueue(asyncio.get_running_loop())
+    parser = DemuxParser(queue)
+    parser.feed_data(frame(1, b'hello'))
+    parser.feed_eof()
+
+    message = await DemuxReader(None, queue).read_out()
+    assert message.data == b'hello' and isinstance(message.data, bytes)
+
+
+@pytest.mark.asyncio
+async def test_demux_reader_installs_into_aiohttp_internals():
+    # The parser replaces aiodocker's one through private attributes of
+    # aiohttp and aiodocker, this fails as soon as they are changed
+    assert parser_supported(), 'Installed aiohttp or aiodocker is not supported by DemuxParser'
+    stdout = b'x' * 10_000
+    async with FakeDocker(FakeDockerConfig(stdout=stdout, frame_size=3000, run_time=0.05)) as docker:
+        executor = DockerExecutor(url=docker.url)
+        try:
+            sandbox = await executor.create_container(DockerProfile(image='alpine'))
+            async with sandbox:
+                reader = await sandbox.run()
+                protocol = reader.stream.stream._resp.connection.protocol
+                assert isinstance(protocol._payload_parser, DemuxParser)
+                assert reader.stream._queue is reader.stream.stream._queue
+
+                views = []
+                while message := await reader.read_view():
+                    views.append(message.data)
+                await sandbox.wait()
+        finally:
+            await executor.close()
+
+    assert all(isinstance(view, memoryview) for view in views)
+    assert b''.join(views) == stdout
+
+
+class ClosingStream:
+
+    def __init__(self, queue: aiohttp.DataQueue):
+        self.queue = queue
+        self.closed = False
+
+    async def close(self) -> None:
+        # Closed connection fails pending reads
+        self.closed = True
+        self.queue.set_exception(aiohttp.ClientConnectionError('Connection closed'))
+
+
+@pytest.mark.asyncio
+async def test_demux_reader_ends_when_closed():
+    queue = aiohttp.DataQueue(asyncio.get_running_loop())
+    stream = ClosingStream(queue)
+    reader = DemuxReader(stream, queue)
+    await reader.close()
+
+    assert stream.closed
+    assert await reader.read_out() is None
+
+    broken = aiohttp.DataQueue(asyncio.get_running_loop())
+    broken.set_exception(aiohttp.ClientConnectionError('Connection reset'))
+    with pytest.raises(aiohttp.ClientError):
+        await DemuxReader(None, broken).read_out()
+
+
+def test_output_decoder_joins_split_characters():
+    data = 'привет'.encode('utf-8')
+    decoder = OutputDecoder()
+
+    text = decoder.decode(1, data[:3]) + decoder.decode(2, b'\xd0') + decoder.decode(1, data[3:])
+    assert text == 'привет'
+    assert decoder.flush() == [(2, '\ufffd')]
+
+
+def container_event(action: str, container_id: str, time: int, **attributes) -> dict:
+    return {
+        "Type": "container",
+        "Action": action,
+        "Actor": {"ID": container_id, "Attributes": attributes},
+        "timeNano": time * 10 ** 9,
+    }
+
+
+@pytest.mark.asyncio
+async def test_container_events_resolve_exit_from_die_event():
+    events = ContainerEvents(docker=None)
+    events._connected = True
+    container_exit = events.watch('container')
+
+    # die event of a previous run must be ignored
+    events._dispatch(container_event('die', 'container', 1, exitCode='0'))
+    events._dispatch(container_event('start', 'container', 2))
+    events._dispatch(container_event('start', 'other', 2))
+    events._dispatch(container_event('oom', 'container', 3))
+    events._dispatch(container_event('die', 'container', 4, exitCode='137'))
+
+    state = SandboxState.parse_obj({
+        **(await container_exit).state(),
+        'CpuLimit': False,
+    })
+    assert state.exit_code == 137
+    assert state.memory_limit
+    assert state.duration == timedelta(seconds=2)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_queues_requests_over_budget():
+    scheduler = AdmissionScheduler(memory_mb=256, cpu_count=2)
+    first = await scheduler.acquire(Limits(memory_mb=128))
+    second = await scheduler.acquire(Limits(memory_mb=128))
+
+    low = asyncio.create_task(scheduler.acquire(Limits(memory_mb=128)))
+    high = asyncio.create_task(scheduler.acquire(Limits(memory_mb=128), priority=1))
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 2
+
+    first.release()
+    first.release()
+    await asyncio.sleep(0)
+    assert high.done() and not low.done()
+
+    second.release()
+    (await low).release()
+    (await high).release()
+
+    stats = scheduler.stats
+    assert stats.reserved_memory_mb == 0 and stats.reserved_cpus == 0
+    assert stats.admitted == 4 and stats.max_queue_depth == 2
+    with pytest.raises(ValueError):
+        await scheduler.acquire(Limits(cpu_count=4))
+
+
+@pytest.mark.asyncio
+async def test_scheduler_skips_cancelled_requests():
+    scheduler = AdmissionScheduler(memory_mb=128, cpu_count=1)
+    held = await scheduler.acquire(Limits(memory_mb=128))
+    cancelled = asyncio.create_task(scheduler.acquire(Limits(memory_mb=128)))
+    waiting = asyncio.create_task(scheduler.acquire(Limits(memory_mb=128)))
+    await asyncio.sleep(0)
+
+    cancelled.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    held.release()
+
+    (await waiting).release()
+    assert scheduler.stats.queue_depth == 0
+    assert scheduler.reserved_memory_mb == 0
+
+
+@pytest.mark.asyncio
+async def test_cpu_allocator_gives_exclusive_cores():
+    allocator = CpuAllocator(cores=[0, 1, 2])
+    first = await allocator.acquire(2)
+    waiting = asyncio.create_task(allocator.acquire(2))
+    await asyncio.sleep(0)
+
+    assert first.cpuset_cpus == '0,1'
+    assert allocator.free == 1 and allocator.queue_depth == 1
+
+    first.release()
+    second = await waiting
+    assert second.cores == (0, 1)
+    second.release()
+    assert allocator.free == 3
+    with pytest.raises(ValueError):
+        await allocator.acquire(4)
+
+
+@pytest.mark.asyncio
+async def test_cgroup_usage_reader_reads_v2_and_v1(tmp_path: Path):
+    v2 = tmp_path / 'v2' / 'system.slice' / 'docker-abc.scope'
+    v2.mkdir(parents=True)
+    (v2 / 'cpu.stat').write_text('usage_usec 1500000\nuser_usec 1000000\nsystem_usec 500000\n')
+    (v2 / 'memory.peak').write_text('4096\n')
+
+    assert CgroupUsageReader(tmp_path / 'v2').read_sync('abc') == ResourceUsage(
+        cpu_time=timedelta(seconds=1.5),
+        memory_peak_bytes=4096,
+    )
+
+    for controller, name, value in [
+        ('cpuacct', 'cpuacct.usage', '2000000000'),
+        ('memory', 'memory.max_usage_in_bytes', '8192'),
+    ]:
+        group = tmp_path / 'v1' / controller / 'docker' / 'abc'
+        group.mkdir(parents=True)
+        (group / name).write_text(value)
+
+    assert CgroupUsageReader(tmp_path / 'v1').read_sync('abc') == ResourceUsage(
+        cpu_time=timedelta(seconds=2),
+        memory_peak_bytes=8192,
+    )
+    assert CgroupUsageReader(tmp_path / 'v1').read_sync('stopped') is None
+
+
+def test_parse_stats_of_running_and_stopped_containers():
+    usage = parse_stats({
+        'cpu_stats': {'cpu_usage': {'total_usage': 250_000_000}},
+        'memory_stats': {'usage': 1024},
+    })
+    assert usage == ResourceUsage(cpu_time=timedelta(milliseconds=250), memory_peak_bytes=1024)
+    assert parse_stats({'cpu_stats': {}, 'memory_stats': {}}) is None
@@ -0,0 +1,66 @@
+import pytest
+
+from benchmarks import FakeDocker
+from runbox import DockerExecutor
+from runbox.build_stages import CompileAndRunPipeline
+from runbox.build_stages.stages import UseSandbox
+from runbox.instrumentation import PrometheusHistograms, SpanRecorder, TracerInstrumentation
+from runbox.models import DockerProfile, File
+
+
+def test_prometheus_histograms_render():
+    histograms = PrometheusHistograms(buckets=(0.1, 1.0))
+    tags = {'container': 'a', 'image': 'alpine'}
+    histograms.observe('start', tags, 0.05)
+    histograms.observe('start', tags, 0.5)
+    histograms.observe('start', {**tags, 'container': 'b'}, 5.0)
+
+    assert histograms.render().splitlines()[2:] == [
+        'runbox_span_duration_seconds_bucket{span="start",image="alpine",le="0.1"} 1',
+        'runbox_span_duration_seconds_bucket{span="start",image="alpine",le="1.0"} 2',
+        'runbox_span_duration_seconds_bucket{span="start",image="alpine",le="+Inf"} 3',
+        'runbox_span_duration_seconds_sum{span="start",image="alpine"} 5.55',
+        'runbox_span_duration_seconds_count{span="start",image="alpine"} 3',
+    ]
+
+
+def test_tracer_instrumentation_passes_attributes():
+    class Tracer:
+        def __init__(self):
+            self.spans = []
+
+        def start_as_current_span(self, name, attributes):
+            self.spans.append((name, attributes))
+            return SpanRecorder().span(name, attributes)
+
+    tracer = Tracer()
+    with TracerInstrumentation(tracer).span('wait', {'container': 'a', 'image': None}):
+        pass
+
+    assert tracer.spans == [('docker.wait', {'runbox.container': 'a'})]
+
+
+@pytest.mark.asyncio
+async def test_executor_and_pipeline_emit_spans():
+    recorder = SpanRecorder()
+    profile = DockerProfile(image='python', cmd_template=['python', 'main.py'])
+    async with FakeDocker() as docker:
+        executor = DockerExecutor(url=docker.url, instrumentation=recorder)
+        pipeline = CompileAndRunPipeline() \
+            .add_stages('run', UseSandbox(UseSandbox.Params(
+                key='run', profile=profile, files=[File(name='main.py', content='')], attach=False,
+            ))) \
+            .with_executor(executor)
+        try:
+            await pipeline.run()
+            await pipeline.finalize()
+        finally:
+            await executor.close()
+
+    names = [span.name for span in recorder.spans]
+    for name in ('create', 'put_archive', 'start', 'attach', 'wait', 'inspect', 'delete', 'stage'):
+        assert name in names
+    stage = next(span for span in recorder.spans if span.name == 'stage')
+    assert stage.tags == {'group': 'run', 'stage': 'run'}
+    assert all(span.tags['image'] == 'python' for span in recorder.spans if span.name != 'stage')
+    assert all(span.duration >= 0 and span.error is None for span in recorder.spans)
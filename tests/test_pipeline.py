@@ -1,14 +1,18 @@
+import asyncio
+import contextlib
 from pathlib import Path
 
 import pytest
+from pydantic import BaseModel
 
 from runbox import DockerExecutor
-from runbox.build_stages import BasePipeline, CompileAndRunPipeline
+from runbox.build_stages import BasePipeline, CompileAndRunPipeline, stage_dependencies
+from runbox.build_stages.pipeline import GroupStatus
 from runbox.build_stages.pipeline_loaders import (
     load_stages, JsonPipelineLoader,
 )
 from runbox.build_stages.stages import (
-    UseSandbox, UseVolume,
+    UseSandbox, UseVolume, SandboxMount, WriteFiles,
     default_stages, LoadableFile
 )
 from runbox.models import DockerProfile, Limits
@@ -104,3 +108,141 @@ async def test_pipeline_multistage_build(
     await pipeline.run()
     await pipeline.finalize()
     observer.validate()
+
+
+class RecordingStage:
+    class Params(BaseModel):
+        key: str
+        mounts: list[SandboxMount] = []
+        depends_on: list[str] = []
+
+    def __init__(self, params: Params, log: list[str], delay: float = 0.01, fail: bool = False):
+        self.params = params
+        self.log = log
+        self.delay = delay
+        self.fail = fail
+        self.is_setup = False
+        self.is_disposed = False
+
+    async def setup(self, state) -> None:
+        self.is_setup = True
+        self.log.append(f'start {self.params.key}')
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError(self.params.key)
+        state.shared[self.params.key] = self.params.key
+        self.log.append(f'end {self.params.key}')
+
+    async def dispose(self) -> None:
+        self.is_disposed = True
+        self.log.append(f'dispose {self.params.key}')
+
+
+def recording_stage(log: list[str], key: str, reads: list[str] = (), **kwargs) -> RecordingStage:
+    mounts = [SandboxMount(key=read, bind='/' + read) for read in reads]
+    return RecordingStage(RecordingStage.Params(key=key, mounts=mounts), log, **kwargs)
+
+
+def test_stage_dependencies_are_inferred_from_keys():
+    log = []
+    stages = [
+        recording_stage(log, 'runner', ['build', 'headers']),
+        recording_stage(log, 'build'),
+        recording_stage(log, 'headers'),
+    ]
+    assert stage_dependencies(stages) == [{1, 2}, set(), set()]
+
+
+def test_stage_dependencies_order_stages_changing_a_volume():
+    profile = DockerProfile(image='alpine')
+    stages = [
+        UseVolume(UseVolume.Params(key='vol')),
+        WriteFiles(WriteFiles.Params(key='files', file_keys=['sources'], volume='vol')),
+        UseSandbox(UseSandbox.Params(key='compile', profile=profile, mounts=[
+            SandboxMount(key='vol', bind='/build'),
+        ])),
+        UseSandbox(UseSandbox.Params(key='link', profile=profile, mounts=[
+            SandboxMount(key='vol', bind='/build'),
+        ])),
+    ]
+    assert stage_dependencies(stages) == [set(), {0}, {0, 1}, {0, 1, 2}]
+
+
+def test_stage_dependencies_detect_cycles():
+    log = []
+    stages = [recording_stage(log, 'a', ['b']), recording_stage(log, 'b', ['a'])]
+    with pytest.raises(ValueError):
+        stage_dependencies(stages)
+
+
+@pytest.mark.asyncio
+async def test_pipeline_runs_independent_stages_concurrently():
+    log = []
+    pipeline = BasePipeline(max_concurrency=2) \
+        .with_executor(object()) \
+        .add_stages(
+            'build',
+            recording_stage(log, 'runner', ['first', 'second']),
+            recording_stage(log, 'first'),
+            recording_stage(log, 'second'),
+        )
+
+    await pipeline.execute_group('build')
+    await pipeline.finalize()
+
+    assert log[:2] == ['start first', 'start second']
+    assert log[4:6] == ['start runner', 'end runner']
+    assert log[6] == 'dispose runner'
+    assert pipeline.groups[0].status == GroupStatus.done
+
+
+@pytest.mark.asyncio
+async def test_pipeline_stops_starting_stages_after_failure():
+    log = []
+    pipeline = BasePipeline(max_concurrency=2) \
+        .with_executor(object()) \
+        .add_stages(
+            'build',
+            recording_stage(log, 'broken', fail=True),
+            recording_stage(log, 'slow', delay=0.05),
+            recording_stage(log, 'runner', ['slow']),
+        )
+
+    with pytest.raises(RuntimeError):
+        await pipeline.execute_group('build')
+    await pipeline.finalize()
+
+    assert 'start runner' not in log
+    assert log == ['start broken', 'start slow', 'dispose broken', 'end slow', 'dispose slow']
+    assert pipeline.groups[0].status == GroupStatus.failed
+
+
+class WorkdirRecorder:
+
+    def __init__(self):
+        self.tmpfs_sizes: list[int | None] = []
+
+    @contextlib.asynccontextmanager
+    async def workdir(self, tmpfs_mb: int | None = None):
+        self.tmpfs_sizes.append(tmpfs_mb)
+        yield object()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_keeps_crossing_volumes_on_disk():
+    log = []
+    executor = WorkdirRecorder()
+    pipeline = BasePipeline() \
+        .with_executor(executor) \
+        .add_stages(
+            'build',
+            UseVolume(UseVolume.Params(key='scratch', tmpfs=True, limits=Limits(disk_space_mb=16))),
+            UseVolume(UseVolume.Params(key='build', tmpfs=True)),
+            recording_stage(log, 'compile', ['scratch', 'build']),
+        ) \
+        .add_stages('run', recording_stage(log, 'run', ['build']))
+
+    await pipeline.execute_group('build')
+    await pipeline.finalize()
+
+    assert executor.tmpfs_sizes == [16, None]
@@ -0,0 +1,560 @@
+import asyncio
+import functools
+import os
+import shutil
+import subprocess
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from aiodocker.stream import Message
+from aiodocker.volumes import DockerVolume
+
+from runbox import SandboxBuilder
+from runbox.models import DockerProfile, Limits, SandboxState
+from runbox.testing import BaseTestSuite, BatchTestSuite, IOTestCase, TestSet
+from runbox.testing.batch import DRIVER_SCRIPT, BatchReader
+from runbox.testing.checker import Checker, CheckerTestCase
+from runbox.testing.comparators import (
+    ExactComparator, TokenComparator, FloatComparator, LineSetComparator,
+)
+from runbox.testing.proto import TestResult, TestStatus
+from runbox.testing.result_cache import MemoryResultCache, SqliteResultCache, solution_key
+from runbox.utils import _
+
+
+class FakeSandbox:
+
+    def __init__(self):
+        self.deleted = False
+        self.killed = False
+
+    async def kill(self):
+        self.killed = True
+
+    async def delete(self, force: bool = False):
+        self.deleted = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.delete()
+
+
+class FakeStream:
+
+    def __init__(self, messages: list[Message]):
+        self.messages = messages
+
+    async def read_out(self) -> Message | None:
+        await asyncio.sleep(0)
+        return self.messages.pop(0) if self.messages else None
+
+
+class FakeOutputSandbox(FakeSandbox):
+
+    def __init__(self, messages: list[Message], exit_code: int = 0):
+        super().__init__()
+        self.stream = FakeStream(messages)
+        self.exit_code = exit_code
+
+    async def run(self, stdin: bytes | None = None) -> FakeStream:
+        return self.stream
+
+    async def wait(self):
+        while self.stream.messages and not self.killed:
+            await asyncio.sleep(0)
+
+    async def kill(self):
+        await super().kill()
+        self.exit_code = 137
+        self.stream.messages.clear()
+
+    async def state(self) -> SandboxState:
+        started_at = datetime.now()
+        return SandboxState(
+            Status="exited",
+            ExitCode=self.exit_code,
+            StartedAt=started_at,
+            FinishedAt=started_at + timedelta(seconds=1),
+            OOMKilled=False,
+            CpuLimit=False,
+        )
+
+
+class FakeSandboxFactory:
+
+    def __init__(self):
+        self.sandboxes: list[FakeSandbox] = []
+
+    async def create(self, executor) -> FakeSandbox:
+        sandbox = FakeSandbox()
+        self.sandboxes.append(sandbox)
+        return sandbox
+
+
+class SleepTestCase:
+    running = 0
+    max_running = 0
+
+    def __init__(self, delay: float, status: TestStatus = TestStatus.ok):
+        self.delay = delay
+        self.status = status
+
+    async def exec(self, sandbox) -> TestResult:
+        SleepTestCase.running += 1
+        SleepTestCase.max_running = max(SleepTestCase.max_running, SleepTestCase.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            SleepTestCase.running -= 1
+        return TestResult(status=self.status, why=str(self.delay), duration=self.delay)
+
+    def cache_key(self) -> str:
+        return f'{self.delay}:{self.status}'
+
+
+@pytest.fixture(autouse=True)
+def reset_counters():
+    SleepTestCase.running = 0
+    SleepTestCase.max_running = 0
+
+
+@pytest.mark.asyncio
+async def test_suite_keeps_order_and_concurrency_limit():
+    factory = FakeSandboxFactory()
+    delays = [0.05, 0.01, 0.03, 0.02, 0.04, 0.01]
+    suite = BaseTestSuite(factory, concurrency=3) \
+        .add_tests(*(SleepTestCase(delay) for delay in delays))
+
+    results = await suite.exec(None)
+
+    assert [result.duration for result in results] == delays
+    assert SleepTestCase.max_running == 3
+    assert len(factory.sandboxes) == 3
+    assert all(sandbox.deleted for sandbox in factory.sandboxes)
+
+
+@pytest.mark.asyncio
+async def test_suite_creates_sandbox_per_test():
+    factory = FakeSandboxFactory()
+    suite = BaseTestSuite(factory, concurrency=2, sandbox_per_test=True) \
+        .add_tests(*(SleepTestCase(0.01) for _ in range(5)))
+
+    await suite.exec(None)
+
+    assert len(factory.sandboxes) == 5
+
+
+@pytest.mark.asyncio
+async def test_suite_fail_fast_skips_remaining_tests():
+    factory = FakeSandboxFactory()
+    suite = BaseTestSuite(factory, concurrency=2, fail_fast=True).add_tests(
+        SleepTestCase(0.01, TestStatus.wrong_answer),
+        SleepTestCase(1),
+        SleepTestCase(1),
+    )
+
+    results = await suite.exec(None)
+
+    assert [result.status for result in results] == [
+        TestStatus.wrong_answer, TestStatus.skipped, TestStatus.skipped,
+    ]
+    assert all(sandbox.deleted for sandbox in factory.sandboxes)
+    assert any(sandbox.killed for sandbox in factory.sandboxes)
+
+
+def test_exact_comparator_accepts_split_output():
+    comparator = ExactComparator(b'Hello, world!\n')
+    assert comparator.feed(b'Hello')
+    assert comparator.feed(b', world!')
+    assert not comparator.finish()
+    assert comparator.feed(b'\n')
+    assert comparator.finish()
+
+
+def test_exact_comparator_rejects_extra_output():
+    comparator = ExactComparator(b'42\n')
+    assert comparator.feed(b'42\n')
+    assert not comparator.feed(b'\n')
+    assert not comparator.finish()
+
+
+@pytest.mark.asyncio
+async def test_io_test_case_aborts_on_first_mismatch():
+    sandbox = FakeOutputSandbox([
+        Message(1, b'Fizz'),
+        Message(1, b'Fizz'),
+    ] + [Message(1, b'Buzz')] * 100)
+
+    result = await IOTestCase(b'15\n', b'FizzBuzz\n').exec(sandbox)
+
+    assert result.status == TestStatus.wrong_answer
+    assert sandbox.killed
+
+
+@pytest.mark.asyncio
+async def test_io_test_case_reports_runtime_error():
+    sandbox = FakeOutputSandbox([Message(2, b'Traceback')], exit_code=1)
+
+    result = await IOTestCase(b'15\n', b'FizzBuzz\n').exec(sandbox)
+
+    assert result.status == TestStatus.runtime_error
+    assert result.why == 'Traceback'
+    assert not sandbox.killed
+
+
+@pytest.mark.asyncio
+async def test_io_test_case_accepts_matching_output():
+    sandbox = FakeOutputSandbox([Message(1, b'Fizz'), Message(1, b'Buzz\n')])
+
+    result = await IOTestCase(b'15\n', b'FizzBuzz\n').exec(sandbox)
+
+    assert result.status == TestStatus.ok
+
+
+def batch_output(*frames: bytes) -> bytes:
+    return b'RUNBOX-BATCH 0f1e\n' + b''.join(frames)
+
+
+def batch_frame(
+    index: int, exit_code: int, stdout: bytes, stderr: bytes = b'', timed_out: bool = False,
+) -> bytes:
+    trailer = f'\nRUNBOX-BATCH-0f1e {index} {exit_code} 1000000000 1100000000 0 50000 0 0 4096 0 ' \
+              f'{int(timed_out)} {len(stderr)}\n'
+    return stdout + trailer.encode() + stderr
+
+
+class FakeBatchExecutor:
+
+    def __init__(self, *outputs: bytes):
+        self.outputs = list(outputs)
+        self.sandboxes: list[FakeOutputSandbox] = []
+
+    async def create_container(self, profile, files, mounts, limits, timeout, priority):
+        output = self.outputs.pop(0)
+        # Frames are split at arbitrary points
+        sandbox = FakeOutputSandbox([Message(1, output[i:i + 5]) for i in range(0, len(output), 5)])
+        sandbox.profile = profile
+        sandbox.limits = limits
+        sandbox.files = []
+
+        async def write_files(path, *files):
+            sandbox.files.extend(files)
+
+        sandbox.write_files = write_files
+        self.sandboxes.append(sandbox)
+        return sandbox
+
+
+def batch_suite(fail_fast: bool = False) -> BatchTestSuite:
+    builder = SandboxBuilder() \
+        .with_profile(DockerProfile(image='sandbox:python-3.10', cmd_template=['python', 'main.py'])) \
+        .with_limits(Limits(time=timedelta(milliseconds=500)))
+    return BatchTestSuite(builder, fail_fast=fail_fast).add_tests(
+        IOTestCase(b'1\n', b'1\n'),
+        IOTestCase(b'2\n', b'4\n'),
+        IOTestCase(b'3\n', b'9\n'),
+    )
+
+
+@pytest.mark.asyncio
+async def test_batch_suite_maps_frames_to_results():
+    executor = FakeBatchExecutor(
+        batch_output(batch_frame(0, 0, b'1\n'), batch_frame(1, 0, b'5\n'), batch_frame(2, 1, b'', b'Traceback')),
+    )
+
+    results = await batch_suite().exec(executor)
+
+    assert [result.status for result in results] == [
+        TestStatus.ok, TestStatus.wrong_answer, TestStatus.runtime_error,
+    ]
+    assert results[0].duration == 0.05
+    assert results[2].why == 'Traceback'
+
+    sandbox = executor.sandboxes[0]
+    assert sandbox.profile.cmd_template[:4] == ['sh', '/runbox-batch/driver.sh', '/runbox-batch', '3']
+    # Tests don't run as root, unlike the driver
+    assert sandbox.profile.user == '0'
+    assert sandbox.profile.cmd_template[4] == '0.500'
+    assert sandbox.profile.cmd_template[8:10] == ['65534', '65534']
+    assert sandbox.profile.cmd_template[-2:] == ['python', 'main.py']
+    # Output is not limited by default
+    assert sandbox.limits.output_bytes is None
+    assert [file.name for file in sandbox.files][1:] == [f'runbox-batch/{idx}.in' for idx in range(3)]
+
+
+@pytest.mark.asyncio
+async def test_batch_suite_reruns_tests_after_container_death():
+    executor = FakeBatchExecutor(
+        batch_output(batch_frame(0, 0, b'1\n')),
+        batch_output(batch_frame(0, 0, b'4\n'), batch_frame(1, 137, b'', timed_out=True)),
+    )
+
+    results = await batch_suite().exec(executor)
+
+    assert [result.status for result in results] == [
+        TestStatus.ok, TestStatus.ok, TestStatus.time_limit,
+    ]
+    assert len(executor.sandboxes) == 2
+    assert all(sandbox.deleted for sandbox in executor.sandboxes)
+
+
+@pytest.mark.asyncio
+async def test_batch_suite_reports_time_limit_only_for_driver_timeouts():
+    executor = FakeBatchExecutor(
+        # The second test kills itself, the third one is killed by the driver
+        batch_output(batch_frame(0, 0, b'1\n'), batch_frame(1, 137, b''), batch_frame(2, 137, b'', timed_out=True)),
+    )
+
+    results = await batch_suite().exec(executor)
+
+    assert [result.status for result in results] == [
+        TestStatus.ok, TestStatus.runtime_error, TestStatus.time_limit,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_batch_suite_captures_more_stderr_than_expected():
+    builder = SandboxBuilder() \
+        .with_profile(DockerProfile(image='sandbox:python-3.10', cmd_template=['python', 'main.py']))
+    suite = BatchTestSuite(builder).add_tests(IOTestCase(b'1\n', b'1\n', b'e' * 8192))
+    executor = FakeBatchExecutor(batch_output(batch_frame(0, 0, b'1\n', b'e' * 8193)))
+
+    results = await suite.exec(executor)
+
+    assert executor.sandboxes[0].profile.cmd_template[7] == '8193'
+    assert results[0].status == TestStatus.wrong_answer
+
+
+@pytest.mark.asyncio
+async def test_batch_suite_stops_test_over_output_limit():
+    builder = SandboxBuilder() \
+        .with_profile(DockerProfile(image='sandbox:python-3.10', cmd_template=['python', 'main.py'])) \
+        .with_limits(Limits(output_bytes=8))
+    suite = BatchTestSuite(builder).add_tests(IOTestCase(b'1\n', b'1\n'), IOTestCase(b'2\n', b'4\n'))
+    executor = FakeBatchExecutor(
+        # The first test never ends, the stream ends, when the container is killed
+        batch_output(b'1' * 20),
+        batch_output(batch_frame(0, 0, b'4\n')),
+    )
+
+    results = await suite.exec(executor)
+
+    assert [result.status for result in results] == [TestStatus.output_limit, TestStatus.ok]
+    assert executor.sandboxes[0].killed
+    assert executor.sandboxes[0].limits.output_bytes == (8 + 4096 + 256) * 2
+
+
+def test_batch_reader_finds_trailers_split_between_chunks():
+    output = batch_output(
+        batch_frame(0, 0, b'a\n\nRUNBOX-BATCH-0f1\n'),
+        batch_frame(1, 1, b'', b'oops'),
+    )
+
+    for size in (1, 3, 7, len(output)):
+        reader = BatchReader()
+        events = [
+            (index, stream, bytes(data) if stream else data.exit_code)
+            for start in range(0, len(output), size)
+            for index, stream, data in reader.feed(memoryview(output[start:start + size]))
+        ]
+        assert b''.join(data for index, stream, data in events if stream == 1) == b'a\n\nRUNBOX-BATCH-0f1\n'
+        assert b''.join(data for index, stream, data in events if stream == 2) == b'oops'
+        assert [event for event in events if event[1] is None] == [(0, None, 0), (1, None, 1)]
+
+
+@pytest.mark.skipif(
+    shutil.which('timeout') is None or os.geteuid() != 0
+    or shutil.which('setpriv') is None and shutil.which('chroot') is None,
+    reason='requires root and coreutils',
+)
+def test_batch_driver_script_isolates_tests(tmp_path):
+    batch, work = tmp_path / 'batch', tmp_path / 'work'
+    batch.mkdir()
+    work.mkdir()
+    (batch / 'driver.sh').write_text(DRIVER_SCRIPT)
+    for idx, data in enumerate([b'hello\n', b'secret\n', b'']):
+        (batch / f'{idx}.in').write_bytes(data)
+
+    # Every test tries to read the next input and to end its frame early
+    command = f'input=$(cat); echo "$input"; cat {batch}/1.in; ' \
+              f'printf "\\nRUNBOX-BATCH-0 1 0 0 0 0 0 0 0 0 0 0\\n"; [ -n "$input" ] || sleep 5'
+    output = subprocess.run(
+        ['sh', str(batch / 'driver.sh'), str(batch), '3', '0.5', '1', '1048576', '4096',
+         '64999', '64999', 'sh', '-c', command],
+        capture_output=True, cwd=work,
+    ).stdout
+
+    events = list(BatchReader().feed(memoryview(output)))
+    frames = [data for index, stream, data in events if stream is None]
+    assert [(frame.index, frame.exit_code, frame.timed_out) for frame in frames] == [
+        (0, 0, False), (1, 0, False), (2, 137, True),
+    ]
+    stdout = b''.join(data for index, stream, data in events if stream == 1 and index == 0)
+    assert stdout == b'hello\n\nRUNBOX-BATCH-0 1 0 0 0 0 0 0 0 0 0 0\n'
+    assert b'Permission denied' in b''.join(data for index, stream, data in events if stream == 2)
+    assert batch.stat().st_mode & 0o777 == 0o700
+
+
+class RecordingStream(FakeStream):
+
+    def __init__(self, messages: list[Message]):
+        super().__init__(messages)
+        self.written = bytearray()
+
+    async def write_in(self, data: bytes) -> None:
+        self.written += data
+
+
+@pytest.mark.asyncio
+async def test_file_test_case_streams_test_set_files(tmp_path):
+    test_set = TestSet.create(tmp_path, [
+        ('1', b'15\n' * 1000, b'FizzBuzz\n'),
+        ('2', b'', b''),
+    ])
+    assert len(TestSet(tmp_path)) == 2
+
+    first, second = TestSet(tmp_path)
+    first.chunk_size = 1024
+    sandbox = FakeOutputSandbox([Message(1, b'Fizz'), Message(1, b'Buzz\n')])
+    sandbox.stream = RecordingStream(sandbox.stream.messages)
+
+    result = await first.exec(sandbox)
+
+    assert result.status == TestStatus.ok
+    assert sandbox.stream.written == b'15\n' * 1000
+    assert second.comparators() == (None, None)
+    assert second.input_file('0.in').content_bytes() == b''
+
+
+def feed_all(comparator, *chunks: bytes) -> bool:
+    return all(comparator.feed(chunk) for chunk in chunks) and comparator.finish()
+
+
+def test_token_comparators_ignore_whitespace_and_chunks():
+    assert feed_all(TokenComparator(b'1 2\n3\n'), b'1', b'  2', b'\n3')
+    assert not feed_all(TokenComparator(b'12'), b'1 ', b'2')
+    assert feed_all(FloatComparator(b'0.333333 x'), b'0.3333334 ', b'x')
+    assert not feed_all(FloatComparator(b'1.0'), b'1.1')
+
+
+def test_line_set_comparator_ignores_order():
+    assert feed_all(LineSetComparator(b'a\nb\n'), b'b\na', b'\n\n')
+    assert not feed_all(LineSetComparator(b'a\nb\n'), b'a\na\n')
+    assert not feed_all(LineSetComparator(b'a\nb'), b'a\n')
+
+
+def test_comparators_fail_on_endless_tokens_and_lines():
+    tokens = TokenComparator(b'12 345\n')
+    assert tokens.feed(b'12 34')
+    assert not tokens.feed(b'56')
+
+    lines = LineSetComparator(b'abc\n')
+    assert lines.feed(b'abc' + b' ' * 100)
+    assert not lines.feed(b'd')
+    assert feed_all(LineSetComparator(b'abc\n'), b'ab', b'c   ', b'    \n')
+
+
+class FakeCheckerExecutor:
+
+    def __init__(self, exit_code: int):
+        self.sandbox = FakeOutputSandbox([], exit_code=exit_code)
+        self.sandbox.files = []
+        self.volumes = 0
+
+        async def write_files(path, *files):
+            self.sandbox.files.extend((file.name, file.content_bytes()) for file in files)
+            self.sandbox.stream.messages.append(Message(2, b'checked'))
+
+        self.sandbox.write_files = write_files
+
+    @asynccontextmanager
+    async def workdir(self):
+        self.volumes += 1
+        yield DockerVolume(None, 'check')
+
+    async def create_container(self, profile, files, mounts, limits, timeout, priority):
+        self.sandbox.profile = profile
+        return self.sandbox
+
+
+@pytest.mark.asyncio
+async def test_checker_test_case_runs_checker_on_spooled_output():
+    executor = FakeCheckerExecutor(exit_code=1)
+    builder = SandboxBuilder().with_profile(DockerProfile(image='checker', cmd_template=['./check']))
+    solution = FakeOutputSandbox([Message(1, b'42'), Message(1, b'\n')])
+
+    async with Checker(executor, builder) as checker:
+        result = await CheckerTestCase(b'6 7\n', b'42\n', checker=checker).exec(solution)
+
+    assert result.status == TestStatus.wrong_answer
+    assert result.why == 'checked'
+    assert executor.sandbox.profile.cmd_template == ['./check', '/check/input', '/check/output', '/check/answer']
+    assert sorted(executor.sandbox.files) == [('answer', b'42\n'), ('input', b'6 7\n'), ('output', b'42\n')]
+    assert executor.sandbox.deleted
+
+
+@pytest.mark.asyncio
+async def test_suite_runs_only_tests_missing_in_cache():
+    factory = FakeSandboxFactory()
+    cache = MemoryResultCache()
+    suite = BaseTestSuite(factory, sandbox_per_test=True, result_cache=cache, solution_key='solution')
+    suite.add_tests(SleepTestCase(0.01), SleepTestCase(0.02))
+
+    await suite.exec(None)
+    suite.add_tests(SleepTestCase(0.03), SleepTestCase(0.0, TestStatus.server_error))
+    results = await suite.exec(None)
+
+    assert [result.duration for result in results] == [0.01, 0.02, 0.03, 0.0]
+    assert len(factory.sandboxes) == 4
+    assert len(cache) == 3
+
+    await suite.exec(None, use_cache=False)
+    assert len(factory.sandboxes) == 8
+
+
+def test_solution_key_is_stable_for_placeholders():
+    def builder():
+        return SandboxBuilder().with_profile(DockerProfile(image='gcc', cmd_template=['g++', _[0], ...]))
+
+    assert solution_key(builder()) == solution_key(builder())
+
+
+def test_result_cache_needs_solution_key_for_mounts():
+    builder = SandboxBuilder() \
+        .with_profile(DockerProfile(image='gcc', cmd_template=['./main'])) \
+        .mount(DockerVolume(None, 'build'), '/build')
+
+    with pytest.raises(ValueError):
+        BaseTestSuite(builder, result_cache=MemoryResultCache())
+    with pytest.raises(ValueError):
+        solution_key(builder)
+    BaseTestSuite(builder, result_cache=MemoryResultCache(), solution_key='build-cache-key')
+
+
+def test_comparator_parameters_are_keyed():
+    def key(comparator):
+        return CheckerTestCase(b'1\n', b'1\n', comparator=comparator).cache_key()
+
+    assert key(functools.partial(FloatComparator, epsilon=1e-3)) == \
+           key(functools.partial(FloatComparator, epsilon=1e-3))
+    assert key(functools.partial(FloatComparator, epsilon=1e-3)) != \
+           key(functools.partial(FloatComparator, epsilon=1e-6))
+    assert key(FloatComparator) != key(TokenComparator)
+    with pytest.raises(TypeError):
+        key(lambda expected: TokenComparator(expected))
+
+
+def test_sqlite_result_cache_keeps_recent_results(tmp_path):
+    cache = SqliteResultCache(tmp_path / 'results.db', max_entries=2)
+    for idx in range(3):
+        cache.set(str(idx), TestResult(status=TestStatus.ok, why=None, duration=idx))
+    cache.evict()
+    cache.close()
+
+    cache = SqliteResultCache(tmp_path / 'results.db')
+    assert cache.get('0') is None
+    assert cache.get('2') == TestResult(status=TestStatus.ok, why=None, duration=2)
+    assert len(cache) == 2